@@ -0,0 +1,107 @@
+"""
+语义答案缓存
+问题向量与历史问题的余弦相似度达到阈值即视为命中，直接返回缓存的答案与引用；
+支持 TTL / LRU 淘汰，索引重新入库后整体失效
+"""
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from config import AnswerCacheConfig
+
+
+class SemanticAnswerCache:
+    """按问题语义命中的答案缓存"""
+
+    def __init__(self, threshold=None, ttl=None, max_entries=None, version_fn=None):
+        self.threshold = threshold or AnswerCacheConfig.similarity_threshold
+        self.ttl = ttl or AnswerCacheConfig.ttl_seconds
+        self.max_entries = max_entries or AnswerCacheConfig.max_entries
+        # version_fn 返回索引的入库版本，版本变化时清空缓存
+        self.version_fn = version_fn
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._next_key = 0
+        self._version = None
+        self._version_checked = 0.0
+
+    def _check_version(self):
+        """version_fn 可能是一次网络请求（如读取 ES mapping），在锁外调用"""
+        if self.version_fn is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if now - self._version_checked < AnswerCacheConfig.version_check_interval:
+                return
+            self._version_checked = now
+        try:
+            version = self.version_fn()
+        except Exception:
+            return
+        with self.lock:
+            if version != self._version:
+                self.entries.clear()
+                self._version = version
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        for key in [k for k, entry in self.entries.items() if entry['created'] < deadline]:
+            del self.entries[key]
+
+    def lookup(self, query_embedding):
+        """返回最相似且达到阈值的缓存条目 {'query', 'answer', 'docs', 'similarity'}，否则 None"""
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(np.linalg.norm(query), 1e-12)
+        self._check_version()
+        with self.lock:
+            self._expire()
+            if not self.entries:
+                self.misses += 1
+                return None
+            keys = list(self.entries)
+            matrix = np.stack([self.entries[key]['embedding'] for key in keys])
+            similarities = matrix @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            key = keys[best]
+            self.entries.move_to_end(key)
+            self.hits += 1
+            entry = self.entries[key]
+            return {
+                'query': entry['query'],
+                'answer': entry['answer'],
+                'docs': entry['docs'],
+                'similarity': float(similarities[best])
+            }
+
+    def store(self, query, query_embedding, answer, docs):
+        embedding = np.asarray(query_embedding, dtype=np.float32)
+        embedding = embedding / max(np.linalg.norm(embedding), 1e-12)
+        with self.lock:
+            self.entries[self._next_key] = {
+                'query': query,
+                'embedding': embedding,
+                'answer': answer,
+                'docs': docs,
+                'created': time.monotonic()
+            }
+            self._next_key += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.entries)
+        }
@@ -0,0 +1,270 @@
+"""
+异步 RAG 查询引擎
+基于 AsyncElasticsearch 与 AsyncOpenAI，进程内共享调优后的连接池，
+单个 worker 可同时处理多个问题（并发上限可配置）
+"""
+import asyncio
+import sys
+import time
+import httpx
+from elasticsearch import AsyncElasticsearch
+from openai import AsyncOpenAI
+from config import (
+    ElasticConfig, OPENAI_API_KEY, OPENAI_BASE_URL, RetrievalConfig, ServingConfig, VectorStoreConfig
+)
+from pdf_rag import (
+    StreamTimer, build_messages, candidate_size, encode_texts, expansion_messages, make_answer_cache,
+    merge_hits, open_store, parse_variations, record_llm_tokens
+)
+from components import registry
+from metrics import metrics, span
+from reranker import make_reranker
+from vector_store import ElasticsearchVectorStore
+
+
+class AsyncClients:
+    """进程内共享的异步 Elasticsearch / LLM 客户端"""
+
+    def __init__(self):
+        self.es = AsyncElasticsearch(
+            [ElasticConfig.url],
+            verify_certs=False,
+            connections_per_node=ServingConfig.es_connections_per_node,
+            request_timeout=ServingConfig.request_timeout
+        )
+        self.llm = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            base_url=OPENAI_BASE_URL,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=ServingConfig.llm_max_connections,
+                    max_keepalive_connections=ServingConfig.llm_max_keepalive
+                ),
+                timeout=ServingConfig.request_timeout
+            )
+        )
+
+    async def close(self):
+        await self.es.close()
+        await self.llm.close()
+
+
+_shared_clients = None
+
+
+def shared_clients():
+    """返回进程内唯一的 AsyncClients，所有 AsyncRAGQuery 复用同一组连接池"""
+    global _shared_clients
+    if _shared_clients is None:
+        _shared_clients = AsyncClients()
+    return _shared_clients
+
+
+class AsyncRAGQuery:
+    """异步 RAG 查询：检索与生成都不阻塞事件循环"""
+
+    def __init__(self, index_name, clients=None, store=None, mode=None, expand=None,
+                 reranker=None, max_concurrency=None):
+        self.index_name = index_name
+        self.clients = clients or shared_clients()
+        self.store = store or open_store(index_name)
+        self.mode = mode or RetrievalConfig.search_mode
+        self.expand = RetrievalConfig.query_expansion if expand is None else expand
+        self.reranker = reranker or make_reranker(RetrievalConfig.reranker)
+        self.answer_cache = make_answer_cache(self.store)
+        self.limit = asyncio.Semaphore(max_concurrency or ServingConfig.max_concurrency)
+
+    async def expand_query(self, query, n=None):
+        """用 LLM 生成 n 个改写问题，失败时返回空列表"""
+        n = n or RetrievalConfig.num_query_variations
+        try:
+            response = await self.clients.llm.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=expansion_messages(query, n),
+                temperature=0.7,
+                max_tokens=200
+            )
+        except Exception:
+            return []
+        return parse_variations(response.choices[0].message.content, query, n)
+
+    async def _multi_search(self, query_embeddings, size, text_queries):
+        if isinstance(self.store, ElasticsearchVectorStore):
+            searches = self.store.msearch_body(query_embeddings, size, text_queries)
+            result = await self.clients.es.msearch(searches=searches)
+            return self.store.parse_msearch(result, len(text_queries))
+        # 本地向量存储在线程中检索
+        return await asyncio.to_thread(self.store.multi_search, query_embeddings, size, text_queries)
+
+    async def search(self, query, top_k=5, mode=None, expand=None, timings=None):
+        """同 RAGQuery.search；各阶段耗时写入 timings（毫秒）"""
+        mode = mode or self.mode
+        expand = self.expand if expand is None else expand
+        timings = {} if timings is None else timings
+
+        queries = [query]
+        if expand:
+            started = time.perf_counter()
+            queries += await self.expand_query(query)
+            timings['expand'] = (time.perf_counter() - started) * 1000
+
+        # 模型编码是 CPU 计算，放到线程中避免阻塞事件循环
+        started = time.perf_counter()
+        query_embeddings = await asyncio.to_thread(encode_texts, queries)
+        timings['encode'] = (time.perf_counter() - started) * 1000
+
+        text_queries = [query] if mode == 'hybrid' and self.store.supports_text_search else []
+        size = candidate_size(len(queries) + len(text_queries), top_k)
+
+        started = time.perf_counter()
+        with span('search', backend=VectorStoreConfig.backend, knn=len(queries), bm25=len(text_queries)):
+            knn_lists, bm25_lists, latencies = await self._multi_search(query_embeddings, size, text_queries)
+        timings['search'] = (time.perf_counter() - started) * 1000
+        timings['knn'] = max(latencies['knn'])
+        if latencies['bm25']:
+            timings['bm25'] = max(latencies['bm25'])
+
+        return merge_hits(knn_lists, bm25_lists, top_k)
+
+    async def retrieve(self, query, top_k=None, timings=None):
+        """检索；配置了重排序器时先取 top_k_rerank 个候选再重排到 top_k（未指定时为 final_top_k）"""
+        timings = {} if timings is None else timings
+        if self.reranker is None:
+            return await self.search(query, top_k or 5, timings=timings)
+
+        top_k = top_k or RetrievalConfig.final_top_k
+        candidates = await self.search(query, max(RetrievalConfig.top_k_rerank, top_k), timings=timings)
+        started = time.perf_counter()
+        with span('rerank', candidates=len(candidates)) as s:
+            docs, reranked = await asyncio.to_thread(
+                self.reranker.rerank, query, candidates, top_k
+            )
+            s.set(completed=reranked)
+        timings['rerank'] = (time.perf_counter() - started) * 1000
+        return docs
+
+    async def cached_answer(self, query):
+        """同 RAGQuery.cached_answer，编码与查找放到线程中"""
+        if self.answer_cache is None:
+            return None, None
+        query_embedding = (await asyncio.to_thread(encode_texts, [query]))[0]
+        cached = await asyncio.to_thread(self.answer_cache.lookup, query_embedding)
+        metrics.inc('rag_answer_cache_total', result='hit' if cached else 'miss')
+        return cached, query_embedding
+
+    def remember_answer(self, query, query_embedding, answer, docs):
+        if self.answer_cache is not None and docs:
+            self.answer_cache.store(query, query_embedding, answer, docs)
+
+    async def generate_answer(self, query, timings=None, report=None):
+        """生成答案，返回 (答案, 文档)；同时进行中的问题数受 max_concurrency 限制
+
+        report 给出时写入上下文装配统计（含 prompt_tokens）
+        """
+        timings = {} if timings is None else timings
+        report = {} if report is None else report
+        async with self.limit:
+            with span('query'):
+                cached, query_embedding = await self.cached_answer(query)
+                if cached:
+                    return cached['answer'], cached['docs']
+
+                docs = await self.retrieve(query, timings=timings)
+                if not docs:
+                    return "未找到相关信息", []
+
+                messages = build_messages(query, docs, report)
+                started = time.perf_counter()
+                with span('llm', prompt_tokens=report['prompt_tokens']):
+                    response = await self.clients.llm.chat.completions.create(
+                        model="gpt-4o-mini",
+                        messages=messages,
+                        temperature=0.7,
+                        max_tokens=800
+                    )
+                timings['llm'] = (time.perf_counter() - started) * 1000
+                record_llm_tokens(report, response.usage)
+
+        answer = response.choices[0].message.content
+        self.remember_answer(query, query_embedding, answer, docs)
+        return answer, docs
+
+    async def stream_answer(self, query):
+        """异步流式生成答案，事件格式同 RAGQuery.stream_answer"""
+        async with self.limit:
+            timer = StreamTimer()
+            timings = {}
+            # span 不跨越 yield：只覆盖检索部分
+            with span('query', stream=True):
+                cached, query_embedding = await self.cached_answer(query)
+                docs = None if cached else await self.retrieve(query, timings=timings)
+            if cached:
+                yield {'event': 'docs', 'docs': cached['docs']}
+                timer.token()
+                yield {'event': 'token', 'text': cached['answer']}
+                yield {'event': 'done', 'metrics': {**timer.metrics(), 'cache_hit': True}}
+                return
+
+            yield {'event': 'docs', 'docs': docs}
+
+            if not docs:
+                yield {'event': 'token', 'text': "未找到相关信息"}
+                yield {'event': 'done', 'metrics': timer.metrics(timings)}
+                return
+
+            report = {}
+            messages = build_messages(query, docs, report)
+            timer.request_sent()
+            stream = await self.clients.llm.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=0.7,
+                max_tokens=800,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            parts = []
+            usage = None
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                    timer.usage(chunk.usage.completion_tokens)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    timer.token()
+                    parts.append(chunk.choices[0].delta.content)
+                    yield {'event': 'token', 'text': parts[-1]}
+
+            timer.record()
+            record_llm_tokens(report, usage)
+            self.remember_answer(query, query_embedding, ''.join(parts), docs)
+            yield {'event': 'done', 'metrics': {
+                **timer.metrics(timings),
+                'prompt_tokens': report['prompt_tokens'],
+                'cache_hit': False
+            }}
+
+    async def answer_many(self, questions):
+        """并发回答多个问题，结果顺序与输入一致"""
+        return await asyncio.gather(*(self.generate_answer(q) for q in questions))
+
+
+async def _demo(index_name, questions):
+    # 服务端在接收请求前预热，首个问题不承担模型加载开销
+    registry.warm_up(['embedder', 'embedding_cache', 'context_builder'])
+    rag = AsyncRAGQuery(index_name)
+    started = time.perf_counter()
+    try:
+        results = await rag.answer_many(questions)
+    finally:
+        await rag.clients.close()
+    for question, (answer, docs) in zip(questions, results):
+        print("=" * 70)
+        print(f"💬 {question}")
+        print(answer)
+        print(f"📚 {len(docs)} 个文档")
+    print(f"\n✓ {len(questions)} 个问题，用时 {time.perf_counter() - started:.1f} 秒")
+
+
+if __name__ == "__main__":
+    # 用法: python async_rag.py "问题1" "问题2" ...
+    asyncio.run(_demo("pdf_rag_index", sys.argv[1:] or ["这份文档讲了什么？"]))
@@ -0,0 +1,152 @@
+"""
+批量问答与离线评测
+从 JSONL 读入问题，分批编码与检索（每批一次批量编码、一个 _msearch 请求），线程池并发生成答案，
+答案、引用与各阶段耗时按输入顺序逐行写入 JSONL；问题带 gold_pages 时统计 recall@k，
+一次运行同时得到检索改动对速度与质量的影响
+
+问题文件每行一个 JSON 对象:
+    {"id": "q1", "question": "...", "gold_pages": [3, {"source": "a.pdf", "page": 5}]}
+id 也可写作 request_id；没有 question 时用 title 与 body 拼成问题；
+gold_pages 可省略，整数表示任意文档的该页
+
+用法:
+    python pdf_rag.py --batch questions.jsonl --output answers.jsonl
+    python mini_rag_demo.py questions.jsonl answers.jsonl
+"""
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import percentiles
+from pipeline import batched, ordered_map
+
+RECALL_KS = (1, 3, 5, 10)
+NO_ANSWER = "未找到相关信息"
+
+
+def load_questions(path):
+    """读取问题文件，返回 [{'id', 'question', 'gold'}]"""
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            text = record.get('question') or '\n'.join(
+                part for part in (record.get('title'), record.get('body')) if part
+            )
+            if not text:
+                raise ValueError(f"{path} 第 {line_no} 行没有 question（或 title / body）")
+            questions.append({
+                'id': record.get('id') or record.get('request_id') or str(line_no),
+                'question': text,
+                'gold': record.get('gold_pages') or []
+            })
+    return questions
+
+
+def _gold_key(item):
+    if isinstance(item, dict):
+        return item.get('source'), item['page']
+    return None, item
+
+
+def recall_at_k(docs, gold, k):
+    """前 k 个文档覆盖的标注页占比（同一页的多个块只算一次）"""
+    gold = {_gold_key(item) for item in gold}
+    found = {
+        (source, page) for source, page in gold
+        for doc in docs[:k]
+        if doc.get('page') == page and source in (None, doc.get('source'))
+    }
+    return len(found) / len(gold)
+
+
+def citation(doc):
+    """引用只保留出处与分数，不重复写入原文"""
+    return {key: doc[key] for key in ('source', 'page', 'type', 'chunk_id', 'score') if key in doc}
+
+
+def _retrieved(questions, retrieve_batch, top_k, batch_size):
+    """逐批检索，产出 (问题, 文档, 耗时)；检索失败时该批问题带上错误信息"""
+    for batch in batched(questions, batch_size):
+        try:
+            results = retrieve_batch([item['question'] for item in batch], top_k)
+        except Exception as e:
+            print(f"  ⚠️ 检索失败（{len(batch)} 个问题）: {e}")
+            results = [([], {'error': str(e)})] * len(batch)
+        for item, (docs, timings) in zip(batch, results):
+            yield item, docs, dict(timings)
+
+
+def _answer(answer, item, docs, timings, generate, ks):
+    record = {'id': item['id'], 'question': item['question'], 'answer': None,
+              'citations': [citation(doc) for doc in docs]}
+    error = timings.pop('error', None)
+    if error is None and generate:
+        if docs:
+            report = {}
+            started = time.perf_counter()
+            try:
+                record['answer'] = answer(item['question'], docs, report)
+            except Exception as e:
+                error = str(e)
+            timings['llm'] = (time.perf_counter() - started) * 1000
+            if 'prompt_tokens' in report:
+                record['prompt_tokens'] = report['prompt_tokens']
+        else:
+            record['answer'] = NO_ANSWER
+    record['timings_ms'] = timings
+    if item['gold']:
+        record['recall'] = {str(k): recall_at_k(docs, item['gold'], k) for k in ks}
+    if error is not None:
+        record['error'] = error
+    return record
+
+
+def run_batch(questions, retrieve_batch, answer, output_path, top_k=5, batch_size=32,
+              concurrency=8, generate=True):
+    """批量回答 questions，结果写入 output_path，返回汇总
+
+    retrieve_batch(问题列表, top_k) -> [(文档, 耗时)]；answer(问题, 文档, report) -> 答案。
+    每批检索完即把生成任务交给线程池，下一批的检索与在途的生成重叠；generate=False 时只评测检索
+    """
+    # 超过 top_k 的 recall@k 没有意义
+    ks = [k for k in RECALL_KS if k < top_k] + [top_k]
+    records = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool, \
+            open(output_path, 'w', encoding='utf-8') as f:
+        retrieved = _retrieved(questions, retrieve_batch, top_k, batch_size)
+        tasks = ((answer, item, docs, timings, generate, ks) for item, docs, timings in retrieved)
+        for record in ordered_map(pool, _answer, tasks, max_pending=concurrency * 2):
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            records.append(record)
+    elapsed = time.perf_counter() - started
+
+    stage_names = sorted({name for record in records for name in record['timings_ms']})
+    labelled = [record['recall'] for record in records if 'recall' in record]
+    return {
+        'questions': len(records),
+        'errors': sum('error' in record for record in records),
+        'seconds': elapsed,
+        'qps': len(records) / elapsed if elapsed else 0.0,
+        'stages_ms': {
+            name: percentiles([r['timings_ms'][name] for r in records if name in r['timings_ms']])
+            for name in stage_names
+        },
+        'labelled': len(labelled),
+        'recall': {
+            k: sum(recall[k] for recall in labelled) / len(labelled) for k in labelled[0]
+        } if labelled else {}
+    }
+
+
+def print_summary(summary, output_path):
+    print("\n" + "=" * 70)
+    print(f"✓ {summary['questions']} 个问题, {summary['seconds']:.1f} 秒, {summary['qps']:.1f} 问题/秒, "
+          f"失败 {summary['errors']} 个 -> {output_path}")
+    for name, stage in summary['stages_ms'].items():
+        print(f"  {name:<8} p50 {stage['p50']:.1f}ms  p95 {stage['p95']:.1f}ms")
+    if summary['recall']:
+        print(f"  recall ({summary['labelled']} 个带标注): " + "  ".join(
+            f"@{k} {value:.3f}" for k, value in summary['recall'].items()))
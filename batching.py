@@ -0,0 +1,148 @@
+"""
+动态微批处理
+把并发的小请求合并为一次批量调用（如查询向量编码：batch=1 的前向计算浪费 BLAS 吞吐）。
+worker 空闲时请求立即执行，低负载下不增加延迟；worker 忙时新请求在队列中积累，下一批一次取走；
+最近一批不止一个请求（有并发）时，再最多等待 max_wait 凑满 max_batch
+用法: python batching.py   # 模拟模型上不同并发下的吞吐与 p99
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from metrics import SIZE_BUCKETS, observe
+
+
+class MicroBatcher:
+    """fn(items) -> 与 items 等长的结果序列；submit(items) 返回这几项结果的 Future"""
+
+    def __init__(self, fn, max_batch, max_wait_ms=0, workers=1, name='batch'):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.pending = queue.Queue()
+        self.slots = threading.Semaphore(workers)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.last_batch_calls = 0
+        self.batches = 0
+        self.calls = 0
+        self.items = 0
+        self.max_depth = 0
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def submit(self, items):
+        future = Future()
+        depth = self.pending.qsize()
+        observe('rag_batch_queue_depth', depth, buckets=SIZE_BUCKETS, batcher=self.name)
+        with self.lock:
+            self.max_depth = max(self.max_depth, depth)
+        self.pending.put((list(items), future, time.perf_counter()))
+        return future
+
+    def __call__(self, items):
+        return self.submit(items).result()
+
+    def _collect(self):
+        while True:
+            batch = [self.pending.get()]
+            # 所有 worker 都忙时在此等待，期间到达的请求留在队列里，下一批一起处理
+            self.slots.acquire()
+            count = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait if self.last_batch_calls > 1 else 0
+            while count < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        item = self.pending.get(timeout=remaining)
+                    else:
+                        item = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                count += len(item[0])
+            self.last_batch_calls = len(batch)
+            self.pool.submit(self._run, batch, count)
+
+    def _run(self, batch, count):
+        started = time.perf_counter()
+        try:
+            for _, _, submitted in batch:
+                observe('rag_batch_wait_seconds', started - submitted, batcher=self.name)
+            observe('rag_batch_size', count, buckets=SIZE_BUCKETS, batcher=self.name)
+            try:
+                results = self.fn([entry for items, _, _ in batch for entry in items])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                return
+            offset = 0
+            for items, future, _ in batch:
+                future.set_result(results[offset:offset + len(items)])
+                offset += len(items)
+            with self.lock:
+                self.batches += 1
+                self.calls += len(batch)
+                self.items += count
+        finally:
+            self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'calls': self.calls,
+                'items': self.items,
+                'mean_batch': self.items / self.batches if self.batches else 0.0,
+                'max_queue_depth': self.max_depth
+            }
+
+
+def benchmark(fn, concurrency_levels=(1, 4, 16, 64), requests_per_level=400, max_batch=32,
+              max_wait_ms=2):
+    """同一 fn 直接调用与经 MicroBatcher 调用，在各并发度下的吞吐与 p99 延迟"""
+    for concurrency in concurrency_levels:
+        for label, batcher in (('直接', None), ('微批', MicroBatcher(fn, max_batch, max_wait_ms))):
+            call = batcher or fn
+            latencies = []
+
+            def client(n):
+                for i in range(n):
+                    started = time.perf_counter()
+                    call([f"query {i}"])
+                    latencies.append(time.perf_counter() - started)
+
+            per_client = max(requests_per_level // concurrency, 1)
+            threads = [threading.Thread(target=client, args=(per_client,)) for _ in range(concurrency)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            extra = f"  平均批量 {batcher.stats()['mean_batch']:.1f}" if batcher else ""
+            print(f"并发 {concurrency:>3} {label}: {len(latencies) / elapsed:8.0f} 次/秒  "
+                  f"p99 {p99 * 1000:6.1f}ms{extra}")
+
+
+_device = threading.Lock()
+
+
+def _simulated_model(texts, fixed_ms=2.0, per_item_ms=0.05):
+    """前向计算耗时 = 固定开销 + 每条的边际开销（与真实模型一样，批量越大单条越便宜）；
+    一次前向计算占满所有核，并发调用只能排队"""
+    with _device:
+        time.sleep((fixed_ms + per_item_ms * len(texts)) / 1000)
+    return [None] * len(texts)
+
+
+if __name__ == "__main__":
+    import sys
+    if '--model' in sys.argv:
+        from components import get_model
+        model = get_model()
+        benchmark(lambda texts: model.encode(texts))
+    else:
+        benchmark(_simulated_model)
@@ -0,0 +1,458 @@
+"""
+端到端性能基准
+合成 PDF 语料 + 本地 OpenAI 兼容桩服务 + 本地向量存储，不依赖 Elasticsearch 和外网；
+测量入库吞吐与各阶段耗时、并发查询延迟分位数，结果写成 JSON 便于回归对比
+
+用法:
+    python benchmark.py --docs 20 --pages 10 --concurrency 8 --output bench.json
+    python benchmark.py --compare baseline.json bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "retrieval augmented generation vector index embedding query answer document page table image "
+    "latency throughput cache shard replica cluster search ranking fusion model token context "
+    "pipeline batch stream worker process memory disk network request response score"
+).split()
+
+STAGE_KEYS = {'抽取': 'extract', '图像描述': 'caption', '编码': 'encode', '索引': 'index'}
+
+
+# ---- 合成语料 ----
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def make_corpus(directory, num_docs, pages, images_per_page=1, seed=0):
+    """生成 num_docs 个各 pages 页的 PDF：段落文本、图像（含每页重复的 logo）、首页一张表格"""
+    import fitz  # PyMuPDF
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    logo = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 32, 32), 0)
+    logo.clear_with(180)
+
+    for doc_no in range(num_docs):
+        doc = fitz.open()
+        for page_no in range(pages):
+            page = doc.new_page()
+            page.insert_image(fitz.Rect(500, 20, 540, 60), pixmap=logo)
+            y = 80
+            for _ in range(4):
+                text = ' '.join(sentence(rng) for _ in range(rng.randint(3, 6)))
+                page.insert_textbox(fitz.Rect(50, y, 550, y + 110), text, fontsize=9)
+                y += 120
+            for i in range(images_per_page):
+                pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 24, 24), 0)
+                pixmap.clear_with(rng.randint(0, 255))
+                page.insert_image(fitz.Rect(60 + i * 60, 700, 110 + i * 60, 750), pixmap=pixmap)
+            if page_no == 0:
+                draw_table(page, rng, fitz.Rect(50, 560, 550, 680))
+        doc.save(os.path.join(directory, f"doc_{doc_no:04d}.pdf"))
+        doc.close()
+
+
+def draw_table(page, rng, rect, rows=5, cols=4):
+    """画带边框的表格，pdfplumber 可按线条识别"""
+    import fitz  # PyMuPDF
+    width = rect.width / cols
+    height = rect.height / rows
+    for r in range(rows + 1):
+        page.draw_line((rect.x0, rect.y0 + r * height), (rect.x1, rect.y0 + r * height))
+    for c in range(cols + 1):
+        page.draw_line((rect.x0 + c * width, rect.y0), (rect.x0 + c * width, rect.y1))
+    for r in range(rows):
+        for c in range(cols):
+            cell = rng.choice(WORDS) if r == 0 else str(rng.randint(1, 999))
+            page.insert_text((rect.x0 + c * width + 4, rect.y0 + r * height + height * 0.7), cell, fontsize=8)
+
+
+def make_questions(num, seed=1):
+    rng = random.Random(seed)
+    return [
+        f"What does the document say about {' '.join(rng.sample(WORDS, 3))}?"
+        for _ in range(num)
+    ]
+
+
+# ---- OpenAI 兼容桩服务 ----
+
+class StubHandler(BaseHTTPRequestHandler):
+    """POST /v1/chat/completions（含流式）与 /rerank，按配置的延迟返回固定内容"""
+
+    protocol_version = 'HTTP/1.1'
+    # 头和正文分两次写出：keep-alive 连接上不关 Nagle 会叠加 40ms 延迟确认
+    disable_nagle_algorithm = True
+    first_token_ms = 200
+    token_ms = 10
+    answer_tokens = 50
+    rerank_ms = 20
+    embed_ms = 5
+    embedding_dims = int(os.getenv('EMBEDDING_DIMS', '384'))
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path.endswith('/rerank'):
+            time.sleep(self.rerank_ms / 1000)
+            query = set(request['query'].lower().split())
+            return self._json({'results': [
+                {'index': i, 'relevance_score': len(query & set(doc.lower().split())) / (1 + len(query))}
+                for i, doc in enumerate(request['documents'])
+            ]})
+        if self.path.endswith('/embeddings'):
+            time.sleep(self.embed_ms / 1000)
+            return self._json({'object': 'list', 'model': request.get('model', 'stub'), 'data': [
+                {'object': 'embedding', 'index': i, 'embedding': self._embedding(text)}
+                for i, text in enumerate(request['input'])
+            ]})
+        if not self.path.endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        if request.get('stream'):
+            return self._stream(request)
+
+        time.sleep((self.first_token_ms + self.token_ms * self.answer_tokens) / 1000)
+        self._json({
+            'id': 'stub', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': request.get('model', 'stub'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': 'stub ' * self.answer_tokens}}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': self.answer_tokens,
+                      'total_tokens': self.answer_tokens}
+        })
+
+    def _embedding(self, text):
+        # 以文本为种子的固定随机向量：同一文本总是得到同一向量
+        rng = random.Random(text)
+        return [round(rng.gauss(0, 1), 4) for _ in range(self.embedding_dims)]
+
+    def _stream(self, request):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def send(payload):
+            data = f"data: {payload}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        base = {'id': 'stub', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                'model': request.get('model', 'stub')}
+        time.sleep(self.first_token_ms / 1000)
+        for i in range(self.answer_tokens):
+            if i:
+                time.sleep(self.token_ms / 1000)
+            send(json.dumps({**base, 'choices': [
+                {'index': 0, 'delta': {'content': 'stub '}, 'finish_reason': None}
+            ]}))
+        if (request.get('stream_options') or {}).get('include_usage'):
+            send(json.dumps({**base, 'choices': [], 'usage': {
+                'prompt_tokens': 0, 'completion_tokens': self.answer_tokens,
+                'total_tokens': self.answer_tokens}}))
+        send('[DONE]')
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端关闭长连接属于正常情况，不打印堆栈
+        if not issubclass(sys.exc_info()[0], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_stub_server(first_token_ms, token_ms, answer_tokens):
+    """在后台线程启动桩服务，返回 (server, base_url)"""
+    handler = type('ConfiguredStubHandler', (StubHandler,), {
+        'first_token_ms': first_token_ms, 'token_ms': token_ms, 'answer_tokens': answer_tokens
+    })
+    server = StubServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ---- 测量 ----
+
+def measure_startup():
+    """导入 pdf_rag 的耗时（组件均延迟加载）与首次加载嵌入模型的耗时"""
+    started = time.perf_counter()
+    import pdf_rag  # noqa: F401
+    import_seconds = time.perf_counter() - started
+    from components import registry
+    registry.warm_up(['embedder'])
+    return {'import_seconds': import_seconds, 'components': registry.stats()}
+
+
+def run_ingest(pdf_dir, index_name):
+    from components import get_embedding_cache
+    from pdf_rag import PDFProcessor
+
+    with PDFProcessor(index_name, rebuild=True) as processor:
+        started = time.perf_counter()
+        total = processor.process_directory(pdf_dir)
+        elapsed = time.perf_counter() - started
+
+    stats = processor.last_stats
+    return processor, {
+        'seconds': elapsed,
+        'chunks': total,
+        'chunks_per_sec': total / elapsed if elapsed else 0.0,
+        'counts': dict(stats.counts),
+        'failed': len(stats.failed),
+        'stages': {
+            STAGE_KEYS.get(name, name): {
+                'items': stage.items, 'busy_seconds': stage.busy, 'rate': stage.rate
+            }
+            for name, stage in stats.stages.items()
+        },
+        'embedding_cache': get_embedding_cache().stats(),
+        'captions': {'requests': processor.captioner.requests,
+                     'cache_hits': processor.captioner.cache_hits,
+                     'deduplicated': processor.captioner.deduplicated}
+    }
+
+
+def run_queries(store, index_name, questions, concurrency, stream, warmup=3):
+    """每个线程一个 RAGQuery（last_timings 不跨线程共享），并发回答 questions"""
+    from metrics import percentiles
+    from pdf_rag import RAGQuery
+
+    local = threading.local()
+
+    def engine():
+        if not hasattr(local, 'rag'):
+            local.rag = RAGQuery(index_name, store=store)
+        return local.rag
+
+    def ask(question):
+        rag = engine()
+        started = time.perf_counter()
+        ttft = None
+        if stream:
+            for event in rag.stream_answer(question):
+                if event['event'] == 'token' and ttft is None:
+                    ttft = (time.perf_counter() - started) * 1000
+        else:
+            rag.generate_answer(question)
+        return {
+            'total': (time.perf_counter() - started) * 1000,
+            'ttft': ttft,
+            'stages': dict(rag.last_timings),
+            'prompt_tokens': rag.last_context.get('prompt_tokens')
+        }
+
+    for question in questions[:warmup]:
+        ask(question)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(ask, questions))
+    elapsed = time.perf_counter() - started
+
+    stage_names = sorted({name for r in results for name in r['stages']})
+    prompt_tokens = [r['prompt_tokens'] for r in results if r['prompt_tokens'] is not None]
+    return {
+        'questions': len(questions),
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'qps': len(questions) / elapsed if elapsed else 0.0,
+        'latency_ms': percentiles([r['total'] for r in results]),
+        'ttft_ms': percentiles([r['ttft'] for r in results if r['ttft'] is not None]),
+        'stages_ms': {
+            name: percentiles([r['stages'][name] for r in results if name in r['stages']])
+            for name in stage_names
+        },
+        'prompt_tokens_mean': sum(prompt_tokens) / len(prompt_tokens) if prompt_tokens else None
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def configure_environment(args, workdir, base_url):
+    """在导入 config / pdf_rag 之前设置，所有缓存与存储都放到临时目录"""
+    os.environ.update({
+        'OPENAI_BASE_URL': f"{base_url}/v1",
+        'OPENAI_API_KEY': os.environ.get('OPENAI_API_KEY') or 'sk-benchmark',
+        'RERANK_URL': f"{base_url}/rerank",
+        'EMBEDDING_URL': f"{base_url}/v1/embeddings",
+        'EMBEDDING_BACKEND': args.embedding,
+        'VECTOR_STORE': args.store,
+        'VECTOR_STORE_DIR': os.path.join(workdir, 'vector_store'),
+        'EMBEDDING_CACHE_DIR': os.path.join(workdir, 'embeddings'),
+        'CAPTION_CACHE': os.path.join(workdir, 'captions.jsonl'),
+        'INGEST_MANIFEST': os.path.join(workdir, 'manifest.json'),
+        'SEARCH_MODE': args.search_mode,
+        'RERANKER': args.reranker,
+        'QUERY_EXPANSION': 'true' if args.expand else 'false',
+        # 每个问题都走完整流程，不命中语义答案缓存
+        'ANSWER_CACHE': 'false',
+        'RAG_METRICS': 'true',
+        'LOG_FILE': os.path.join(workdir, 'rag_system.log')
+    })
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='rag_bench_')
+    server, base_url = start_stub_server(args.first_token_ms, args.token_ms, args.answer_tokens)
+    try:
+        configure_environment(args, workdir, base_url)
+        pdf_dir = os.path.join(workdir, 'pdfs')
+        started = time.perf_counter()
+        make_corpus(pdf_dir, args.docs, args.pages, args.images_per_page, seed=args.seed)
+        print(f"✓ 合成语料: {args.docs} 个文档 x {args.pages} 页 ({time.perf_counter() - started:.1f} 秒)")
+
+        index_name = 'benchmark_index'
+        startup = measure_startup()
+        processor, ingest = run_ingest(pdf_dir, index_name)
+        questions = make_questions(args.queries, seed=args.seed + 1)
+        query = run_queries(processor.store, index_name, questions, args.concurrency, args.stream)
+        from metrics import metrics
+        snapshot = metrics.snapshot()
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'startup': startup,
+        'ingest': ingest,
+        'query': query,
+        'metrics': snapshot
+    }
+
+
+# ---- 回归对比 ----
+
+COMPARE_METRICS = [
+    ('startup.import_seconds', False),
+    ('ingest.chunks_per_sec', True),
+    ('ingest.seconds', False),
+    ('ingest.stages.extract.rate', True),
+    ('ingest.stages.encode.rate', True),
+    ('ingest.stages.index.rate', True),
+    ('query.qps', True),
+    ('query.latency_ms.p50', False),
+    ('query.latency_ms.p95', False),
+    ('query.latency_ms.p99', False),
+    ('query.ttft_ms.p50', False),
+    ('query.prompt_tokens_mean', False),
+]
+
+
+def lookup(result, path):
+    for key in path.split('.'):
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+def compare(baseline_path, current_path, tolerance=0.05):
+    """打印关键指标变化；超出 tolerance 的退化标记出来，有退化时返回 1"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+
+    regressions = 0
+    print(f"{'指标':<32} {'基线':>12} {'当前':>12} {'变化':>9}")
+    for path, higher_is_better in COMPARE_METRICS:
+        old, new = lookup(baseline, path), lookup(current, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = "  ✗ 退化" if worse > tolerance else ""
+        regressions += bool(flag)
+        print(f"{path:<32} {old:>12.2f} {new:>12.2f} {change:>+8.1%}{flag}")
+    return 1 if regressions else 0
+
+
+def print_summary(result):
+    ingest, query = result['ingest'], result['query']
+    print("\n" + "=" * 70)
+    print(f"启动: 导入 {result['startup']['import_seconds'] * 1000:.0f}ms, " + ", ".join(
+        f"{name} {seconds:.2f}s" for name, seconds in result['startup']['components'].items()))
+    print(f"入库: {ingest['chunks']} 块, {ingest['seconds']:.2f} 秒, {ingest['chunks_per_sec']:.1f} 块/秒")
+    for name, stage in ingest['stages'].items():
+        print(f"  {name:<8} {stage['items']:>6} 项  忙碌 {stage['busy_seconds']:.2f} 秒  {stage['rate']:.1f} 项/秒")
+    latency = query['latency_ms']
+    print(f"查询: {query['questions']} 个问题, 并发 {query['concurrency']}, {query['qps']:.1f} QPS")
+    print(f"  延迟 p50 {latency['p50']:.0f}ms  p95 {latency['p95']:.0f}ms  p99 {latency['p99']:.0f}ms")
+    if query['ttft_ms']:
+        print(f"  首 token p50 {query['ttft_ms']['p50']:.0f}ms  p95 {query['ttft_ms']['p95']:.0f}ms")
+    for name, stage in query['stages_ms'].items():
+        print(f"  {name:<8} p50 {stage['p50']:.1f}ms  p95 {stage['p95']:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG 端到端性能基准")
+    parser.add_argument('--docs', type=int, default=10)
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--images-per-page', type=int, default=1)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--stream', action='store_true', help="用 stream_answer 并测量首 token 时间")
+    parser.add_argument('--store', default='numpy', choices=['numpy', 'hnsw'])
+    parser.add_argument('--search-mode', default='hybrid', choices=['knn', 'hybrid'])
+    parser.add_argument('--reranker', default='none', choices=['none', 'local', 'http'])
+    parser.add_argument('--embedding', default='local', choices=['local', 'http'],
+                        help="http: 经桩服务的 /v1/embeddings 编码")
+    parser.add_argument('--expand', action='store_true')
+    parser.add_argument('--first-token-ms', type=float, default=200)
+    parser.add_argument('--token-ms', type=float, default=10)
+    parser.add_argument('--answer-tokens', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="结果 JSON 文件")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'))
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(*args.compare))
+
+    result = run(args)
+    print_summary(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"\n✓ 结果已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+文本分块
+按嵌入模型自己的 tokenizer 计数（块不会超过模型的 max_seq_length 而被截断），
+尊重 PyMuPDF 文本块（段落）与句子边界，支持块间重叠；
+分块策略由 DocumentConfig.chunk_strategy 选择
+用法: python chunker.py 文件.pdf   # 基准测试：块/秒
+"""
+import json
+import os
+import re
+import sys
+import time
+from config import DocumentConfig
+from onnx_embedding import cache_dir
+
+WORDS_PER_CHUNK = 100    # words 策略：每个文本块的单词数
+
+# 句末标点之后断句；英文句号等后面需要跟空白，避免切开小数和缩写
+SENTENCE_END = re.compile(r'(?<=[。！？；!?])|(?<=[.;])\s+')
+FALLBACK_TOKEN = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]|\w+|[^\w\s]')
+
+
+def model_directory(model_name):
+    """嵌入模型 tokenizer.json 所在目录：本地模型目录、ONNX 导出缓存或 HF 缓存（只查本地，不联网）"""
+    for directory in (model_name, cache_dir(model_name)):
+        if os.path.exists(os.path.join(directory, 'tokenizer.json')):
+            return directory
+    try:
+        from huggingface_hub import try_to_load_from_cache
+        repo = model_name if '/' in model_name else f'sentence-transformers/{model_name}'
+        cached = try_to_load_from_cache(repo, 'tokenizer.json')
+    except (ImportError, ValueError):
+        return None
+    return os.path.dirname(cached) if isinstance(cached, str) else None
+
+
+def max_seq_length(directory):
+    """模型输入上限（SentenceTransformer 配置、ONNX 导出的 meta.json 或 tokenizer 配置），未知时返回 None"""
+    for name, key in (('sentence_bert_config.json', 'max_seq_length'), ('meta.json', 'max_seq_length'),
+                      ('tokenizer_config.json', 'model_max_length')):
+        try:
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                limit = json.load(f)[key]
+        except (OSError, KeyError, ValueError):
+            continue
+        # 未设置上限的 tokenizer 用一个极大的数占位
+        if isinstance(limit, int) and limit < 100000:
+            return limit
+    return None
+
+
+class Tokenizer:
+    """token 计数：model_name 给出时用该嵌入模型的 tokenizer（与模型实际看到的 token 一致），
+    找不到时用 tiktoken；编码文件不可用（如离线环境）时退回正则近似"""
+
+    def __init__(self, encoding_name=None, model_name=None):
+        self.encoding_name = encoding_name or DocumentConfig.chunk_encoding
+        self.model = self.encoding = None
+        self.max_tokens = None    # 模型输入上限扣除 [CLS]/[SEP] 等特殊 token，未知时为 None
+        directory = model_directory(model_name) if model_name else None
+        if directory:
+            try:
+                from tokenizers import Tokenizer as ModelTokenizer
+                self.model = ModelTokenizer.from_file(os.path.join(directory, 'tokenizer.json'))
+                self.model.no_truncation()
+                self.model.no_padding()
+                self.name = model_name
+                limit = max_seq_length(directory)
+                if limit:
+                    self.max_tokens = limit - len(self.model.encode('').ids)
+                return
+            except Exception:
+                self.model = None
+        try:
+            import tiktoken
+            self.encoding = tiktoken.get_encoding(self.encoding_name)
+            self.name = self.encoding_name
+        except Exception:
+            self.encoding = None
+            self.name = 'regex'
+
+    def count(self, text):
+        if self.model is not None:
+            return len(self.model.encode(text, add_special_tokens=False).ids)
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return len(FALLBACK_TOKEN.findall(text))
+
+    def split(self, text, max_tokens):
+        """把超长文本硬切成每段不超过 max_tokens 的片段"""
+        if self.encoding is not None:
+            tokens = self.encoding.encode(text, disallowed_special=())
+            return [
+                self.encoding.decode(tokens[i:i + max_tokens])
+                for i in range(0, len(tokens), max_tokens)
+            ]
+        if self.model is not None:
+            # 按字符偏移切原文：WordPiece 解码会丢失大小写与空白
+            starts = [start for start, _ in self.model.encode(text, add_special_tokens=False).offsets]
+        else:
+            starts = [match.start() for match in FALLBACK_TOKEN.finditer(text)]
+        cuts = starts[max_tokens::max_tokens]
+        return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+_tokenizer = None
+
+
+def get_tokenizer():
+    """进程内共享的分块 Tokenizer（抽取 worker 中各自加载一次）"""
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = Tokenizer(model_name=DocumentConfig.chunk_tokenizer)
+    return _tokenizer
+
+
+def chunk_budget(tokenizer, chunk_size=None):
+    """块的 token 上限：配置值，且不超过嵌入模型的输入上限"""
+    chunk_size = chunk_size or DocumentConfig.chunk_size
+    return min(chunk_size, tokenizer.max_tokens) if tokenizer.max_tokens else chunk_size
+
+
+def page_paragraphs(page):
+    """PyMuPDF 页面 -> 段落列表（按阅读顺序的文本块，合并块内换行）"""
+    paragraphs = []
+    for block in page.get_text('blocks', sort=True):
+        if block[6] != 0:
+            continue
+        text = re.sub(r'-\n(?=\w)', '', block[4])
+        text = re.sub(r'\s*\n\s*', ' ', text).strip()
+        if text:
+            paragraphs.append(text)
+    return paragraphs
+
+
+def split_sentences(paragraph):
+    return [s.strip() for s in SENTENCE_END.split(paragraph) if s and s.strip()]
+
+
+class WordChunker:
+    """按单词数切分（原始策略）"""
+
+    name = 'words'
+
+    def signature(self):
+        return f"{self.name}:{WORDS_PER_CHUNK}"
+
+    def chunk(self, paragraphs):
+        words = ' '.join(paragraphs).split()
+        chunks = []
+        for i in range(0, len(words), WORDS_PER_CHUNK):
+            chunk = ' '.join(words[i:i + WORDS_PER_CHUNK])
+            if chunk.strip():
+                chunks.append(chunk)
+        return chunks
+
+
+class LayoutChunker:
+    """按 token 预算合并句子：优先在段落边界断开，相邻块重叠 chunk_overlap 个 token"""
+
+    name = 'layout'
+
+    def __init__(self, chunk_size=None, chunk_overlap=None, tokenizer=None):
+        self.tokenizer = tokenizer or get_tokenizer()
+        self.chunk_size = chunk_budget(self.tokenizer, chunk_size)
+        self.chunk_overlap = DocumentConfig.chunk_overlap if chunk_overlap is None else chunk_overlap
+
+    def signature(self):
+        return f"{self.name}:{self.chunk_size}/{self.chunk_overlap}:{self.tokenizer.name}"
+
+    def _units(self, paragraphs):
+        """产出 (句子, token 数, 是否段落开头)，超长句子先硬切"""
+        for paragraph in paragraphs:
+            first = True
+            for sentence in split_sentences(paragraph):
+                tokens = self.tokenizer.count(sentence)
+                if tokens <= self.chunk_size:
+                    yield sentence, tokens, first
+                else:
+                    for piece in self.tokenizer.split(sentence, self.chunk_size):
+                        yield piece, self.tokenizer.count(piece), first
+                        first = False
+                first = False
+
+    def chunk(self, paragraphs):
+        chunks = []
+        current = []    # [(句子, token 数, 是否段落开头)]
+        size = 0
+        for unit in self._units(paragraphs):
+            _, tokens, para_start = unit
+            # 当前块已过半且新段落开始时提前断开，保持段落完整
+            full = size + tokens > self.chunk_size
+            early = para_start and size >= self.chunk_size // 2 and current
+            if current and (full or early):
+                chunks.append(self._join(current))
+                current = self._overlap(current, self.chunk_size - tokens)
+                size = sum(t for _, t, _ in current)
+            current.append(unit)
+            size += tokens
+        if current:
+            chunks.append(self._join(current))
+        return chunks
+
+    def _overlap(self, units, room):
+        """上一块末尾不超过 chunk_overlap（且放得下下一句）的整句"""
+        budget = min(self.chunk_overlap, room)
+        tail = []
+        for unit in reversed(units):
+            budget -= unit[1]
+            if budget < 0:
+                break
+            tail.insert(0, unit)
+        # 重叠部分整块都被带过去时不重叠，避免重复产出同一内容
+        return tail if len(tail) < len(units) else []
+
+    @staticmethod
+    def _join(units):
+        text = ''
+        for sentence, _, para_start in units:
+            if text:
+                text += '\n' if para_start else ' '
+            text += sentence
+        return text
+
+
+def make_chunker(strategy=None):
+    """按 DocumentConfig.chunk_strategy 创建分块器：layout | words"""
+    strategy = strategy or DocumentConfig.chunk_strategy
+    if strategy == 'layout':
+        return LayoutChunker()
+    if strategy == 'words':
+        return WordChunker()
+    raise ValueError(f"未知的分块策略: {strategy}")
+
+
+def benchmark(pdf_path, strategies=('words', 'layout')):
+    """各策略在同一文档上的块数、平均 token 数与吞吐"""
+    import fitz  # PyMuPDF
+    with fitz.open(pdf_path) as doc:
+        pages = [page_paragraphs(page) for page in doc]
+    tokenizer = get_tokenizer()
+    for strategy in strategies:
+        chunker = make_chunker(strategy)
+        started = time.perf_counter()
+        chunks = [chunk for paragraphs in pages for chunk in chunker.chunk(paragraphs)]
+        elapsed = time.perf_counter() - started
+        tokens = sum(tokenizer.count(chunk) for chunk in chunks)
+        print(f"{chunker.signature():<32} {len(chunks):>6} 块, "
+              f"平均 {tokens / max(len(chunks), 1):.0f} tokens, "
+              f"{len(chunks) / elapsed if elapsed else 0:.0f} 块/秒 ({len(pages) / elapsed if elapsed else 0:.0f} 页/秒)")
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1])
@@ -0,0 +1,159 @@
+"""
+组件注册表
+嵌入模型、Elasticsearch / OpenAI 客户端等重量级组件在首次使用时才导入和创建，
+只建索引或查看帮助的命令不再为加载模型付出数秒启动时间。
+服务端启动时可调用 warm_up() 预热；多进程部署可在 fork 前调用 preload()，
+子进程直接共享已加载的模型（写时复制）
+"""
+import gc
+import logging
+import threading
+import time
+from config import (
+    EMBEDDING_DIMS, ElasticConfig, LOCAL_EMBEDDING_MODEL, LocalEmbeddingConfig, OPENAI_API_KEY,
+    OPENAI_BASE_URL
+)
+
+logger = logging.getLogger('rag.components')
+
+
+class ComponentRegistry:
+    """按名称注册工厂函数，首次 get() 时创建实例（线程安全，只创建一次）"""
+
+    def __init__(self):
+        self._factories = {}
+        self._warmers = {}
+        self._instances = {}
+        self._load_seconds = {}
+        self._lock = threading.RLock()
+
+    def register(self, name, factory, warm_up=None):
+        """warm_up(instance) 在 warm_up() 时调用，用于触发首次推理等一次性开销"""
+        self._factories[name] = factory
+        if warm_up is not None:
+            self._warmers[name] = warm_up
+
+    def get(self, name):
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        with self._lock:
+            if name not in self._instances:
+                started = time.perf_counter()
+                self._instances[name] = self._factories[name]()
+                self._load_seconds[name] = time.perf_counter() - started
+                logger.info("loaded %s in %.2fs", name, self._load_seconds[name])
+            return self._instances[name]
+
+    def set(self, name, instance):
+        """注入已有实例（测试替身、外部创建的客户端）"""
+        with self._lock:
+            self._instances[name] = instance
+
+    def is_loaded(self, name):
+        return name in self._instances
+
+    def warm_up(self, names=None):
+        """立即创建 names（默认全部）并执行各自的预热函数"""
+        for name in names or list(self._factories):
+            instance = self.get(name)
+            warmer = self._warmers.get(name)
+            if warmer is not None:
+                started = time.perf_counter()
+                warmer(instance)
+                logger.info("warmed up %s in %.2fs", name, time.perf_counter() - started)
+
+    def preload(self, names=None):
+        """fork 前调用：预热后把模型参数放进共享内存，并冻结 GC 追踪的对象，
+        避免子进程中的引用计数/GC 扫描触发写时复制"""
+        self.warm_up(names)
+        model = self._instances.get('embedding_model')
+        if model is not None and hasattr(model, 'share_memory'):
+            model.share_memory()
+        gc.collect()
+        gc.freeze()
+
+    def stats(self):
+        """已加载组件及其创建耗时（秒）"""
+        return dict(self._load_seconds)
+
+
+def _embedding_model():
+    """PyTorch SentenceTransformer 或导出的 ONNX Runtime 模型（encode 接口相同）"""
+    if LocalEmbeddingConfig.backend == 'onnx':
+        from onnx_embedding import load_onnx_model
+        model = load_onnx_model(LOCAL_EMBEDDING_MODEL)
+    elif LocalEmbeddingConfig.backend == 'torch':
+        from sentence_transformers import SentenceTransformer
+        if LocalEmbeddingConfig.threads:
+            import torch
+            torch.set_num_threads(LocalEmbeddingConfig.threads)
+        model = SentenceTransformer(LOCAL_EMBEDDING_MODEL)
+    else:
+        raise ValueError(f"未知的本地推理后端: {LocalEmbeddingConfig.backend}")
+    # 索引 mapping 与本地存储都按 EMBEDDING_DIMS 创建，模型输出维度必须一致
+    dims = model.get_sentence_embedding_dimension()
+    if dims != EMBEDDING_DIMS:
+        raise ValueError(f"{LOCAL_EMBEDDING_MODEL} 输出 {dims} 维向量，与 EMBEDDING_DIMS={EMBEDDING_DIMS} 不一致")
+    return model
+
+
+def _embedder():
+    from embedding_provider import make_embedding_provider
+    # 本地模型（http 后端的回退模型）仍经注册表按需加载
+    return make_embedding_provider(get_model)
+
+
+def _embedding_cache():
+    from embedding_cache import EmbeddingCache
+    # 按实际编码所用的模型分命名空间
+    return EmbeddingCache(get_embedder().name)
+
+
+def _llm():
+    from openai import OpenAI
+    return OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+
+
+def _elasticsearch():
+    from elasticsearch import Elasticsearch
+    return Elasticsearch([ElasticConfig.url], verify_certs=False)
+
+
+def _context_builder():
+    from context_builder import ContextBuilder
+    return ContextBuilder()
+
+
+registry = ComponentRegistry()
+registry.register('embedding_model', _embedding_model, warm_up=lambda model: model.encode(["warm up"]))
+registry.register('embedder', _embedder, warm_up=lambda embedder: embedder.encode(["warm up"]))
+registry.register('embedding_cache', _embedding_cache)
+registry.register('llm', _llm)
+registry.register('elasticsearch', _elasticsearch)
+registry.register('context_builder', _context_builder,
+                  warm_up=lambda builder: builder.tokenizer.count("warm up"))
+
+
+def get_model():
+    return registry.get('embedding_model')
+
+
+def get_embedder():
+    return registry.get('embedder')
+
+
+def get_embedding_cache():
+    return registry.get('embedding_cache')
+
+
+def get_llm():
+    return registry.get('llm')
+
+
+def get_es():
+    return registry.get('elasticsearch')
+
+
+def get_context_builder():
+    return registry.get('context_builder')
@@ -14,18 +14,73 @@ class ElasticConfig:
     username = os.getenv('ELASTICSEARCH_USERNAME', 'elastic')
     password = os.getenv('ELASTICSEARCH_PASSWORD', '')
     
-    number_of_shards = 1
-    number_of_replicas = 0
-    vector_dims = 1024
+    number_of_shards = int(os.getenv('ES_SHARDS', '1'))
+    number_of_replicas = int(os.getenv('ES_REPLICAS', '0'))
     similarity = "cosine"
+    refresh_interval = os.getenv('ES_REFRESH_INTERVAL', '1s')
+    # Applied while bulk loading (together with 0 replicas) and restored afterwards
+    bulk_refresh_interval = '-1'
+
+# Vector Store Configuration
+class VectorStoreConfig:
+    """Vector store backend: elasticsearch, numpy (exact) or hnsw (approximate)"""
+    backend = os.getenv('VECTOR_STORE', 'elasticsearch')
+    directory = os.getenv('VECTOR_STORE_DIR', '.rag_cache/vector_store')
+    # HNSW graph parameters, shared by the local hnsw store and Elasticsearch mappings
+    hnsw_m = 16
+    hnsw_ef_construction = 100
+    hnsw_ef_search = 64
+    hnsw_max_ef = 512               # upper bound on ef when widening it to skip deleted nodes
+    compact_deleted_ratio = 0.2     # flush() rebuilds a local store once this share of rows is deleted
+    reload_check_interval = 5       # seconds between checks for a re-ingest by another process
+    # none | int8 (4x smaller) | binary (32x smaller); candidates are rescored with float vectors.
+    # Elasticsearch maps these to int8_hnsw / bbq_hnsw (rescore_vector needs 8.18+)
+    quantization = os.getenv('VECTOR_QUANTIZATION', 'none')
+    rescore_oversample = {'int8': 4, 'binary': 16}   # candidates fetched per result
 
 # Embedding Service Configuration
 EMBEDDING_URL = os.getenv('EMBEDDING_URL', 'http://localhost:8000/v1/embeddings')
 EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'bge-large-zh-v1.5')
+LOCAL_EMBEDDING_MODEL = os.getenv('LOCAL_EMBEDDING_MODEL', 'paraphrase-MiniLM-L6-v2')
+# Output dimension of LOCAL_EMBEDDING_MODEL; indices and local stores are checked against it
+EMBEDDING_DIMS = int(os.getenv('EMBEDDING_DIMS', '384'))
+
+class LocalEmbeddingConfig:
+    """CPU inference of LOCAL_EMBEDDING_MODEL: PyTorch or an exported ONNX Runtime model"""
+    backend = os.getenv('LOCAL_EMBEDDING_BACKEND', 'torch')   # torch | onnx
+    quantize = os.getenv('ONNX_QUANTIZE', 'false').lower() == 'true'   # dynamic int8 weights
+    threads = int(os.getenv('EMBEDDING_THREADS', '0'))   # intra-op threads, 0 = runtime default
+    onnx_dir = os.getenv('ONNX_CACHE_DIR', '.rag_cache/onnx')
+    # Minimum cosine similarity to the PyTorch output; an export below it is rejected
+    parity_min_cosine = {'fp32': 0.9999, 'int8': 0.98}
+
+class EmbeddingServiceConfig:
+    """Embedding backend: local (in-process SentenceTransformer) or http (EMBEDDING_URL)"""
+    backend = os.getenv('EMBEDDING_BACKEND', 'local')
+    timeout = 10
+    max_retries = 2
+    pool_size = 8            # keep-alive connections / concurrent requests
+    max_batch = 64           # texts per request; concurrent calls are merged up to this size
+    max_wait_ms = 5          # extra wait for more calls to join while traffic is concurrent
+    # In-process model: concurrent small encodes (queries) share one batched forward pass
+    local_batching = os.getenv('LOCAL_EMBED_BATCHING', 'true').lower() == 'true'
+    local_max_batch = int(os.getenv('LOCAL_EMBED_MAX_BATCH', '32'))
+    local_max_wait_ms = float(os.getenv('LOCAL_EMBED_MAX_WAIT_MS', '2'))
+    # Fall back to LOCAL_EMBEDDING_MODEL when the service fails. Only correct if the
+    # service runs the same model, otherwise the vectors live in different spaces
+    fallback = os.getenv('EMBEDDING_FALLBACK', 'false').lower() == 'true'
+    fallback_cooldown = 30   # seconds to stay on the fallback before retrying the service
+
+# Embedding Cache Configuration
+class EmbeddingCacheConfig:
+    """Content-addressed embedding cache (memory LRU + on-disk memmap)"""
+    cache_dir = os.getenv('EMBEDDING_CACHE_DIR', '.rag_cache/embeddings')
+    memory_items = 50000
 
 # Reranking Service Configuration
 RERANK_URL = os.getenv('RERANK_URL', 'http://localhost:8001/rerank')
 RERANK_MODEL = os.getenv('RERANK_MODEL', 'bge-reranker-v2-m3')
+RERANK_LOCAL_MODEL = os.getenv('RERANK_LOCAL_MODEL', 'BAAI/bge-reranker-v2-m3')
 
 # OpenAI Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
@@ -35,23 +90,68 @@ OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
 # Document Processing Configuration
 class DocumentConfig:
     """Document processing configuration"""
-    chunk_size = 1024
-    chunk_overlap = 100
+    chunk_strategy = os.getenv('CHUNK_STRATEGY', 'layout')  # layout | words
+    # Chunks are measured with the local embedding model's own tokenizer and capped at its
+    # max_seq_length (128 WordPiece tokens for MiniLM, incl. [CLS]/[SEP]) so nothing is truncated;
+    # chunk_encoding (tiktoken) is only used when that tokenizer is not available locally
+    chunk_tokenizer = os.getenv('CHUNK_TOKENIZER', LOCAL_EMBEDDING_MODEL)
+    chunk_encoding = 'cl100k_base'
+    chunk_size = 116
+    chunk_overlap = 16
     batch_size = 25
+    bulk_max_inflight = 4
+    extract_workers = os.cpu_count() or 1
+    pages_per_task = 8
+    manifest_path = os.getenv('INGEST_MANIFEST', '.rag_cache/ingest_manifest.json')
     extract_images = True
     image_caption_model = 'gpt-4o-mini'
+    caption_workers = 8
+    caption_rate_per_sec = 5
+    caption_burst = 10
+    caption_max_retries = 3
+    caption_window_pages = 32
+    caption_cache_path = os.getenv('CAPTION_CACHE', '.rag_cache/captions.jsonl')
     extract_tables = True
+    # auto: PyMuPDF find_tables on pages with ruling lines, pdfplumber only for grids it misses
+    table_engine = os.getenv('TABLE_ENGINE', 'auto')   # auto | fitz | pdfplumber
     table_to_markdown = True
 
 # Retrieval Configuration
 class RetrievalConfig:
     """Retrieval and search configuration"""
+    search_mode = os.getenv('SEARCH_MODE', 'hybrid')  # knn | hybrid
     max_results_per_query = 20
     rrf_k = 60
     num_query_variations = 3
+    query_expansion = os.getenv('QUERY_EXPANSION', 'false').lower() == 'true'
     similarity_threshold = 0.8
     top_k_rerank = 50
     final_top_k = 10
+    reranker = os.getenv('RERANKER', 'none')  # none | local | http
+    rerank_batch_size = 16
+    rerank_budget_ms = 300
+    rerank_cache_size = 10000
+
+# Semantic Answer Cache Configuration
+class AnswerCacheConfig:
+    """Semantic answer cache: reuses the answer of an earlier, near-identical question"""
+    # Opt-in: a hit returns another question's answer, which changes what users see
+    enabled = os.getenv('ANSWER_CACHE', 'false').lower() == 'true'
+    # Stricter than retrieval similarity: only paraphrases of the same question may share an answer
+    similarity_threshold = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95'))
+    ttl_seconds = 3600
+    max_entries = 1000
+    version_check_interval = 5
+
+# Async Serving Configuration
+class ServingConfig:
+    """Concurrency limits and connection pools for the async query engine"""
+    max_concurrency = int(os.getenv('RAG_MAX_CONCURRENCY', 32))
+    es_connections_per_node = 32
+    llm_max_connections = 64
+    llm_max_keepalive = 32
+    request_timeout = 60
+    preload = os.getenv('RAG_PRELOAD', 'false').lower() == 'true'  # load models before forking workers
 
 # Response Generation Configuration
 class GenerationConfig:
@@ -59,6 +159,10 @@ class GenerationConfig:
     temperature = 0.7
     max_tokens = 2000
     top_p = 0.9
+    prompt_encoding = 'o200k_base'  # tokenizer of gpt-4o / gpt-4o-mini
+    context_token_budget = 3000
+    context_dedup_threshold = 0.85
+    context_min_chunk_tokens = 32
     system_prompt = """You are a helpful AI assistant that answers questions based on provided documents.
 Always cite your sources by referring to the document chunks you used.
 If you cannot find relevant information in the provided context, say so clearly.
@@ -67,3 +171,13 @@ Provide detailed, accurate, and well-structured responses."""
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 LOG_FILE = os.getenv('LOG_FILE', 'rag_system.log')
 
+# Metrics / Tracing Configuration
+class MetricsConfig:
+    """Spans, histograms and counters (near-zero overhead when disabled)"""
+    enabled = os.getenv('RAG_METRICS', 'false').lower() == 'true'
+    port = int(os.getenv('RAG_METRICS_PORT', 0))  # 0 = no HTTP endpoint
+    host = os.getenv('RAG_METRICS_HOST', '127.0.0.1')  # 0.0.0.0 exposes it to the network
+    dump_path = os.getenv('RAG_METRICS_DUMP', '')  # JSON dump written on exit
+    trace_buffer = 2000
+    slow_trace_ms = 3000
+
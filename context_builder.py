@@ -0,0 +1,189 @@
+"""
+按 token 预算装配生成答案的上下文
+按检索排名依次放入 chunk：同页相邻（页内序号相邻或内容重叠）的 chunk 按页内顺序合并并去掉重叠部分，
+近似重复的 chunk 丢弃，
+超出预算时截断或跳过，并统计提示词 token 数
+"""
+from chunker import FALLBACK_TOKEN, Tokenizer
+from config import GenerationConfig
+
+SYSTEM_PROMPT = "你是一个helpful的AI助手。请基于提供的文档回答问题，并标注引用来源。如果文档中没有相关信息，请明确说明。"
+MESSAGE_OVERHEAD = 4     # 每条消息的角色/分隔符 token
+MIN_OVERLAP_CHARS = 5    # 更短的首尾重合视为巧合，不去重
+
+_tokenizer = None
+
+
+def get_tokenizer():
+    """与生成模型一致的 tokenizer（进程内共享）"""
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = Tokenizer(GenerationConfig.prompt_encoding)
+    return _tokenizer
+
+
+def shingles(text, n=3):
+    """词（中日韩按字）n-gram 集合，用于近似重复判断"""
+    tokens = FALLBACK_TOKEN.findall(text.lower())
+    if len(tokens) <= n:
+        return {tuple(tokens)}
+    return {tuple(tokens[i:i + n]) for i in range(len(tokens) - n + 1)}
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+def merge_overlapping(first, second):
+    """first 在前、second 在后拼接，去掉分块重叠的部分；两者没有重叠时返回 None"""
+    if second in first:
+        return first
+    if first in second:
+        return second
+    # 从最长的可能重叠开始找：first 的某个后缀恰好是 second 的前缀
+    start = first.find(second[0], max(0, len(first) - len(second)))
+    while 0 <= start <= len(first) - MIN_OVERLAP_CHARS:
+        if second.startswith(first[start:]):
+            return first[:start] + second
+        start = first.find(second[0], start + 1)
+    return None
+
+
+def join_chunks(first, second):
+    """拼接页内顺序相邻的两个 chunk"""
+    return merge_overlapping(first, second) or first + "\n" + second
+
+
+def merge_into(group, text, index):
+    """group 与 chunk 相邻时返回按页内顺序合并后的文本，否则返回 None
+
+    有页内序号时只合并序号相邻的 chunk；没有序号（旧索引）时只合并内容首尾重叠的 chunk
+    """
+    if index is not None and group['first'] is not None:
+        if index == group['first'] - 1:
+            return join_chunks(text, group['text'])
+        if index == group['last'] + 1:
+            return join_chunks(group['text'], text)
+        return None
+    return merge_overlapping(group['text'], text) or merge_overlapping(text, group['text'])
+
+
+class ContextBuilder:
+    """把排序后的检索结果装入 token 预算"""
+
+    def __init__(self, budget=None, dedup_threshold=None, min_chunk_tokens=None, tokenizer=None):
+        self.budget = budget or GenerationConfig.context_token_budget
+        self.dedup_threshold = dedup_threshold or GenerationConfig.context_dedup_threshold
+        self.min_chunk_tokens = min_chunk_tokens or GenerationConfig.context_min_chunk_tokens
+        self.tokenizer = tokenizer or get_tokenizer()
+
+    def pack(self, docs):
+        """返回 (分组列表, 统计)；分组为 {'source', 'page', 'type', 'text', 'text_tokens', ...}"""
+        groups = []
+        by_page = {}     # {(来源, 页, 类型): [分组]}
+        seen = []
+        used = 0
+        stats = {'chunks': len(docs), 'merged': 0, 'duplicates': 0, 'truncated': 0, 'skipped': 0}
+
+        for doc in docs:
+            text = doc['text'].strip()
+            if not text:
+                continue
+            fingerprint = shingles(text)
+            if any(jaccard(fingerprint, other) >= self.dedup_threshold for other in seen):
+                stats['duplicates'] += 1
+                continue
+
+            key = (doc['source'], doc['page'], doc['type'])
+            index = doc.get('chunk_index')
+            group, merged = next((
+                (group, merged) for group in by_page.get(key, ())
+                for merged in [merge_into(group, text, index)] if merged is not None
+            ), (None, None))
+            if group is not None:
+                merged_tokens = self.tokenizer.count(merged)
+                extra = merged_tokens - group['text_tokens']
+                if used + extra > self.budget:
+                    stats['skipped'] += 1
+                    continue
+                group['text'] = merged
+                group['text_tokens'] = merged_tokens
+                used += extra
+                if index is not None and group['first'] is not None:
+                    group['first'] = min(group['first'], index)
+                    group['last'] = max(group['last'], index)
+                    used -= self._bridge(group, by_page[key], groups)
+                stats['merged'] += 1
+                seen.append(fingerprint)
+                continue
+
+            header = f"[文档{len(groups) + 1}] (来源: {doc['source']}, 第{doc['page']}页, 类型: {doc['type']})\n"
+            cost = self.tokenizer.count(header)
+            tokens = self.tokenizer.count(text)
+            remaining = self.budget - used - cost
+            if tokens > remaining:
+                # 放不下整块时，剩余空间足够才截断放入，否则留给后面更短的 chunk
+                if remaining < self.min_chunk_tokens:
+                    stats['skipped'] += 1
+                    continue
+                text = self.tokenizer.split(text, remaining)[0]
+                tokens = self.tokenizer.count(text)
+                stats['truncated'] += 1
+                # 截断后与下一块之间有缺口，不再按序号拼接，只在内容重叠时合并
+                index = None
+
+            # first / last: 分组覆盖的页内序号范围
+            group = {'source': doc['source'], 'page': doc['page'], 'type': doc['type'],
+                     'text': text, 'text_tokens': tokens, 'first': index, 'last': index,
+                     'header_tokens': cost}
+            groups.append(group)
+            by_page.setdefault(key, []).append(group)
+            seen.append(fingerprint)
+            used += tokens + cost
+
+        stats['context_tokens'] = used
+        return groups, stats
+
+    def _bridge(self, group, siblings, groups):
+        """新 chunk 填上了两个同页分组之间的空缺时把它们连成一组，返回节省的 token 数"""
+        for other in siblings:
+            if other is group or other['first'] is None:
+                continue
+            if other['first'] == group['last'] + 1:
+                text = join_chunks(group['text'], other['text'])
+            elif other['last'] == group['first'] - 1:
+                text = join_chunks(other['text'], group['text'])
+            else:
+                continue
+            tokens = self.tokenizer.count(text)
+            saved = group['text_tokens'] + other['text_tokens'] + other['header_tokens'] - tokens
+            group.update(text=text, text_tokens=tokens,
+                         first=min(group['first'], other['first']), last=max(group['last'], other['last']))
+            siblings.remove(other)
+            groups.remove(other)
+            return saved
+        return 0
+
+    def build_messages(self, query, docs, report=None):
+        """由检索结果构建对话消息；report 给出时写入装配统计与提示词 token 数"""
+        groups, stats = self.pack(docs)
+        context = "\n\n".join(
+            f"[文档{i+1}] (来源: {g['source']}, 第{g['page']}页, 类型: {g['type']})\n{g['text']}"
+            for i, g in enumerate(groups)
+        )
+        messages = [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": f"问题: {query}\n\n参考文档:\n{context}\n\n请回答:"
+            }
+        ]
+        if report is not None:
+            report.update(stats)
+            report['prompt_tokens'] = sum(
+                self.tokenizer.count(m['content']) + MESSAGE_OVERHEAD for m in messages
+            )
+        return messages
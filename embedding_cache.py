@@ -0,0 +1,189 @@
+"""
+内容寻址的向量缓存
+键为 sha256(模型名 + 文本)，内存 LRU 一级 + 磁盘 memmap 二级
+多个进程可同时追加同一个缓存目录：写入时持有文件锁，keys.txt 每行记录键及其向量在文件中的实际行号
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from config import EmbeddingCacheConfig
+
+try:
+    import fcntl
+except ImportError:  # Windows：没有 flock，只支持单进程写入
+    fcntl = None
+
+
+class EmbeddingCache:
+    """两级向量缓存，统计命中/未命中"""
+
+    def __init__(self, model_name, cache_dir=None, max_items=None):
+        self.model_name = model_name
+        self.max_items = max_items or EmbeddingCacheConfig.memory_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        cache_dir = cache_dir or EmbeddingCacheConfig.cache_dir
+        safe_name = model_name.replace('/', '__')
+        self.directory = os.path.join(cache_dir, safe_name) if cache_dir else None
+        self.dim = None
+        self.rows = {}
+        self._mmap = None
+        self._load()
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    # ---- 磁盘层 ----
+
+    def _paths(self):
+        return (
+            os.path.join(self.directory, 'meta.json'),
+            os.path.join(self.directory, 'keys.txt'),
+            os.path.join(self.directory, 'vectors.f32')
+        )
+
+    def _load(self):
+        if not self.directory:
+            return
+        meta_path, keys_path, vectors_path = self._paths()
+        if not os.path.exists(meta_path):
+            return
+        with open(meta_path) as f:
+            self.dim = json.load(f)['dim']
+        # 向量先于键写入，进程中途退出时多出的向量没有键引用，不影响读取
+        complete_rows = self._file_rows()
+        self.rows = {}
+        with open(keys_path) as f:
+            for line_no, line in enumerate(f):
+                parts = line.split()
+                if not parts:
+                    continue
+                # 旧格式每行只有键，行号即向量行
+                row = int(parts[1]) if len(parts) > 1 else line_no
+                if row < complete_rows:
+                    # 同一个键被多个进程写入过时保留第一次的向量
+                    self.rows.setdefault(parts[0], row)
+
+    def _file_rows(self):
+        _, _, vectors_path = self._paths()
+        return os.path.getsize(vectors_path) // (4 * self.dim)
+
+    def _disk_get(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            return None
+        if self._mmap is None or row >= self._mmap.shape[0]:
+            _, _, vectors_path = self._paths()
+            # 按文件中实际的行数映射（其他进程写入的行不在 self.rows 中，但占用文件行）
+            self._mmap = np.memmap(vectors_path, dtype=np.float32, mode='r',
+                                   shape=(self._file_rows(), self.dim))
+        return np.array(self._mmap[row])
+
+    def _disk_put(self, keys, vectors):
+        meta_path, keys_path, vectors_path = self._paths()
+        if self.dim is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.dim = vectors.shape[1]
+            with open(meta_path, 'w') as f:
+                json.dump({'model': self.model_name, 'dim': self.dim}, f)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"向量维度 {vectors.shape[1]} 与缓存维度 {self.dim} 不一致")
+
+        with open(vectors_path, 'ab') as vf, open(keys_path, 'a') as kf:
+            if fcntl is not None:
+                fcntl.flock(vf, fcntl.LOCK_EX)
+            try:
+                # 起始行取自文件实际大小：其他进程可能已追加过
+                first_row = os.fstat(vf.fileno()).st_size // (4 * self.dim)
+                vf.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+                vf.flush()
+                kf.write(''.join(f"{key} {first_row + i}\n" for i, key in enumerate(keys)))
+                kf.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(vf, fcntl.LOCK_UN)
+        for i, key in enumerate(keys):
+            self.rows[key] = first_row + i
+
+    # ---- 内存层 ----
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def get(self, text):
+        key = self.key(text)
+        with self.lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+            if self.directory:
+                vector = self._disk_get(key)
+                if vector is not None:
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    return vector
+            self.misses += 1
+            return None
+
+    def encode(self, texts, encode_fn, cacheable=None):
+        """返回 texts 的向量矩阵，只对未命中的文本调用一次 encode_fn
+
+        cacheable() 在编码后调用，返回 False 时本次结果不写入缓存（如向量来自别的模型）
+        """
+        vectors = [self.get(text) for text in texts]
+
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(texts[i], []).append(i)
+
+        if missing:
+            miss_texts = list(missing)
+            encoded = np.asarray(encode_fn(miss_texts), dtype=np.float32)
+            if cacheable is None or cacheable():
+                self._store(miss_texts, encoded)
+            for text, vector in zip(miss_texts, encoded):
+                for i in missing[text]:
+                    vectors[i] = vector
+
+        if not vectors:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.stack(vectors)
+
+    def _store(self, texts, encoded):
+        keys = [self.key(text) for text in texts]
+        with self.lock:
+            for key, vector in zip(keys, encoded):
+                self._remember(key, vector)
+            if self.directory:
+                new = [i for i, key in enumerate(keys) if key not in self.rows]
+                if new:
+                    self._disk_put([keys[i] for i in new], encoded[new])
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_items': len(self.memory),
+            'disk_items': len(self.rows)
+        }
+
+    def __str__(self):
+        s = self.stats()
+        return (f"向量缓存 命中率 {s['hit_rate']:.1%} "
+                f"(内存 {s['memory_hits']}, 磁盘 {s['disk_hits']}, 未命中 {s['misses']})")
@@ -0,0 +1,172 @@
+"""
+向量编码后端
+- LocalEmbeddingProvider: 进程内 SentenceTransformer
+- HTTPEmbeddingProvider: OpenAI 兼容的 /v1/embeddings 服务；连接池复用 keep-alive 连接，
+  超时重试，服务不可用时可回退到本地模型
+两者都经 MicroBatcher 把并发的小调用（查询编码）合并为一次批量编码/请求；
+多个查询进程可共用一台 GPU 向量服务，而不必各自把模型加载进内存
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from batching import MicroBatcher
+from config import (
+    EMBEDDING_DIMS, EMBEDDING_MODEL, EMBEDDING_URL, EmbeddingServiceConfig, LOCAL_EMBEDDING_MODEL,
+    LocalEmbeddingConfig
+)
+from metrics import inc, span
+
+logger = logging.getLogger('rag.embedding')
+
+
+def check_shape(vectors, count, dims, source, model_setting):
+    """向量矩阵必须是 (count, dims)：维度不符时 reshape 会把文档与半截向量错配而不报错"""
+    if vectors.shape != (count, dims):
+        raise ValueError(f"{source}返回 {vectors.shape}，期望 ({count}, {dims})；"
+                         f"请检查 {model_setting} 与 EMBEDDING_DIMS")
+    return vectors
+
+
+class EmbeddingProvider:
+    """编码接口，子类实现 encode_batch；name 作为向量缓存的命名空间
+
+    少于 batcher.max_batch 条的调用经微批合并，入库时的大批量直接编码
+    """
+
+    name = None
+    dims = EMBEDDING_DIMS
+    batcher = None
+    fallbacks = 0    # 改用回退模型编码的次数；回退得到的向量不属于 name 命名空间
+
+    def encode(self, texts, batch_size=32):
+        """返回 (len(texts), dims) 的 float32 矩阵"""
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.dims), dtype=np.float32)
+        if self.batcher is not None and len(texts) < self.batcher.max_batch:
+            return self.batcher(texts)
+        return self.encode_batch(texts, batch_size)
+
+    def encode_batch(self, texts, batch_size=32):
+        raise NotImplementedError
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """进程内模型；load_model 为返回 SentenceTransformer 的无参函数，首次编码时才调用"""
+
+    def __init__(self, load_model, name=LOCAL_EMBEDDING_MODEL, batching=None):
+        self.load_model = load_model
+        self.name = name
+        batching = EmbeddingServiceConfig.local_batching if batching is None else batching
+        if batching:
+            # 单 worker：一次前向计算已占满所有核，并发调用排队时自然凑成下一批
+            self.batcher = MicroBatcher(
+                self.encode_batch, EmbeddingServiceConfig.local_max_batch,
+                EmbeddingServiceConfig.local_max_wait_ms, workers=1, name='local_embed'
+            )
+
+    def encode_batch(self, texts, batch_size=32):
+        vectors = np.asarray(self.load_model().encode(texts, batch_size=batch_size), dtype=np.float32)
+        return check_shape(vectors, len(texts), self.dims, "本地模型", "LOCAL_EMBEDDING_MODEL")
+
+
+class HTTPEmbeddingProvider(EmbeddingProvider):
+    """远程向量服务：小调用合并后发送，最多 pool_size 个请求同时在途；
+    入库时的大批量按 max_batch 分块并发请求
+    """
+
+    def __init__(self, url=EMBEDDING_URL, name=EMBEDDING_MODEL, fallback=None, timeout=None,
+                 max_retries=None, max_batch=None, max_wait_ms=None, pool_size=None):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.url = url
+        self.name = name
+        self.fallback = fallback
+        self.timeout = timeout or EmbeddingServiceConfig.timeout
+        self.max_retries = EmbeddingServiceConfig.max_retries if max_retries is None else max_retries
+        self.max_batch = max_batch or EmbeddingServiceConfig.max_batch
+        pool_size = pool_size or EmbeddingServiceConfig.pool_size
+        self.errors = (requests.RequestException,)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPoolExecutor(max_workers=pool_size)
+        self.batcher = MicroBatcher(
+            self._embed, self.max_batch, max_wait_ms or EmbeddingServiceConfig.max_wait_ms,
+            workers=pool_size, name='http_embed'
+        )
+        self.lock = threading.Lock()
+        self.unavailable_until = 0.0
+        self.requests = 0
+        self.fallbacks = 0
+
+    def encode_batch(self, texts, batch_size=32):
+        futures = [
+            self.pool.submit(self._embed, texts[i:i + self.max_batch])
+            for i in range(0, len(texts), self.max_batch)
+        ]
+        return np.vstack([future.result() for future in futures])
+
+    def _embed(self, texts):
+        """请求服务，失败时指数退避重试；重试用尽后回退到本地模型（若配置）"""
+        if self.fallback is not None and time.monotonic() < self.unavailable_until:
+            return self._fall_back(texts)
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._request(texts)
+            except self.errors as e:
+                if attempt < self.max_retries:
+                    time.sleep(min(2, 0.1 * 2 ** attempt))
+                    continue
+                if self.fallback is None:
+                    raise
+                logger.warning("向量服务不可用，%d 秒内改用本地模型: %s",
+                               EmbeddingServiceConfig.fallback_cooldown, e)
+                self.unavailable_until = time.monotonic() + EmbeddingServiceConfig.fallback_cooldown
+                return self._fall_back(texts)
+
+    def _fall_back(self, texts):
+        with self.lock:
+            self.fallbacks += 1
+        inc('rag_embedding_fallbacks_total')
+        # 回退向量与服务端向量混在同一批结果里，维度必须一致
+        return check_shape(self.fallback.encode(texts), len(texts), self.dims, "回退模型", "LOCAL_EMBEDDING_MODEL")
+
+    def _request(self, texts):
+        with self.lock:
+            self.requests += 1
+        inc('rag_embedding_requests_total')
+        with span('embed_http', texts=len(texts)):
+            response = self.session.post(
+                self.url, json={'model': self.name, 'input': texts}, timeout=self.timeout
+            )
+            response.raise_for_status()
+            data = sorted(response.json()['data'], key=lambda item: item['index'])
+        vectors = np.asarray([item['embedding'] for item in data], dtype=np.float32)
+        # 配置错误，不重试也不回退
+        return check_shape(vectors, len(texts), self.dims, "向量服务", "EMBEDDING_MODEL")
+
+    def __str__(self):
+        return (
+            f"向量服务: 请求 {self.requests} 次, 合并调用 {self.batcher.stats()['calls']} 个, "
+            f"回退本地 {self.fallbacks} 次"
+        )
+
+
+def make_embedding_provider(load_model, backend=None):
+    """按 EmbeddingServiceConfig.backend 创建：local | http（可回退到 load_model 加载的本地模型）"""
+    backend = backend or EmbeddingServiceConfig.backend
+    name = LOCAL_EMBEDDING_MODEL
+    if LocalEmbeddingConfig.backend == 'onnx' and LocalEmbeddingConfig.quantize:
+        # int8 模型的向量与原模型略有差异，向量缓存分开存放
+        name += '-onnx-int8'
+    local = LocalEmbeddingProvider(load_model, name)
+    if backend == 'local':
+        return local
+    if backend == 'http':
+        return HTTPEmbeddingProvider(fallback=local if EmbeddingServiceConfig.fallback else None)
+    raise ValueError(f"未知的向量后端: {backend}")
@@ -0,0 +1,182 @@
+"""
+并发图像描述
+线程池 + 令牌桶限速 + 指数退避重试；同一图像（按内容哈希）只请求一次，
+成功的描述持久化到磁盘缓存，重新入库时无需再次调用视觉模型；失败不缓存，下次入库重试
+"""
+import base64
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from config import DocumentConfig
+from metrics import span
+
+
+def image_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class TokenBucket:
+    """令牌桶：平均每秒 rate 个请求，允许 burst 个突发"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """阻塞直到拿到一个令牌"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class CaptionCache:
+    """图像哈希 -> 描述，追加写入 JSON Lines 文件"""
+
+    def __init__(self, path):
+        self.path = path
+        self.captions = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 进程中途退出时最后一行可能不完整
+                        continue
+                    self.captions[record['hash']] = record['caption']
+
+    def get(self, key):
+        return self.captions.get(key)
+
+    def put(self, key, caption):
+        with self.lock:
+            self.captions[key] = caption
+            if not self.path:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'hash': key, 'caption': caption}, ensure_ascii=False) + '\n')
+
+    def __len__(self):
+        return len(self.captions)
+
+
+class ImageCaptioner:
+    """提交图像后立即返回 Future；相同哈希的图像共享同一个 Future
+
+    client 可以是 OpenAI 客户端，也可以是返回客户端的无参函数（首次请求时才创建）
+    """
+
+    def __init__(self, client, model=None, max_workers=None, rate=None, burst=None,
+                 max_retries=None, cache_path=None):
+        self.client = client
+        self.model = model or DocumentConfig.image_caption_model
+        self.max_retries = DocumentConfig.caption_max_retries if max_retries is None else max_retries
+        self.bucket = TokenBucket(
+            rate or DocumentConfig.caption_rate_per_sec,
+            burst or DocumentConfig.caption_burst
+        )
+        self.cache = CaptionCache(cache_path or DocumentConfig.caption_cache_path)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers or DocumentConfig.caption_workers)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.cache_hits = 0
+        self.deduplicated = 0
+        self.failures = 0
+
+    def submit(self, key, image_bytes):
+        """返回描述的 Future，失败时结果为 None
+
+        image_bytes 可以为 None：表示同一文档中该图像已提交过，只按哈希取结果
+        """
+        with self.lock:
+            future = self.pending.get(key)
+            if future is not None:
+                self.deduplicated += 1
+                return future
+            caption = self.cache.get(key)
+            future = Future()
+            if caption is not None or image_bytes is None:
+                self.cache_hits += caption is not None
+                future.set_result(caption)
+                return future
+            future = self.pool.submit(self._caption, key, image_bytes)
+            self.pending[key] = future
+            return future
+
+    def _caption(self, key, image_bytes):
+        try:
+            for attempt in range(self.max_retries + 1):
+                self.bucket.acquire()
+                try:
+                    caption = self._request(image_bytes)
+                    if not caption or not caption.strip():
+                        # 空描述按失败处理：写入缓存会让该图像永远拿不到描述
+                        raise ValueError("视觉模型返回空描述")
+                except Exception:
+                    if attempt == self.max_retries:
+                        with self.lock:
+                            self.failures += 1
+                        return None
+                    # 指数退避加随机抖动，避免限流后所有 worker 同时重试
+                    time.sleep(min(30, 2 ** attempt) * (0.5 + random.random()))
+                    continue
+                self.cache.put(key, caption)
+                return caption
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def _request(self, image_bytes):
+        """使用 GPT-4 Vision 生成图像描述"""
+        with self.lock:
+            self.requests += 1
+        base64_image = base64.b64encode(image_bytes).decode('utf-8')
+        client = self.client() if callable(self.client) else self.client
+        with span('caption', bytes=len(image_bytes)):
+            response = client.chat.completions.create(
+                model=self.model,
+                messages=[{
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": "简要描述这张图片的内容（1-2句话）。"
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:image/jpeg;base64,{base64_image}"
+                            }
+                        }
+                    ]
+                }],
+                max_tokens=100
+            )
+        return response.choices[0].message.content
+
+    def shutdown(self, wait=True):
+        """停止线程池；wait=False 时丢弃尚未开始的请求"""
+        self.pool.shutdown(wait=wait, cancel_futures=not wait)
+
+    def __str__(self):
+        return (
+            f"图像描述: 请求 {self.requests} 次, 缓存命中 {self.cache_hits}, "
+            f"去重 {self.deduplicated}, 失败 {self.failures}"
+        )
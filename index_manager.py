@@ -1,77 +1,209 @@
 """
 Elasticsearch Index Management
+
+Owns the index lifecycle for every entry point: mappings and settings are built
+from config, existing indices are checked against the embedding dimension, and
+each logical index name is an alias over a versioned physical index so it can be
+rebuilt without downtime.
+
+    python index_manager.py create|delete|stats|check|reindex <index_name>
 """
-from elasticsearch import Elasticsearch
-from config import ElasticConfig
+import contextlib
 import logging
+import time
+import uuid
+from config import EMBEDDING_DIMS, ElasticConfig, VectorStoreConfig
+
+logger = logging.getLogger('rag.index')
+
+# Quantization mode -> dense_vector index_options type
+ES_INDEX_TYPES = {'none': 'hnsw', 'int8': 'int8_hnsw', 'binary': 'bbq_hnsw'}
+
+
+def dense_vector_mapping(dims, quantization=None):
+    """Mapping of the embedding field; quantized indices keep float vectors for rescoring"""
+    quantization = quantization or VectorStoreConfig.quantization
+    if quantization not in ES_INDEX_TYPES:
+        raise ValueError(f"Unknown quantization: {quantization}")
+    return {
+        "type": "dense_vector",
+        "dims": dims,
+        "index": True,
+        "similarity": ElasticConfig.similarity,
+        "index_options": {
+            "type": ES_INDEX_TYPES[quantization],
+            "m": VectorStoreConfig.hnsw_m,
+            "ef_construction": VectorStoreConfig.hnsw_ef_construction
+        }
+    }
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
 
 class IndexManager:
-    def __init__(self):
+    def __init__(self, es=None, dims=None, quantization=None):
         self.config = ElasticConfig()
+        self.dims = dims or EMBEDDING_DIMS
+        self.quantization = quantization or VectorStoreConfig.quantization
+        if es is not None:
+            self.es = es
+            return
+
+        from elasticsearch import Elasticsearch
         self.es = Elasticsearch([self.config.url], verify_certs=False)
-        
         if self.es.ping():
             logger.info("✓ Successfully connected to Elasticsearch")
         else:
             raise ConnectionError("Failed to connect to Elasticsearch")
-    
-    def create_index(self, index_name: str) -> bool:
-        if self.es.indices.exists(index=index_name):
-            logger.warning(f"Index '{index_name}' already exists")
-            return True
-        
-        mapping = {
+
+    def index_body(self) -> dict:
+        return {
             "settings": {
-                "number_of_shards": 1,
-                "number_of_replicas": 0
+                "number_of_shards": self.config.number_of_shards,
+                "number_of_replicas": self.config.number_of_replicas,
+                "refresh_interval": self.config.refresh_interval
             },
             "mappings": {
                 "properties": {
                     "text": {"type": "text"},
-                    "embedding": {
-                        "type": "dense_vector",
-                        "dims": 768,
-                        "index": True,
-                        "similarity": "cosine"
-                    },
+                    "embedding": dense_vector_mapping(self.dims, self.quantization),
                     "source": {"type": "keyword"},
                     "page": {"type": "integer"},
-                    "chunk_id": {"type": "keyword"}
+                    "content_type": {"type": "keyword"},
+                    "chunk_id": {"type": "keyword"},
+                    "chunk_index": {"type": "integer"}
                 }
             }
         }
-        
+
+    def resolve(self, index_name: str) -> list:
+        """Physical indices behind index_name (itself for indices created before aliases)"""
+        if self.es.indices.exists_alias(name=index_name):
+            return sorted(self.es.indices.get_alias(name=index_name))
+        return [index_name] if self.es.indices.exists(index=index_name) else []
+
+    def create_physical(self, index_name: str) -> str:
+        """New versioned physical index for index_name; not searchable until switch_alias"""
+        physical = f"{index_name}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:4]}"
+        self.es.indices.create(index=physical, **self.index_body())
+        return physical
+
+    def create_index(self, index_name: str) -> bool:
+        if self.es.indices.exists(index=index_name):
+            logger.warning(f"Index '{index_name}' already exists")
+            try:
+                self.check_index(index_name)
+            except ValueError as e:
+                logger.error(f"✗ {e}")
+                return False
+            return True
+
         try:
-            self.es.indices.create(index=index_name, body=mapping)
-            logger.info(f"✓ Created index '{index_name}'")
+            physical = self.create_physical(index_name)
+            self.es.indices.put_alias(index=physical, name=index_name)
+            logger.info(f"✓ Created index '{index_name}' -> '{physical}'")
             return True
         except Exception as e:
             logger.error(f"✗ Failed to create index: {str(e)}")
             return False
-    
+
+    def check_index(self, index_name: str):
+        """Raise ValueError if the index was built for a different embedding dimension"""
+        mapping = self.es.indices.get_mapping(index=index_name)
+        for physical, body in mapping.items():
+            field = body['mappings'].get('properties', {}).get('embedding', {})
+            if field.get('dims') != self.dims:
+                raise ValueError(
+                    f"Index '{physical}' stores {field.get('dims')}-dim vectors but the embedding "
+                    f"model produces {self.dims}; rebuild it with IndexManager.reindex"
+                )
+            index_type = field.get('index_options', {}).get('type')
+            if index_type and index_type != ES_INDEX_TYPES.get(self.quantization):
+                logger.warning(f"Index '{physical}' uses {index_type}; reindex to apply "
+                               f"quantization '{self.quantization}'")
+
     def delete_index(self, index_name: str) -> bool:
         try:
-            if self.es.indices.exists(index=index_name):
-                self.es.indices.delete(index=index_name)
-                logger.info(f"✓ Deleted index '{index_name}'")
-                return True
-            return False
+            physical = self.resolve(index_name)
+            for index in physical:
+                self.es.indices.delete(index=index)
+                logger.info(f"✓ Deleted index '{index}'")
+            return bool(physical)
         except Exception as e:
             logger.error(f"✗ Failed to delete index: {str(e)}")
             return False
-    
+
     def index_exists(self, index_name: str) -> bool:
-        return self.es.indices.exists(index=index_name)
-    
+        return bool(self.es.indices.exists(index=index_name))
+
+    @contextlib.contextmanager
+    def bulk_load(self, index_name: str):
+        """Disable refresh and replicas while loading, restore them and refresh afterwards
+
+        Only for a physical index that is not serving searches yet (see reindex): on a live
+        index it would drop redundancy and hide fresh writes from readers during the load.
+        """
+        if self.es.indices.exists_alias(name=index_name):
+            raise ValueError(f"'{index_name}' is a live alias; bulk-load a new physical index instead")
+        self.es.indices.put_settings(index=index_name, settings={
+            "refresh_interval": self.config.bulk_refresh_interval,
+            "number_of_replicas": 0
+        })
+        try:
+            yield
+        finally:
+            self.es.indices.put_settings(index=index_name, settings={
+                "refresh_interval": self.config.refresh_interval,
+                "number_of_replicas": self.config.number_of_replicas
+            })
+            self.es.indices.refresh(index=index_name)
+
+    def reindex(self, index_name: str, populate=None) -> str:
+        """Rebuild index_name into a new physical index and switch the alias atomically
+
+        populate(physical_index) fills the new index (e.g. re-embedding after a model
+        change); by default documents are copied with _reindex, which applies new
+        settings/mappings but requires the same embedding dimension.
+        Searches keep hitting the old index until the switch. Returns the new index name.
+        """
+        old = self.resolve(index_name)
+        physical = self.create_physical(index_name)
+        try:
+            with self.bulk_load(physical):
+                if populate is not None:
+                    populate(physical)
+                elif old:
+                    self.es.reindex(source={"index": index_name}, dest={"index": physical},
+                                    wait_for_completion=True)
+        except Exception:
+            self.es.indices.delete(index=physical)
+            raise
+        self.switch_alias(index_name, physical)
+        return physical
+
+    def switch_alias(self, index_name: str, physical: str):
+        """Point index_name at physical in one atomic alias update and delete the old indices"""
+        old = self.resolve(index_name)
+        actions = []
+        for index in old:
+            if index == index_name:
+                # Pre-alias index with the same name: drop it in the same atomic update
+                actions.append({"remove_index": {"index": index}})
+            else:
+                actions.append({"remove": {"index": index, "alias": index_name}})
+        actions.append({"add": {"index": physical, "alias": index_name}})
+        self.es.indices.update_aliases(actions=actions)
+        logger.info(f"✓ Switched '{index_name}' to '{physical}'")
+
+        for index in old:
+            if index != index_name:
+                self.es.indices.delete(index=index)
+
     def get_index_stats(self, index_name: str) -> dict:
         try:
             stats = self.es.indices.stats(index=index_name)
-            doc_count = stats['indices'][index_name]['total']['docs']['count']
-            size = stats['indices'][index_name]['total']['store']['size_in_bytes']
+            doc_count = stats['_all']['primaries']['docs']['count']
+            size = stats['_all']['total']['store']['size_in_bytes']
             return {
+                'indices': sorted(stats['indices']),
                 'document_count': doc_count,
                 'size_bytes': size,
                 'size_mb': round(size / (1024 * 1024), 2)
@@ -80,3 +212,26 @@ class IndexManager:
             logger.error(f"✗ Failed to get index stats: {str(e)}")
             return {}
 
+
+if __name__ == "__main__":
+    import argparse
+    from metrics import setup_logging
+
+    parser = argparse.ArgumentParser(description="Elasticsearch index management")
+    parser.add_argument('command', choices=['create', 'delete', 'stats', 'check', 'reindex'])
+    parser.add_argument('index_name')
+    args = parser.parse_args()
+    setup_logging(log_file='')
+
+    manager = IndexManager()
+    if args.command == 'create':
+        manager.create_index(args.index_name)
+    elif args.command == 'delete':
+        manager.delete_index(args.index_name)
+    elif args.command == 'stats':
+        print(manager.get_index_stats(args.index_name))
+    elif args.command == 'check':
+        manager.check_index(args.index_name)
+        logger.info(f"✓ '{args.index_name}' matches the {manager.dims}-dim embedding model")
+    else:
+        manager.reindex(args.index_name)
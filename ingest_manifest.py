@@ -0,0 +1,71 @@
+"""
+增量入库清单
+记录每个索引中已入库文档的指纹、每页指纹和对应的 chunk ID
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+
+def file_fingerprint(path):
+    """整个文件的 sha256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_id(doc):
+    """基于内容的稳定 chunk ID：同一页上的相同内容总是得到相同 ID"""
+    key = f"{doc['source']}\0{doc['page']}\0{doc['content_type']}\0{doc['text']}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class IngestManifest:
+    """本地 JSON 清单：{索引: {文件名: {'doc_hash', 'pages': {页码: {'fingerprint', 'chunk_ids'}}}}}"""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.data = json.load(f)
+
+    def save(self):
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        # 先写临时文件再替换，中途退出不会留下半个清单
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def documents(self, index_name):
+        return self.data.setdefault(index_name, {})
+
+    def document(self, index_name, source):
+        return self.documents(index_name).get(source)
+
+    def forget_index(self, index_name):
+        self.data.pop(index_name, None)
+
+    def update_page(self, index_name, source, page, fingerprint, chunk_ids):
+        doc = self.documents(index_name).setdefault(source, {'doc_hash': None, 'pages': {}})
+        doc['pages'][str(page)] = {'fingerprint': fingerprint, 'chunk_ids': sorted(chunk_ids)}
+
+    def remove_page(self, index_name, source, page):
+        doc = self.document(index_name, source)
+        entry = doc['pages'].pop(str(page), None) if doc else None
+        return entry['chunk_ids'] if entry else []
+
+    def remove_document(self, index_name, source):
+        doc = self.documents(index_name).pop(source, None)
+        if not doc:
+            return []
+        return [cid for entry in doc['pages'].values() for cid in entry['chunk_ids']]
+
+    def set_doc_hash(self, index_name, source, doc_hash):
+        doc = self.documents(index_name).setdefault(source, {'doc_hash': None, 'pages': {}})
+        doc['doc_hash'] = doc_hash
@@ -0,0 +1,321 @@
+"""
+轻量级埋点：span（调用链）、直方图、计数器
+以 Prometheus 文本格式或 JSON 导出；未启用时 span() 返回共享的空对象，几乎没有开销
+
+    with span('search', backend='numpy') as s:
+        ...
+        s.set(hits=len(hits))
+
+启用: RAG_METRICS=true；RAG_METRICS_PORT 非 0 时在该端口提供
+/metrics（Prometheus）、/metrics.json 和 /traces，默认只监听 127.0.0.1（RAG_METRICS_HOST）
+"""
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import LOG_FILE, LOG_LEVEL, MetricsConfig
+
+logger = logging.getLogger('rag.trace')
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)   # 批量大小、队列深度等计数
+
+_current_span = contextvars.ContextVar('rag_current_span', default=None)
+
+
+def setup_logging(level=None, log_file=None):
+    """按 LOG_LEVEL / LOG_FILE 配置 rag.* 日志（只配置一次）"""
+    root = logging.getLogger('rag')
+    if root.handlers:
+        return root
+    root.setLevel((level or LOG_LEVEL).upper())
+    log_file = LOG_FILE if log_file is None else log_file
+    handler = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root.addHandler(handler)
+    root.propagate = False
+    return root
+
+
+def percentiles(values):
+    """p50 / p95 / p99 / 平均 / 最大（毫秒），基准测试与批量评测的汇总共用"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99),
+        'mean': sum(ordered) / len(ordered), 'max': ordered[-1], 'count': len(ordered)
+    }
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in items) + '}'
+
+
+class Histogram:
+    """固定桶直方图（累计计数在导出时计算）"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """按桶上界估算分位数"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+
+class Span:
+    """一次计时的调用；结束时写入 rag_stage_seconds 直方图与调用链缓冲"""
+
+    __slots__ = ('registry', 'name', 'attrs', 'trace_id', 'span_id', 'parent_id',
+                 'start', 'started', 'duration', 'error', '_token')
+
+    def __init__(self, registry, name, attrs):
+        self.registry = registry
+        self.name = name
+        self.attrs = attrs
+        parent = _current_span.get()
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.span_id = uuid.uuid4().hex[:8]
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.started
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self.registry.finish(self)
+        return False
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': self.duration * 1000,
+            'attrs': self.attrs,
+            'error': self.error
+        }
+
+
+class _NoopSpan:
+    """未启用埋点时的 span：不计时、不分配"""
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class Metrics:
+    """进程内的指标注册表"""
+
+    def __init__(self, enabled=False, trace_buffer=None, slow_ms=None):
+        self.enabled = enabled
+        self.slow_ms = slow_ms or MetricsConfig.slow_trace_ms
+        self.lock = threading.Lock()
+        self.counters = {}      # 名称 -> {标签: 值}
+        self.histograms = {}    # 名称 -> {标签: Histogram}
+        self.traces = deque(maxlen=trace_buffer or MetricsConfig.trace_buffer)
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return _NOOP
+        return Span(self, name, attrs)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def finish(self, span):
+        self.observe('rag_stage_seconds', span.duration, stage=span.name)
+        if span.error:
+            self.inc('rag_stage_errors_total', stage=span.name, error=span.error)
+        record = span.to_dict()
+        with self.lock:
+            self.traces.append(record)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("span %s %.1fms %s", span.name, record['duration_ms'], span.attrs)
+        if span.parent_id is None and record['duration_ms'] >= self.slow_ms:
+            logger.warning("慢调用 %s %.0fms: %s", span.name, record['duration_ms'],
+                           self.breakdown(span.trace_id))
+
+    def trace(self, trace_id):
+        with self.lock:
+            return [record for record in self.traces if record['trace_id'] == trace_id]
+
+    def recent_traces(self):
+        with self.lock:
+            return list(self.traces)
+
+    def breakdown(self, trace_id):
+        """一条调用链中各 span 的耗时，按开始时间排序"""
+        spans = sorted(self.trace(trace_id), key=lambda record: record['start'])
+        return ", ".join(f"{record['name']} {record['duration_ms']:.0f}ms" for record in spans)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.traces.clear()
+
+    # ---- 导出 ----
+
+    def prometheus(self):
+        """Prometheus 文本格式"""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """JSON 可序列化的快照：计数器、直方图摘要（p50/p95/p99 为桶上界估计）"""
+        with self.lock:
+            return {
+                'counters': {
+                    name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                    for name, series in self.counters.items()
+                },
+                'histograms': {
+                    name: [{
+                        'labels': dict(key),
+                        'count': h.count,
+                        'sum': h.sum,
+                        'p50': h.quantile(0.5),
+                        'p95': h.quantile(0.95),
+                        'p99': h.quantile(0.99)
+                    } for key, h in series.items()]
+                    for name, series in self.histograms.items()
+                }
+            }
+
+    def dump_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({**self.snapshot(), 'traces': self.recent_traces()}, f, indent=2, ensure_ascii=False)
+
+    def serve(self, port=None, host=None):
+        """后台线程提供 /metrics、/metrics.json、/traces，返回 server"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = registry.prometheus(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(registry.snapshot()), 'application/json'
+                elif self.path == '/traces':
+                    body, content_type = json.dumps(registry.recent_traces()), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host or MetricsConfig.host, port or MetricsConfig.port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+metrics = Metrics(enabled=MetricsConfig.enabled)
+span = metrics.span
+inc = metrics.inc
+observe = metrics.observe
+
+
+_server = None
+
+
+def start():
+    """按 MetricsConfig 配置日志并启动导出端口（重复调用无副作用）"""
+    global _server
+    setup_logging()
+    if metrics.enabled and MetricsConfig.port and _server is None:
+        _server = metrics.serve()
+        logging.getLogger('rag').info("metrics endpoint on %s:%d", MetricsConfig.host, MetricsConfig.port)
+    return metrics
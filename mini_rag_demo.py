@@ -1,11 +1,16 @@
 """
 最小化 RAG 演示
 不需要 PDF，直接使用文本进行测试
+
+用法:
+    python mini_rag_demo.py                                  # 交互式问答
+    python mini_rag_demo.py questions.jsonl [answers.jsonl]  # 批量问答（格式见 batch_qa.py）
 """
-from openai import OpenAI
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
-import os
+import sys
+import time
+from components import get_embedder, get_embedding_cache, get_es, get_llm, registry
+from vector_store import open_vector_store
+from config import EMBEDDING_DIMS, VectorStoreConfig
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,41 +21,25 @@ print("="*70)
 
 # 配置
 INDEX_NAME = "mini_rag_demo"
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
-# 初始化
+# 初始化（组件由注册表创建，与 pdf_rag 共用同一套配置）
 print("\n[1/6] 初始化组件...")
-es = Elasticsearch(['http://localhost:9200'], verify_certs=False)
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = get_llm()
 
 # 使用轻量级嵌入模型
 print("加载嵌入模型（首次会下载，约 120MB）...")
-model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
+registry.warm_up(['embedder'])
+embedder = get_embedder()
+embedding_cache = get_embedding_cache()
 print("✓ 组件初始化完成")
 
 # 创建索引
 print("\n[2/6] 创建索引...")
-try:
-    if es.indices.exists(index=INDEX_NAME):
-        es.indices.delete(index=INDEX_NAME)
-except:
-    pass
-
-mapping = {
-    "mappings": {
-        "properties": {
-            "text": {"type": "text"},
-            "embedding": {
-                "type": "dense_vector",
-                "dims": 384,
-                "index": True,
-                "similarity": "cosine"
-            }
-        }
-    }
-}
-es.indices.create(index=INDEX_NAME, **mapping)
-print(f"✓ 索引创建成功: {INDEX_NAME}")
+es = get_es() if VectorStoreConfig.backend == 'elasticsearch' else None
+store = open_vector_store(VectorStoreConfig.backend, INDEX_NAME, es=es, dims=EMBEDDING_DIMS)
+store.drop()
+store.create()
+print(f"✓ 索引创建成功: {INDEX_NAME} ({VectorStoreConfig.backend})")
 
 # 准备知识库文档
 print("\n[3/6] 准备知识库...")
@@ -64,50 +53,45 @@ documents = [
 
 # 生成嵌入并索引
 print("生成嵌入向量并索引文档...")
-for i, doc in enumerate(documents):
-    embedding = model.encode(doc).tolist()
-    es.index(
-        index=INDEX_NAME,
-        id=str(i),
-        body={
-            "text": doc,
-            "embedding": embedding
-        }
-    )
-es.indices.refresh(index=INDEX_NAME)
+embeddings = embedding_cache.encode(documents, embedder.encode)
+store.upsert(
+    [str(i) for i in range(len(documents))],
+    embeddings,
+    # page 为文档序号（从 1 开始），批量评测的 gold_pages 按它标注
+    [{"text": doc, "page": i + 1} for i, doc in enumerate(documents)]
+)
+store.flush()
 print(f"✓ 已索引 {len(documents)} 个文档")
 
 # 查询函数
-def rag_query(question: str) -> str:
-    """RAG 查询流程"""
+def retrieve_batch(questions, top_k=3):
+    """批量检索：问题一次编码，一次 multi_search（Elasticsearch 上为一个 _msearch 请求）
+
+    返回 [(文档, 耗时)]，编码与检索耗时按问题数均摊
+    """
     # 1. 生成查询向量
-    query_embedding = model.encode(question).tolist()
+    started = time.perf_counter()
+    query_embeddings = embedding_cache.encode(questions, embedder.encode)
+    encode_ms = (time.perf_counter() - started) * 1000 / len(questions)
     
     # 2. 向量搜索
-    search_result = es.search(
-        index=INDEX_NAME,
-        body={
-            "knn": {
-                "field": "embedding",
-                "query_vector": query_embedding,
-                "k": 3,
-                "num_candidates": 10
-            },
-            "_source": ["text"]
-        }
-    )
+    started = time.perf_counter()
+    knn_lists, _, latencies = store.multi_search(query_embeddings, top_k)
+    search_ms = (time.perf_counter() - started) * 1000 / len(questions)
     
     # 3. 提取检索到的文档
-    retrieved_docs = []
-    for hit in search_result['hits']['hits']:
-        retrieved_docs.append({
-            'text': hit['_source']['text'],
-            'score': hit['_score']
-        })
-    
-    if not retrieved_docs:
-        return "未找到相关信息"
-    
+    return [
+        (
+            [{'text': hit['metadata']['text'], 'page': hit['metadata'].get('page'), 'score': hit['score']}
+             for hit in hits],
+            {'encode': encode_ms, 'search': search_ms, 'knn': knn_ms}
+        )
+        for hits, knn_ms in zip(knn_lists, latencies['knn'])
+    ]
+
+
+def generate_answer(question, retrieved_docs, report=None):
+    """基于检索到的文档生成答案"""
     # 4. 构建上下文
     context = "\n\n".join([f"[文档{i+1}] {doc['text']}" for i, doc in enumerate(retrieved_docs)])
     
@@ -128,8 +112,25 @@ def rag_query(question: str) -> str:
         max_tokens=500
     )
     
-    answer = response.choices[0].message.content
-    return answer, retrieved_docs
+    return response.choices[0].message.content
+
+
+def rag_query(question: str):
+    """RAG 查询流程，返回 (答案, 文档)"""
+    retrieved_docs, _ = retrieve_batch([question])[0]
+    if not retrieved_docs:
+        return "未找到相关信息", []
+    return generate_answer(question, retrieved_docs), retrieved_docs
+
+# 批量问答：回答问题文件中的全部问题后退出
+if len(sys.argv) > 1:
+    from batch_qa import load_questions, print_summary, run_batch
+    output_path = sys.argv[2] if len(sys.argv) > 2 else 'answers.jsonl'
+    questions = load_questions(sys.argv[1])
+    print(f"\n[4/6] 批量问答: {len(questions)} 个问题")
+    summary = run_batch(questions, retrieve_batch, generate_answer, output_path, top_k=3)
+    print_summary(summary, output_path)
+    sys.exit(0)
 
 # 演示查询
 print("\n[4/6] 系统就绪！")
@@ -191,7 +192,7 @@ while True:
 print("\n[5/6] 清理...")
 cleanup = input("是否删除演示索引？(y/n): ").strip().lower()
 if cleanup == 'y':
-    es.indices.delete(index=INDEX_NAME)
+    store.drop()
     print(f"✓ 已删除索引: {INDEX_NAME}")
 
 print("\n[6/6] 完成！")
@@ -0,0 +1,299 @@
+"""
+嵌入模型的 ONNX Runtime CPU 推理后端
+首次使用时把 SentenceTransformer 的 Transformer 部分导出为 ONNX（可选动态 int8 量化），
+连同分词器缓存到 LocalEmbeddingConfig.onnx_dir；导出后与 PyTorch 输出逐条比较余弦相似度，
+低于 parity_min_cosine 的导出不会被使用。之后直接加载缓存，不导入 torch，常驻内存更小。
+OnnxSentenceEncoder 与 SentenceTransformer 的 encode / get_sentence_embedding_dimension 接口相同
+
+依赖: pip install onnxruntime onnx（onnx 仅导出时需要）
+用法: python onnx_embedding.py [--model 名称] [--threads N]   # torch / onnx / onnx-int8 的吞吐、内存与一致性
+"""
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+import numpy as np
+from config import LOCAL_EMBEDDING_MODEL, LocalEmbeddingConfig
+
+logger = logging.getLogger('rag.embedding')
+
+INPUT_NAMES = ('input_ids', 'attention_mask', 'token_type_ids')
+POOLING_FLAGS = {'pooling_mode_mean_tokens': 'mean', 'pooling_mode_cls_token': 'cls',
+                 'pooling_mode_max_tokens': 'max'}
+MODEL_FILES = {'fp32': 'model.onnx', 'int8': 'model_int8.onnx'}
+OPSET = 14
+
+# 一致性检查用的文本：中英文、长短不一（检验 padding），最后一条超过 max_seq_length（检验截断）
+PARITY_TEXTS = [
+    "什么是 RAG？",
+    "Elasticsearch 是一个强大的搜索引擎，支持全文搜索和向量搜索。",
+    "Retrieval augmented generation combines a vector index with a language model.",
+    "表格内容:\n| 年份 | 收入 | 增长率 |\n| --- | --- | --- |\n| 2023 | 120 | 8% |",
+    "a",
+    " ".join(["向量检索与混合检索的延迟和召回率"] * 40)
+]
+
+
+def cache_dir(model_name):
+    return os.path.join(LocalEmbeddingConfig.onnx_dir, re.sub(r'[^\w.-]+', '_', model_name).strip('_'))
+
+
+def read_meta(directory):
+    """meta.json 在导出与检查都完成后才写入；不存在表示没有可用的缓存"""
+    try:
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _pooling_mode(pooling):
+    """兼容新旧版本 sentence-transformers 的 Pooling 配置"""
+    config = pooling.get_config_dict()
+    if 'pooling_mode' in config:
+        return config['pooling_mode']
+    modes = [mode for key, mode in POOLING_FLAGS.items() if config.get(key)]
+    return modes[0] if len(modes) == 1 else '+'.join(modes)
+
+
+def describe(model):
+    """导出与推理所需的模型信息；只支持 Transformer + Pooling (+ Normalize) 结构"""
+    modules = [type(module).__name__ for module in model]
+    if modules[:2] != ['Transformer', 'Pooling'] or any(name != 'Normalize' for name in modules[2:]):
+        raise ValueError(f"不支持导出 ONNX 的模型结构: {modules}")
+    pooling = _pooling_mode(model[1])
+    if pooling not in ('mean', 'cls', 'max'):
+        raise ValueError(f"不支持的池化方式: {pooling}")
+    transformer = model[0]
+    features = transformer.tokenizer(["warm up"])
+    return {
+        'dims': model.get_sentence_embedding_dimension(),
+        'pooling': pooling,
+        'normalize': len(modules) > 2,
+        'max_seq_length': transformer.max_seq_length,
+        'do_lower_case': bool(getattr(transformer, 'do_lower_case', False)),
+        'pad_token': transformer.tokenizer.pad_token,
+        'pad_token_id': transformer.tokenizer.pad_token_id,
+        'input_names': [name for name in INPUT_NAMES if name in features]
+    }
+
+
+def pool(hidden, attention_mask, mode, normalize=False):
+    """token 向量 -> 句向量，与 sentence-transformers 的 Pooling / Normalize 一致"""
+    if mode == 'cls':
+        vectors = hidden[:, 0]
+    else:
+        mask = attention_mask[..., None].astype(hidden.dtype)
+        if mode == 'mean':
+            vectors = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        else:
+            vectors = np.where(mask > 0, hidden, -1e9).max(axis=1)
+    if normalize:
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return vectors.astype(np.float32)
+
+
+class OnnxSentenceEncoder:
+    """ONNX Runtime 推理 + numpy 池化，接口同 SentenceTransformer"""
+
+    def __init__(self, directory, variant='fp32', threads=0, meta=None):
+        import onnxruntime as ort
+        # 用 tokenizers 直接加载 tokenizer.json：transformers 会连带导入 torch
+        from tokenizers import Tokenizer
+        self.meta = meta or read_meta(directory)
+        self.variant = variant
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            os.path.join(directory, MODEL_FILES[variant]), options, providers=['CPUExecutionProvider']
+        )
+        self.tokenizer = Tokenizer.from_file(os.path.join(directory, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(self.meta['max_seq_length'])
+        self.tokenizer.enable_padding(pad_id=self.meta['pad_token_id'], pad_token=self.meta['pad_token'])
+
+    def get_sentence_embedding_dimension(self):
+        return self.meta['dims']
+
+    def _encode_batch(self, texts):
+        texts = [text.strip() for text in texts]
+        if self.meta['do_lower_case']:
+            texts = [text.lower() for text in texts]
+        encodings = self.tokenizer.encode_batch(texts)
+        features = {
+            'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+            'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            'token_type_ids': np.array([e.type_ids for e in encodings], dtype=np.int64)
+        }
+        inputs = {name: features[name] for name in self.meta['input_names']}
+        hidden = self.session.run(['last_hidden_state'], inputs)[0]
+        return pool(hidden, features['attention_mask'], self.meta['pooling'], self.meta['normalize'])
+
+    def encode(self, sentences, batch_size=32):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        vectors = np.zeros((len(texts), self.meta['dims']), dtype=np.float32)
+        # 按长度排序后分批，同一批内 padding 最少（与 SentenceTransformer 相同）
+        order = np.argsort([-len(text) for text in texts], kind='stable')
+        for start in range(0, len(texts), batch_size):
+            rows = order[start:start + batch_size]
+            vectors[rows] = self._encode_batch([texts[i] for i in rows])
+        return vectors[0] if single else vectors
+
+
+def _export_graph(model, path, input_names):
+    """只导出 Transformer 主干（输出 last_hidden_state），池化在 numpy 中完成"""
+    import torch
+
+    class HiddenStates(torch.nn.Module):
+        # 按名称传参：不同版本 transformers 的 forward 位置参数顺序不同
+        def __init__(self, backbone):
+            super().__init__()
+            self.backbone = backbone
+
+        def forward(self, *inputs):
+            return self.backbone(**dict(zip(input_names, inputs)), return_dict=True).last_hidden_state
+
+    features = model[0].tokenizer(["warm up", "导出 ONNX"], padding=True, return_tensors='pt')
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']}
+    tmp_path = path + '.tmp'
+    with torch.no_grad():
+        torch.onnx.export(
+            HiddenStates(model[0].auto_model.eval()),
+            tuple(features[name] for name in input_names),
+            tmp_path,
+            input_names=input_names,
+            output_names=['last_hidden_state'],
+            dynamic_axes=dynamic_axes,
+            opset_version=OPSET,
+            dynamo=False
+        )
+    os.replace(tmp_path, path)
+
+
+def _quantize(directory):
+    """动态 int8 量化：权重离线量化，激活在推理时按批计算缩放"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    tmp_path = os.path.join(directory, MODEL_FILES['int8'] + '.tmp')
+    quantize_dynamic(os.path.join(directory, MODEL_FILES['fp32']), tmp_path, weight_type=QuantType.QInt8)
+    os.replace(tmp_path, os.path.join(directory, MODEL_FILES['int8']))
+
+
+def min_cosine(expected, actual):
+    expected = expected / np.linalg.norm(expected, axis=1, keepdims=True)
+    actual = actual / np.linalg.norm(actual, axis=1, keepdims=True)
+    return float((expected * actual).sum(axis=1).min())
+
+
+def export_model(model_name, directory, quantize=False):
+    """导出（及量化）并与 PyTorch 输出比较，全部通过后写入 meta.json 并返回它"""
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(model_name, device='cpu')
+    meta = {'model': model_name, **describe(model)}
+    os.makedirs(directory, exist_ok=True)
+
+    started = time.perf_counter()
+    _export_graph(model, os.path.join(directory, MODEL_FILES['fp32']), meta['input_names'])
+    model[0].tokenizer.save_pretrained(directory)
+    if not os.path.exists(os.path.join(directory, 'tokenizer.json')):
+        raise ValueError(f"{model_name} 没有 fast tokenizer（tokenizer.json），无法脱离 transformers 推理")
+    variants = ['fp32']
+    if quantize:
+        _quantize(directory)
+        variants.append('int8')
+    logger.info("已导出 %s 的 ONNX 模型 (%s)，用时 %.1f 秒", model_name, '/'.join(variants),
+                time.perf_counter() - started)
+
+    expected = model.encode(PARITY_TEXTS)
+    meta['parity'] = {}
+    for variant in variants:
+        actual = OnnxSentenceEncoder(directory, variant, meta=meta).encode(PARITY_TEXTS)
+        cosine = min_cosine(expected, actual)
+        if cosine < LocalEmbeddingConfig.parity_min_cosine[variant]:
+            raise ValueError(
+                f"{model_name} 的 ONNX {variant} 输出与 PyTorch 不一致: 最小余弦相似度 {cosine:.5f} "
+                f"< {LocalEmbeddingConfig.parity_min_cosine[variant]}"
+            )
+        meta['parity'][variant] = cosine
+        logger.info("ONNX %s 与 PyTorch 一致: 最小余弦相似度 %.6f", variant, cosine)
+
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def load_onnx_model(model_name=LOCAL_EMBEDDING_MODEL, quantize=None, threads=None):
+    """返回 OnnxSentenceEncoder；缓存中没有通过一致性检查的该精度模型时先导出"""
+    quantize = LocalEmbeddingConfig.quantize if quantize is None else quantize
+    threads = LocalEmbeddingConfig.threads if threads is None else threads
+    variant = 'int8' if quantize else 'fp32'
+    directory = cache_dir(model_name)
+    meta = read_meta(directory)
+    if meta.get('model') != model_name or variant not in meta.get('parity', {}):
+        meta = export_model(model_name, directory, quantize)
+    return OnnxSentenceEncoder(directory, variant, threads, meta)
+
+
+def _rss_mb():
+    """当前常驻内存（MB），仅 Linux"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float('nan')
+
+
+def measure(model_name, backend, threads, num_texts, batch_size):
+    """在当前进程中加载一种后端并测量加载耗时、编码吞吐与常驻内存"""
+    from benchmark import WORDS
+    rng = np.random.default_rng(0)
+    texts = [" ".join(rng.choice(WORDS, size=rng.integers(20, 120))) for _ in range(num_texts)]
+
+    started = time.perf_counter()
+    if backend == 'torch':
+        import torch
+        from sentence_transformers import SentenceTransformer
+        if threads:
+            torch.set_num_threads(threads)
+        model = SentenceTransformer(model_name, device='cpu')
+    else:
+        model = load_onnx_model(model_name, quantize=backend == 'onnx-int8', threads=threads)
+    load_seconds = time.perf_counter() - started
+
+    model.encode(texts[:batch_size], batch_size=batch_size)
+    started = time.perf_counter()
+    model.encode(texts, batch_size=batch_size)
+    elapsed = time.perf_counter() - started
+    parity = model.meta['parity'][model.variant] if backend != 'torch' else None
+    print(f"{backend:<10} 加载 {load_seconds:5.1f}s  {num_texts / elapsed:7.1f} 条/秒  "
+          f"常驻内存 {_rss_mb():6.0f}MB" + (f"  最小余弦 {parity:.5f}" if parity is not None else ""))
+
+
+if __name__ == "__main__":
+    import argparse
+    from metrics import setup_logging
+
+    parser = argparse.ArgumentParser(description="嵌入模型 CPU 推理后端对比")
+    parser.add_argument('--model', default=LOCAL_EMBEDDING_MODEL)
+    parser.add_argument('--backend', choices=['torch', 'onnx', 'onnx-int8'],
+                        help="只测量一种后端（默认每种后端各起一个进程，内存互不影响）")
+    parser.add_argument('--threads', type=int, default=LocalEmbeddingConfig.threads)
+    parser.add_argument('--texts', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+    setup_logging(log_file='')
+
+    if args.backend:
+        measure(args.model, args.backend, args.threads, args.texts, args.batch_size)
+    else:
+        for backend in ('torch', 'onnx', 'onnx-int8'):
+            subprocess.run([sys.executable, __file__, '--backend', backend, '--model', args.model,
+                            '--threads', str(args.threads), '--texts', str(args.texts),
+                            '--batch-size', str(args.batch_size)])
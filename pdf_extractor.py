@@ -0,0 +1,194 @@
+"""
+PDF 并行抽取引擎
+每个 worker 只打开一次文档，处理一段页码范围内的文本、图像和表格，
+结果按页码顺序返回
+"""
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import fitz  # PyMuPDF
+from chunker import make_chunker, page_paragraphs
+from config import DocumentConfig
+from image_captioner import image_hash
+from pipeline import ordered_map
+from table_extractor import TableExtractor, table_chunks, table_signature
+
+_chunker = None
+
+
+def get_chunker():
+    """进程内共享的分块器（每个 worker 加载一次 tokenizer）"""
+    global _chunker
+    if _chunker is None:
+        _chunker = make_chunker()
+    return _chunker
+
+
+def extraction_signature():
+    """抽取参数变化时所有页指纹随之变化，触发重新入库"""
+    return (
+        f"chunks={get_chunker().signature()};"
+        f"images={'all' if DocumentConfig.extract_images else 'none'};"
+        f"tables={table_signature() if DocumentConfig.extract_tables else 'none'}"
+    )
+
+
+def split_page_ranges(num_pages, pages_per_task):
+    """把 [0, num_pages) 切分为连续的页码范围"""
+    return [
+        (start, min(start + pages_per_task, num_pages))
+        for start in range(0, num_pages, pages_per_task)
+    ]
+
+
+def page_runs(page_numbers, pages_per_task):
+    """把页码（从1开始）切分为连续的 [start, end) 范围（从0开始）"""
+    ranges = []
+    for page in sorted(page_numbers):
+        index = page - 1
+        if ranges and ranges[-1][1] == index and index - ranges[-1][0] < pages_per_task:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return [tuple(r) for r in ranges]
+
+
+def page_fingerprints(pdf_path):
+    """每页一个指纹：内容流 + 图像/XObject 数据 + 抽取参数，无需抽取文本"""
+    fingerprints = []
+    signature = extraction_signature()
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(len(doc)):
+            page = doc[page_num]
+            digest = hashlib.sha256(f"{signature};page={page_num}".encode())
+            digest.update(page.read_contents())
+            for xref in [img[0] for img in page.get_images()] + [x[0] for x in page.get_xobjects()]:
+                digest.update(doc.xref_stream_raw(xref) or b'')
+            fingerprints.append(digest.hexdigest())
+    return fingerprints
+
+
+def extract_page_range(pdf_path, start, end):
+    """在 worker 中处理 [start, end) 页，返回每页的抽取结果"""
+    results = []
+    seen_images = {}
+    chunker = get_chunker()
+    doc = fitz.open(pdf_path)
+    tables = TableExtractor(pdf_path) if DocumentConfig.extract_tables else None
+
+    try:
+        for page_num in range(start, end):
+            page = doc[page_num]
+            started = time.perf_counter()
+            result = {
+                'page': page_num + 1,
+                'text_chunks': chunker.chunk(page_paragraphs(page)),
+                'images': [],
+                'table_chunks': [],
+                'table_engine': None,    # skipped | fitz | pdfplumber
+                'errors': [],
+                'timings': {}    # 各类内容的抽取耗时（秒），由主进程计入指标
+            }
+            result['timings']['text'] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            if DocumentConfig.extract_images:
+                for img_index, img in enumerate(page.get_images()):
+                    xref = img[0]
+                    if xref in seen_images:
+                        # 同一 xref（如每页重复的 logo）只传一次图像数据
+                        if seen_images[xref] is not None:
+                            result['images'].append({'xref': xref, 'hash': seen_images[xref], 'image': None})
+                        continue
+                    seen_images[xref] = None
+                    try:
+                        image = doc.extract_image(xref)["image"]
+                    except Exception as e:
+                        result['errors'].append(f"跳过图像 {img_index}: {e}")
+                        continue
+                    seen_images[xref] = image_hash(image)
+                    result['images'].append({'xref': xref, 'hash': seen_images[xref], 'image': image})
+            result['timings']['images'] = time.perf_counter() - started
+
+            if tables is not None:
+                started = time.perf_counter()
+                try:
+                    rows_list, result['table_engine'] = tables.extract(page)
+                    for rows in rows_list:
+                        result['table_chunks'].extend(table_chunks(rows))
+                except Exception as e:
+                    result['errors'].append(f"表格提取失败: {e}")
+                result['timings']['tables'] = time.perf_counter() - started
+
+            results.append(result)
+    finally:
+        doc.close()
+        if tables is not None:
+            tables.close()
+
+    return results
+
+
+class PDFExtractor:
+    """基于进程池的页级并行抽取"""
+
+    def __init__(self, max_workers=None, pages_per_task=None):
+        self.max_workers = max_workers or DocumentConfig.extract_workers
+        self.pages_per_task = pages_per_task or DocumentConfig.pages_per_task
+        # 在途页码范围上限：消费端跟不上时 worker 会停下来等待
+        self.max_pending = self.max_workers * 2
+
+    def _tasks(self, pdf_path, pages=None):
+        if pages is None:
+            with fitz.open(pdf_path) as doc:
+                ranges = split_page_ranges(len(doc), self.pages_per_task)
+        else:
+            ranges = page_runs(pages, self.pages_per_task)
+        for start, end in ranges:
+            yield pdf_path, start, end
+
+    def iter_pages(self, pdf_path, pages=None):
+        """按页码顺序逐页产出抽取结果，pages 为需要处理的页码（默认全部）"""
+        tasks = list(self._tasks(pdf_path, pages))
+
+        # 单个范围无需进程池开销
+        if len(tasks) <= 1 or self.max_workers <= 1:
+            for task in tasks:
+                yield from extract_page_range(*task)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            for results in ordered_map(pool, extract_page_range, tasks, self.max_pending):
+                yield from results
+
+    def iter_directory(self, pdf_dir, pages_by_path=None):
+        """并发处理目录中的所有 PDF，按文件名、页码顺序产出 (路径, 页结果)
+
+        pages_by_path 给出时只处理其中列出的文件和页码
+        """
+        if pages_by_path is None:
+            pages_by_path = {path: None for path in list_pdfs(pdf_dir)}
+        # 所有文档的页码范围共享同一个进程池和在途上限
+        tasks = (
+            task
+            for path in sorted(pages_by_path)
+            for task in self._tasks(path, pages_by_path[path])
+        )
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            for results in ordered_map(pool, _extract_task, tasks, self.max_pending):
+                yield from results
+
+
+def list_pdfs(pdf_dir):
+    """目录中的 PDF 路径（按文件名排序）"""
+    return [
+        os.path.join(pdf_dir, f)
+        for f in sorted(os.listdir(pdf_dir))
+        if f.lower().endswith('.pdf')
+    ]
+
+
+def _extract_task(pdf_path, start, end):
+    return [(pdf_path, page) for page in extract_page_range(pdf_path, start, end)]
@@ -3,313 +3,820 @@
 支持文本、图像和表格处理
 """
 import os
-import fitz  # PyMuPDF
-import pdfplumber
-from openai import OpenAI
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
-import base64
+import time
+from collections import deque
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import (
+    AnswerCacheConfig, DocumentConfig, EMBEDDING_DIMS, LOCAL_EMBEDDING_MODEL, MetricsConfig,
+    RetrievalConfig, ServingConfig, VectorStoreConfig
+)
+from image_captioner import ImageCaptioner, image_hash
+from pdf_extractor import PDFExtractor, list_pdfs, page_fingerprints
+from ingest_manifest import IngestManifest, chunk_id, file_fingerprint
+from pipeline import PipelineStats, StageStats, batched
+from vector_store import open_vector_store
+from retrieval import reciprocal_rank_fusion
+from reranker import make_reranker
+from answer_cache import SemanticAnswerCache
+from metrics import metrics, span, start as start_metrics
+from components import (
+    get_context_builder, get_embedder, get_embedding_cache, get_es, get_llm, get_model, registry
+)
 
 load_dotenv()
 
 # 配置
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-client = OpenAI(api_key=OPENAI_API_KEY)
-es = Elasticsearch(['http://localhost:9200'], verify_certs=False)
-model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
+MODEL_NAME = LOCAL_EMBEDDING_MODEL
+
+# 旧的模块级全局对象（client / es / model / embedding_cache / context_builder）
+# 改为首次访问时由组件注册表创建
+_LAZY_GLOBALS = {
+    'client': get_llm,
+    'es': get_es,
+    'model': get_model,
+    'embedding_cache': get_embedding_cache,
+    'context_builder': get_context_builder
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_GLOBALS:
+        return _LAZY_GLOBALS[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def open_store(index_name):
+    """按 VectorStoreConfig.backend 打开向量存储"""
+    # 本地向量存储用不到 Elasticsearch 客户端，不创建
+    es = get_es() if VectorStoreConfig.backend == 'elasticsearch' else None
+    return open_vector_store(VectorStoreConfig.backend, index_name, es=es, dims=EMBEDDING_DIMS)
+
+
+def encode_texts(texts, batch_size=32):
+    """经向量缓存编码，只有未命中的文本才会调用模型
+
+    编码期间向量服务回退到本地模型时结果不写入缓存：缓存按服务端模型分命名空间，
+    回退向量写进去会在服务恢复后继续被命中
+    """
+    embedder = get_embedder()
+    fallbacks = embedder.fallbacks
+    with span('encode', texts=len(texts)):
+        return get_embedding_cache().encode(
+            texts, lambda missing: embedder.encode(missing, batch_size=batch_size),
+            cacheable=lambda: embedder.fallbacks == fallbacks
+        )
+
 
 class PDFProcessor:
     """处理 PDF 文档"""
     
-    def __init__(self, index_name):
+    def __init__(self, index_name, extractor=None, rebuild=False, store=None):
         self.index_name = index_name
-        self.setup_index()
+        self.extractor = extractor or PDFExtractor()
+        self.store = store or open_store(index_name)
+        self.manifest = IngestManifest(DocumentConfig.manifest_path)
+        self.captioner = ImageCaptioner(get_llm)
+        self.last_stats = None
+        self.rebuild_pending = False
+        self.setup_index(rebuild)
     
-    def setup_index(self):
-        """创建索引"""
-        try:
-            if es.indices.exists(index=self.index_name):
-                es.indices.delete(index=self.index_name)
-        except:
-            pass
-        
-        mapping = {
-            "mappings": {
-                "properties": {
-                    "text": {"type": "text"},
-                    "embedding": {
-                        "type": "dense_vector",
-                        "dims": 384,
-                        "index": True,
-                        "similarity": "cosine"
-                    },
-                    "source": {"type": "keyword"},
-                    "page": {"type": "integer"},
-                    "content_type": {"type": "keyword"},
-                    "chunk_id": {"type": "keyword"}
-                }
-            }
-        }
-        es.indices.create(index=self.index_name, **mapping)
-        print(f"✓ 索引创建成功: {self.index_name}")
+    def close(self):
+        """停止图像描述线程池（存储仍可继续使用）"""
+        self.captioner.shutdown()
     
-    def extract_text(self, pdf_path):
-        """提取文本"""
-        print("\n[1/3] 提取文本...")
-        chunks = []
-        
-        doc = fitz.open(pdf_path)
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            text = page.get_text()
-            
-            if text.strip():
-                # 简单分块（每500字符一块）
-                words = text.split()
-                chunk_size = 100  # 单词数
-                
-                for i in range(0, len(words), chunk_size):
-                    chunk_text = ' '.join(words[i:i+chunk_size])
-                    if chunk_text.strip():
-                        chunks.append({
-                            'text': chunk_text,
-                            'source': os.path.basename(pdf_path),
-                            'page': page_num + 1,
-                            'content_type': 'text'
-                        })
-        
-        doc.close()
-        print(f"✓ 提取了 {len(chunks)} 个文本块")
-        return chunks
-    
-    def extract_images(self, pdf_path):
-        """提取图像并生成描述"""
-        print("\n[2/3] 提取图像...")
-        image_data = []
-        
-        doc = fitz.open(pdf_path)
-        image_count = 0
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def setup_index(self, rebuild=False):
+        """创建索引；已存在时保留并增量更新，rebuild=True 时由 process_directory 全量重建（完成后才替换旧索引）"""
+        if self.store.exists():
+            if not rebuild:
+                self.store.check_schema()
+                print(f"✓ 使用已有索引: {self.index_name}")
+                return
+            # 清单只在内存中作废：所有页都会重新入库；重建成功后才保存
+            self.manifest.forget_index(self.index_name)
+            self.rebuild_pending = True
+            print(f"✓ 将在入库时重建索引: {self.index_name}")
+            return
         
-        for page_num in range(min(len(doc), 5)):  # 只处理前5页以节省成本
-            page = doc[page_num]
-            image_list = page.get_images()
-            
-            for img_index, img in enumerate(image_list[:2]):  # 每页最多2张图
-                try:
-                    xref = img[0]
-                    base_image = doc.extract_image(xref)
-                    image_bytes = base_image["image"]
-                    
-                    # 生成描述
-                    caption = self.caption_image(image_bytes, page_num + 1)
-                    
-                    image_data.append({
-                        'text': f"图像描述: {caption}",
-                        'source': os.path.basename(pdf_path),
-                        'page': page_num + 1,
-                        'content_type': 'image'
-                    })
-                    image_count += 1
-                except Exception as e:
-                    print(f"  跳过图像 {img_index}: {e}")
+        # 索引是新建的，清单中的旧记录全部作废
+        self.manifest.forget_index(self.index_name)
+        self.manifest.save()
         
-        doc.close()
-        print(f"✓ 处理了 {image_count} 张图像")
-        return image_data
+        self.store.create()
+        print(f"✓ 索引创建成功: {self.index_name}")
+    
+    def extract_text(self, source, page):
+        """页面文本块 -> 文档"""
+        return [{
+            'text': chunk_text,
+            'source': source,
+            'page': page['page'],
+            'content_type': 'text',
+            'chunk_index': index
+        } for index, chunk_text in enumerate(page['text_chunks'])]
+    
+    def submit_captions(self, page):
+        """提交页面图像的描述请求，返回 [(图像, Future)]"""
+        return [(image, self.captioner.submit(image['hash'], image['image'])) for image in page['images']]
+    
+    def image_documents(self, source, page_num, captions):
+        """等待描述完成 -> 文档；描述失败时退回占位描述（带图像序号：chunk ID 由内容决定，不能重复）"""
+        return [{
+            'text': f"图像描述: {future.result() or f'第 {page_num} 页的第 {index + 1} 张图像'}",
+            'source': source,
+            'page': page_num,
+            'content_type': 'image',
+            'chunk_index': index
+        } for index, (_, future) in enumerate(captions)]
+    
+    def extract_images(self, source, page):
+        """页面图像 -> 生成描述后的文档"""
+        return self.image_documents(source, page['page'], self.submit_captions(page))
     
     def caption_image(self, image_bytes, page_num):
-        """使用 GPT-4 Vision 生成图像描述"""
-        try:
-            base64_image = base64.b64encode(image_bytes).decode('utf-8')
+        """使用 GPT-4 Vision 生成图像描述（经描述缓存）"""
+        caption = self.captioner.submit(image_hash(image_bytes), image_bytes).result()
+        return caption or f"第 {page_num} 页的图像"
+    
+    def extract_tables(self, source, page):
+        """页面表格块（大表格已按行组切分，每块带表头）-> 文档"""
+        return [{
+            'text': f"表格内容:\n{chunk_text}",
+            'source': source,
+            'page': page['page'],
+            'content_type': 'table',
+            'chunk_index': index
+        } for index, chunk_text in enumerate(page['table_chunks'])]
+    
+    def new_stats(self):
+        """创建抽取 -> 描述 -> 编码 -> 索引各阶段的计数器"""
+        return PipelineStats(
+            StageStats('抽取', '页'),
+            StageStats('图像描述', '张'),
+            StageStats('编码', '块'),
+            StageStats('索引', '块')
+        )
+    
+    def iter_documents(self, pages, stats):
+        """抽取阶段：逐页产出文本、表格文档；图像描述在后台并发进行，
+        最多 caption_window_pages 页之后再回收描述结果"""
+        window = deque()
+        pages = iter(pages)
+        while True:
+            started = time.perf_counter()
+            item = next(pages, None)
+            if item is None:
+                break
+            source, page = item
+            stats['抽取'].add(1, time.perf_counter() - started)
+            for kind, seconds in page.get('timings', {}).items():
+                metrics.observe('rag_stage_seconds', seconds, stage=f'extract_{kind}')
+            if page.get('table_engine'):
+                metrics.inc('rag_table_pages_total', engine=page['table_engine'])
             
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "简要描述这张图片的内容（1-2句话）。"
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }],
-                max_tokens=100
-            )
+            for error in page['errors']:
+                print(f"  {source} 第 {page['page']} 页: {error}")
             
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"第 {page_num} 页的图像"
+            page_ids = stats.page_chunks.setdefault((source, page['page']), set())
+            yield from self._collect(self.extract_text(source, page) + self.extract_tables(source, page),
+                                     page_ids, stats)
+            window.append((source, page['page'], page_ids, self.submit_captions(page)))
+            if len(window) > DocumentConfig.caption_window_pages:
+                yield from self._collect_images(window.popleft(), stats)
+        
+        while window:
+            yield from self._collect_images(window.popleft(), stats)
+    
+    def _collect_images(self, pending, stats):
+        source, page_num, page_ids, captions = pending
+        started = time.perf_counter()
+        with span('image_captions', images=len(captions)):
+            image_data = self.image_documents(source, page_num, captions)
+        if any(future.result() is None for _, future in captions):
+            stats.caption_failed.add((source, page_num))
+        stats['图像描述'].add(len(image_data), time.perf_counter() - started)
+        return self._collect(image_data, page_ids, stats)
+    
+    def _collect(self, documents, page_ids, stats):
+        for doc in documents:
+            doc['chunk_id'] = chunk_id(doc)
+            page_ids.add(doc['chunk_id'])
+            stats.counts[doc['content_type']] += 1
+            yield doc
     
-    def extract_tables(self, pdf_path):
-        """提取表格"""
-        print("\n[3/3] 提取表格...")
-        table_data = []
+    def embed_documents(self, documents, stats):
+        """编码阶段：按批产出 (批次号, 文档批, 向量)，编码失败时向量为 None"""
+        batch_size = DocumentConfig.batch_size
+        for batch_no, batch in enumerate(batched(documents, batch_size), 1):
+            started = time.perf_counter()
+            try:
+                embeddings = encode_texts(
+                    [doc['text'] for doc in batch], batch_size=batch_size
+                )
+            except Exception as e:
+                print(f"  批次 {batch_no} 编码失败: {e}")
+                embeddings = None
+            stats['编码'].add(len(batch), time.perf_counter() - started)
+            yield batch_no, batch, embeddings
+    
+    def index_documents(self, documents, stats=None):
+        """索引阶段：流式消费文档，按批编码后经 _bulk API 写入"""
+        stats = stats or self.new_stats()
+        max_inflight = DocumentConfig.bulk_max_inflight
+        print(f"\n流式索引 (每批 {DocumentConfig.batch_size} 个, 最多 {max_inflight} 批并发)...")
         
-        try:
-            with pdfplumber.open(pdf_path) as pdf:
-                for page_num, page in enumerate(pdf.pages[:5]):  # 只处理前5页
-                    tables = page.extract_tables()
-                    
-                    for table in tables:
-                        if table and len(table) > 1:
-                            # 转换为文本
-                            table_text = self.table_to_text(table)
-                            
-                            table_data.append({
-                                'text': f"表格内容: {table_text}",
-                                'source': os.path.basename(pdf_path),
-                                'page': page_num + 1,
-                                'content_type': 'table'
-                            })
-        except Exception as e:
-            print(f"  表格提取失败: {e}")
+        indexed = 0
+        pending = set()
         
-        print(f"✓ 提取了 {len(table_data)} 个表格")
-        return table_data
-    
-    def table_to_text(self, table):
-        """将表格转换为文本"""
-        lines = []
-        for row in table[:5]:  # 只取前5行
-            row_text = ' | '.join([str(cell or '') for cell in row])
-            lines.append(row_text)
-        return '\n'.join(lines)
-    
-    def index_documents(self, documents):
-        """索引文档"""
-        print(f"\n索引 {len(documents)} 个文档...")
+        def collect(done):
+            nonlocal indexed
+            for future in done:
+                batch_no, ok, errors, seconds = future.result()
+                indexed += ok
+                stats['索引'].add(ok, seconds)
+                if errors:
+                    stats.failed.update(doc_id for doc_id, _ in errors)
+                    print(f"  批次 {batch_no} 失败 {len(errors)} 个: {errors[0][1]}")
+            print(f"  已索引 {indexed} | {stats.progress()}")
         
-        for i, doc in enumerate(documents):
-            try:
-                embedding = model.encode(doc['text']).tolist()
+        with ThreadPoolExecutor(max_workers=max_inflight) as pool:
+            for batch_no, batch, embeddings in self.embed_documents(documents, stats):
+                if embeddings is None:
+                    stats.failed.update(doc['chunk_id'] for doc in batch)
+                    continue
                 
-                doc_body = {
+                ids = [doc['chunk_id'] for doc in batch]
+                metadata = [{
                     'text': doc['text'],
-                    'embedding': embedding,
                     'source': doc['source'],
                     'page': doc['page'],
                     'content_type': doc['content_type'],
-                    'chunk_id': f"{doc['source']}_p{doc['page']}_{i}"
-                }
-                
-                es.index(index=self.index_name, id=f"doc_{i}", document=doc_body)
+                    'chunk_id': doc['chunk_id'],
+                    'chunk_index': doc.get('chunk_index')
+                } for doc in batch]
                 
-                if (i + 1) % 10 == 0:
-                    print(f"  已索引 {i + 1}/{len(documents)}")
-            except Exception as e:
-                print(f"  索引失败 {i}: {e}")
+                # 背压：在途 bulk 请求达到上限时暂停编码，上游抽取随之暂停
+                if len(pending) >= max_inflight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(pool.submit(self._bulk_index, batch_no, ids, embeddings, metadata))
+            
+            if pending:
+                collect(wait(pending).done)
         
-        es.indices.refresh(index=self.index_name)
-        print(f"✓ 索引完成")
+        self.store.flush()
+        if stats.failed:
+            print(f"✓ 索引完成 ({indexed} 成功, {len(stats.failed)} 失败)")
+        else:
+            print(f"✓ 索引完成")
+        return indexed
+    
+    def _bulk_index(self, batch_no, ids, embeddings, metadata):
+        """写入一批向量（Elasticsearch 为一个 _bulk 请求），返回 (批次号, 成功数, [(ID, 错误)], 耗时)"""
+        started = time.perf_counter()
+        with span('index', docs=len(ids), backend=VectorStoreConfig.backend) as s:
+            errors = self.store.upsert(ids, embeddings, metadata)
+            s.set(errors=len(errors))
+        metrics.inc('rag_chunks_indexed_total', len(ids) - len(errors))
+        metrics.inc('rag_chunks_failed_total', len(errors))
+        return batch_no, len(ids) - len(errors), errors, time.perf_counter() - started
+    
+    def delete_chunks(self, chunk_ids):
+        """按 ID 删除已不存在的 chunk"""
+        chunk_ids = list(chunk_ids)
+        with span('delete', chunks=len(chunk_ids)):
+            for batch in batched(chunk_ids, DocumentConfig.batch_size * 4):
+                self.store.delete(batch)
+        return len(chunk_ids)
+    
+    def plan_updates(self, pdf_paths):
+        """对比清单与文件/页指纹，返回 {路径: (文件指纹, 页指纹列表, 需要重新处理的页码)}"""
+        plans = {}
+        for pdf_path in pdf_paths:
+            source = os.path.basename(pdf_path)
+            doc_hash = file_fingerprint(pdf_path)
+            entry = self.manifest.document(self.index_name, source)
+            if entry and entry['doc_hash'] == doc_hash:
+                continue
+            
+            fingerprints = page_fingerprints(pdf_path)
+            indexed_pages = entry['pages'] if entry else {}
+            changed = [
+                page for page, fingerprint in enumerate(fingerprints, 1)
+                if indexed_pages.get(str(page), {}).get('fingerprint') != fingerprint
+            ]
+            plans[pdf_path] = (doc_hash, fingerprints, changed)
+        return plans
+    
+    def run_pipeline(self, pages, plans):
+        """抽取 -> 描述 -> 编码 -> 索引，全程流式；完成后删除过期 chunk 并更新清单"""
+        stats = self.new_stats()
+        for pdf_path, (_, _, changed) in plans.items():
+            print(f"  {os.path.basename(pdf_path)}: {len(changed)} 页需要更新")
+        documents = self.iter_documents(pages, stats)
+        if self.rebuild_pending:
+            self.store.rebuild(lambda: self.index_documents(documents, stats))
+            self.rebuild_pending = False
+        else:
+            self.index_documents(documents, stats)
+        self.last_stats = stats
+        
+        stale = []
+        for pdf_path, (doc_hash, fingerprints, changed) in plans.items():
+            source = os.path.basename(pdf_path)
+            entry = self.manifest.document(self.index_name, source)
+            
+            # 文档变短：多出来的旧页整页删除
+            old_pages = [int(p) for p in entry['pages']] if entry else []
+            for page in old_pages:
+                if page > len(fingerprints):
+                    stale.extend(self.manifest.remove_page(self.index_name, source, page))
+            
+            complete = True
+            for page in changed:
+                new_ids = stats.page_chunks.get((source, page), set())
+                if new_ids & stats.failed:
+                    # 有 chunk 写入失败：不记录该页，下次重试
+                    complete = False
+                    continue
+                stale.extend(set(self.manifest.remove_page(self.index_name, source, page)) - new_ids)
+                if (source, page) in stats.caption_failed:
+                    # 图像描述失败（已写入占位描述）：记下 chunk 以便下次替换，但不记指纹，下次重新处理该页
+                    self.manifest.update_page(self.index_name, source, page, None, new_ids)
+                    complete = False
+                    continue
+                self.manifest.update_page(self.index_name, source, page, fingerprints[page - 1], new_ids)
+            self.manifest.set_doc_hash(self.index_name, source, doc_hash if complete else None)
+        
+        if stale:
+            print(f"  删除 {self.delete_chunks(stale)} 个过期 chunk")
+            self.store.flush()
+        self.manifest.save()
+        # 索引内容已变化，查询端的语义答案缓存随之失效
+        self.store.bump_generation()
+        
+        total = sum(stats.counts.values())
+        print(f"\n处理完成! 用时 {stats.elapsed:.1f} 秒")
+        print(f"  文本块: {stats.counts['text']}")
+        print(f"  图像: {stats.counts['image']}")
+        print(f"  表格: {stats.counts['table']}")
+        print(f"  总计: {total} 个文档")
+        print(f"  {stats.progress()}")
+        print(f"  {get_embedding_cache()}")
+        print(f"  {self.captioner}")
+        return total
     
     def process_pdf(self, pdf_path):
-        """完整处理流程"""
+        """完整处理流程（增量：只处理变化的页）"""
+        if self.rebuild_pending:
+            # 重建后的新索引会替换旧索引，只入库一个文件会丢掉其余文档
+            raise ValueError("重建索引需要完整目录，请使用 process_directory")
         print(f"\n处理 PDF: {pdf_path}")
         print("="*70)
         
-        # 提取所有内容
-        text_chunks = self.extract_text(pdf_path)
-        image_data = self.extract_images(pdf_path)
-        table_data = self.extract_tables(pdf_path)
+        plans = self.plan_updates([pdf_path])
+        if not plans:
+            print("✓ 文档未变化，跳过")
+            return 0
         
-        # 合并所有文档
-        all_docs = text_chunks + image_data + table_data
+        # 单次打开、按页并行抽取文本、图像和表格
+        print(f"\n并行抽取 (最多 {self.extractor.max_workers} 个进程)...")
+        source = os.path.basename(pdf_path)
+        changed = plans[pdf_path][2]
+        pages = ((source, page) for page in self.extractor.iter_pages(pdf_path, changed))
+        return self.run_pipeline(pages, plans)
+    
+    def process_directory(self, pdf_dir):
+        """并发抽取目录中的所有 PDF，流式增量索引；目录中已删除的文件从索引移除"""
+        print(f"\n处理目录: {pdf_dir}")
+        print("="*70)
         
-        # 索引
-        self.index_documents(all_docs)
+        pdf_paths = list_pdfs(pdf_dir)
+        present = {os.path.basename(path) for path in pdf_paths}
+        removed = [s for s in self.manifest.documents(self.index_name) if s not in present]
+        stale = []
+        for source in removed:
+            stale.extend(self.manifest.remove_document(self.index_name, source))
+        if stale:
+            print(f"  {len(removed)} 个文件已移除，删除 {self.delete_chunks(stale)} 个 chunk")
+            self.store.flush()
+            self.manifest.save()
+            self.store.bump_generation()
         
-        print(f"\n处理完成!")
-        print(f"  文本块: {len(text_chunks)}")
-        print(f"  图像: {len(image_data)}")
-        print(f"  表格: {len(table_data)}")
-        print(f"  总计: {len(all_docs)} 个文档")
+        plans = self.plan_updates(pdf_paths)
+        if not plans:
+            print("✓ 所有文档均未变化，跳过")
+            return 0
         
-        return len(all_docs)
+        pages_by_path = {path: plan[2] for path, plan in plans.items()}
+        pages = (
+            (os.path.basename(pdf_path), page)
+            for pdf_path, page in self.extractor.iter_directory(pdf_dir, pages_by_path)
+        )
+        return self.run_pipeline(pages, plans)
+
+
+def record_llm_tokens(context, usage):
+    """累计提示词 / 生成 token 数（服务端未返回 usage 时提示词用本地估算）"""
+    prompt_tokens = usage.prompt_tokens if usage and usage.prompt_tokens else context.get('prompt_tokens', 0)
+    metrics.inc('rag_llm_tokens_total', prompt_tokens, kind='prompt')
+    if usage:
+        metrics.inc('rag_llm_tokens_total', usage.completion_tokens, kind='completion')
+
+
+def make_answer_cache(store):
+    """按 AnswerCacheConfig 创建语义答案缓存，索引入库版本变化时自动失效"""
+    if not AnswerCacheConfig.enabled:
+        return None
+    return SemanticAnswerCache(version_fn=store.generation)
+
+
+def hit_to_doc(hit, score):
+    """向量存储命中 -> 检索结果文档"""
+    meta = hit['metadata']
+    return {
+        'text': meta['text'],
+        'source': meta['source'],
+        'page': meta['page'],
+        'type': meta['content_type'],
+        'chunk_id': meta.get('chunk_id', hit['id']),
+        # 页内顺序号；之前入库的 chunk 没有该字段
+        'chunk_index': meta.get('chunk_index'),
+        'score': score
+    }
+
+
+def candidate_size(num_searches, top_k):
+    """多路检索时每路多取候选，融合后再截断到 top_k"""
+    if num_searches > 1:
+        return max(top_k, RetrievalConfig.max_results_per_query)
+    return top_k
+
+
+def merge_hits(knn_lists, bm25_lists, top_k):
+    """单路检索保留原始分数；多路检索按 chunk_id 去重并经 RRF 融合"""
+    ranked_lists = bm25_lists + knn_lists
+    if len(ranked_lists) == 1:
+        return [hit_to_doc(hit, hit['score']) for hit in ranked_lists[0][:top_k]]
+    merged = reciprocal_rank_fusion(
+        ranked_lists,
+        key=lambda hit: hit['metadata'].get('chunk_id', hit['id'])
+    )
+    return [hit_to_doc(hit, score) for score, hit in merged[:top_k]]
+
+
+def expansion_messages(query, n):
+    """问题改写的提示词"""
+    return [
+        {
+            "role": "system",
+            "content": f"把用户的问题改写成 {n} 个不同表述的检索问题，保持原意。每行一个，不要编号，不要其他内容。"
+        },
+        {"role": "user", "content": query}
+    ]
+
+
+def parse_variations(content, query, n):
+    """解析 LLM 返回的改写问题：去掉编号、空行和重复"""
+    variations = []
+    for line in content.splitlines():
+        line = line.strip().lstrip('-•*0123456789.、) ').strip()
+        if line and line != query and line not in variations:
+            variations.append(line)
+    return variations[:n]
+
+
+def build_messages(query, docs, report=None):
+    """由检索结果构建生成答案的对话消息（按 token 预算装配上下文）"""
+    return get_context_builder().build_messages(query, docs, report)
+
+
+class StreamTimer:
+    """记录一次流式生成的首 token 时间 (TTFT) 与生成速度"""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sent = None
+        self.first_token = None
+        self.last_token = None
+        self.chunks = 0
+        self.completion_tokens = None
+    
+    def request_sent(self):
+        self.sent = time.perf_counter()
+    
+    def token(self):
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+        self.last_token = now
+        self.chunks += 1
+    
+    def usage(self, completion_tokens):
+        self.completion_tokens = completion_tokens
+    
+    def record(self):
+        """把首 token 时间与生成耗时计入指标直方图"""
+        if not metrics.enabled or self.sent is None:
+            return
+        now = time.perf_counter()
+        metrics.observe('rag_stage_seconds', now - self.sent, stage='llm_stream')
+        if self.first_token is not None:
+            metrics.observe('rag_llm_ttft_seconds', self.first_token - self.sent)
+    
+    def metrics(self, retrieval_timings=None):
+        now = time.perf_counter()
+        # 服务端返回 usage 时用准确的 token 数，否则以流式分片数近似
+        tokens = self.completion_tokens if self.completion_tokens is not None else self.chunks
+        first = self.first_token or now
+        generation = (self.last_token or now) - first
+        return {
+            'ttft_ms': (first - self.started) * 1000,
+            'llm_ttft_ms': (first - (self.sent or self.started)) * 1000,
+            'total_ms': (now - self.started) * 1000,
+            'tokens': tokens,
+            'tokens_per_sec': (tokens - 1) / generation if generation > 0 and tokens > 1 else 0.0,
+            'retrieval': dict(retrieval_timings or {})
+        }
 
 
 class RAGQuery:
     """RAG 查询"""
     
-    def __init__(self, index_name):
+    def __init__(self, index_name, store=None, mode=None, reranker=None, expand=None):
         self.index_name = index_name
+        self.store = store or open_store(index_name)
+        self.mode = mode or RetrievalConfig.search_mode
+        self.expand = RetrievalConfig.query_expansion if expand is None else expand
+        self.reranker = reranker or make_reranker(RetrievalConfig.reranker)
+        self.answer_cache = make_answer_cache(self.store)
+        self.last_timings = {}
+        self.last_context = {}
     
-    def search(self, query, top_k=5):
-        """搜索"""
-        query_embedding = model.encode(query).tolist()
+    def expand_query(self, query, n=None):
+        """用 LLM 生成 n 个改写问题，失败时返回空列表"""
+        n = n or RetrievalConfig.num_query_variations
+        try:
+            response = get_llm().chat.completions.create(
+                model="gpt-4o-mini",
+                messages=expansion_messages(query, n),
+                temperature=0.7,
+                max_tokens=200
+            )
+        except Exception as e:
+            print(f"  ⚠️ 问题改写失败: {e}")
+            return []
+        return parse_variations(response.choices[0].message.content, query, n)
+    
+    def search(self, query, top_k=5, mode=None, expand=None):
+        """搜索
+
+        knn 为纯向量检索；hybrid 为 BM25 + kNN。expand=True 时额外检索 LLM 改写的问题，
+        所有问题一次批量编码、一次并发检索，按 chunk_id 去重后经 RRF 融合
+        """
+        mode = mode or self.mode
+        expand = self.expand if expand is None else expand
+        timings = {}
         
-        result = es.search(
-            index=self.index_name,
-            body={
-                "knn": {
-                    "field": "embedding",
-                    "query_vector": query_embedding,
-                    "k": top_k,
-                    "num_candidates": 50
-                },
-                "_source": ["text", "source", "page", "content_type"]
-            }
-        )
+        queries = [query]
+        if expand:
+            started = time.perf_counter()
+            queries += self.expand_query(query)
+            timings['expand'] = (time.perf_counter() - started) * 1000
+        
+        started = time.perf_counter()
+        query_embeddings = encode_texts(queries)
+        timings['encode'] = (time.perf_counter() - started) * 1000
+        
+        # 本地向量存储没有倒排索引，只能做向量检索
+        text_queries = [query] if mode == 'hybrid' and self.store.supports_text_search else []
+        size = candidate_size(len(queries) + len(text_queries), top_k)
+        
+        started = time.perf_counter()
+        with span('search', backend=VectorStoreConfig.backend, knn=len(queries), bm25=len(text_queries)):
+            knn_lists, bm25_lists, latencies = self.store.multi_search(query_embeddings, size, text_queries)
+        timings['search'] = (time.perf_counter() - started) * 1000
+        timings['knn'] = max(latencies['knn'])
+        if latencies['bm25']:
+            timings['bm25'] = max(latencies['bm25'])
+        
+        self.last_timings = timings
+        return merge_hits(knn_lists, bm25_lists, top_k)
+    
+    def search_batch(self, queries, top_k=5, mode=None):
+        """批量检索（不做问题改写）
+
+        所有问题一次批量编码，kNN 与 BM25 检索合并为一个 _msearch 请求；
+        返回与 queries 对应的 [(文档, 耗时)]，批量编码与检索的耗时按问题数均摊
+        """
+        mode = mode or self.mode
+        started = time.perf_counter()
+        query_embeddings = encode_texts(queries, batch_size=len(queries))
+        encode_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        
+        text_queries = list(queries) if mode == 'hybrid' and self.store.supports_text_search else []
+        size = candidate_size(1 + bool(text_queries), top_k)
+        
+        started = time.perf_counter()
+        with span('search', backend=VectorStoreConfig.backend, knn=len(queries), bm25=len(text_queries)):
+            knn_lists, bm25_lists, latencies = self.store.multi_search(query_embeddings, size, text_queries)
+        search_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        
+        results = []
+        for i in range(len(queries)):
+            timings = {'encode': encode_ms, 'search': search_ms, 'knn': latencies['knn'][i]}
+            bm25 = [bm25_lists[i]] if text_queries else []
+            if text_queries:
+                timings['bm25'] = latencies['bm25'][i]
+            results.append((merge_hits([knn_lists[i]], bm25, top_k), timings))
+        return results
+    
+    def retrieve_batch(self, queries, top_k=None):
+        """批量检索；配置了重排序器时逐个问题重排，返回值同 search_batch"""
+        if self.reranker is None:
+            return self.search_batch(queries, top_k or 5)
         
-        docs = []
-        for hit in result['hits']['hits']:
-            docs.append({
-                'text': hit['_source']['text'],
-                'source': hit['_source']['source'],
-                'page': hit['_source']['page'],
-                'type': hit['_source']['content_type'],
-                'score': hit['_score']
-            })
+        top_k = top_k or RetrievalConfig.final_top_k
+        results = []
+        candidate_lists = self.search_batch(queries, max(RetrievalConfig.top_k_rerank, top_k))
+        for query, (candidates, timings) in zip(queries, candidate_lists):
+            started = time.perf_counter()
+            with span('rerank', candidates=len(candidates)) as s:
+                docs, reranked = self.reranker.rerank(query, candidates, top_k)
+                s.set(completed=reranked)
+            timings['rerank'] = (time.perf_counter() - started) * 1000
+            results.append((docs, timings))
+        return results
+    
+    def retrieve(self, query, top_k=None):
+        """检索；配置了重排序器时先取 top_k_rerank 个候选再重排到 top_k（未指定时为 final_top_k）"""
+        if self.reranker is None:
+            return self.search(query, top_k or 5)
         
+        top_k = top_k or RetrievalConfig.final_top_k
+        candidates = self.search(query, max(RetrievalConfig.top_k_rerank, top_k))
+        started = time.perf_counter()
+        with span('rerank', candidates=len(candidates)) as s:
+            docs, reranked = self.reranker.rerank(query, candidates, top_k)
+            s.set(completed=reranked)
+        self.last_timings['rerank'] = (time.perf_counter() - started) * 1000
+        if not reranked:
+            print("  ⚠️ 重排序超出延迟预算，使用第一阶段排序")
         return docs
     
+    def cached_answer(self, query):
+        """查询语义答案缓存，返回 (缓存条目或 None, 问题向量)"""
+        if self.answer_cache is None:
+            return None, None
+        query_embedding = encode_texts([query])[0]
+        cached = self.answer_cache.lookup(query_embedding)
+        metrics.inc('rag_answer_cache_total', result='hit' if cached else 'miss')
+        return cached, query_embedding
+    
+    def remember_answer(self, query, query_embedding, answer, docs):
+        if self.answer_cache is not None and docs:
+            self.answer_cache.store(query, query_embedding, answer, docs)
+    
     def generate_answer(self, query):
-        """生成答案"""
-        # 检索
-        docs = self.search(query)
+        """生成答案（相近问题直接返回缓存的答案与引用）"""
+        with span('query'):
+            cached, query_embedding = self.cached_answer(query)
+            if cached:
+                return cached['answer'], cached['docs']
+            
+            # 检索
+            docs = self.retrieve(query)
+            
+            if not docs:
+                return "未找到相关信息", []
+            
+            # 生成答案
+            self.last_context = {}
+            answer = self.complete(query, docs, self.last_context)
+            self.remember_answer(query, query_embedding, answer, docs)
+            return answer, docs
+    
+    def complete(self, query, docs, report):
+        """由检索结果生成答案；上下文装配统计写入 report（可在多个线程中同时调用）"""
+        messages = build_messages(query, docs, report)
+        with span('llm', prompt_tokens=report['prompt_tokens']) as s:
+            response = get_llm().chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=0.7,
+                max_tokens=800
+            )
+            if response.usage:
+                s.set(completion_tokens=response.usage.completion_tokens)
+        record_llm_tokens(report, response.usage)
+        return response.choices[0].message.content
+    
+    def stream_answer(self, query):
+        """流式生成答案
+
+        依次产出 {'event': 'docs', 'docs'}、若干 {'event': 'token', 'text'}，
+        最后 {'event': 'done', 'metrics'}，metrics 含首 token 时间与 tokens/秒
+        """
+        timer = StreamTimer()
+        # span 不跨越 yield：只覆盖检索部分，流式生成的耗时单独计入直方图
+        with span('query', stream=True):
+            cached, query_embedding = self.cached_answer(query)
+            docs = None if cached else self.retrieve(query)
+        if cached:
+            yield {'event': 'docs', 'docs': cached['docs']}
+            timer.token()
+            yield {'event': 'token', 'text': cached['answer']}
+            yield {'event': 'done', 'metrics': {**timer.metrics(), 'cache_hit': True}}
+            return
         
-        if not docs:
-            return "未找到相关信息", []
+        yield {'event': 'docs', 'docs': docs}
         
-        # 构建上下文
-        context = "\n\n".join([
-            f"[文档{i+1}] (来源: {doc['source']}, 第{doc['page']}页, 类型: {doc['type']})\n{doc['text'][:300]}"
-            for i, doc in enumerate(docs)
-        ])
+        if not docs:
+            yield {'event': 'token', 'text': "未找到相关信息"}
+            yield {'event': 'done', 'metrics': timer.metrics(self.last_timings)}
+            return
         
-        # 生成答案
-        response = client.chat.completions.create(
+        self.last_context = {}
+        messages = build_messages(query, docs, self.last_context)
+        timer.request_sent()
+        stream = get_llm().chat.completions.create(
             model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "你是一个helpful的AI助手。请基于提供的文档回答问题，并标注引用来源。如果文档中没有相关信息，请明确说明。"
-                },
-                {
-                    "role": "user",
-                    "content": f"问题: {query}\n\n参考文档:\n{context}\n\n请回答:"
-                }
-            ],
+            messages=messages,
             temperature=0.7,
-            max_tokens=800
+            max_tokens=800,
+            stream=True,
+            stream_options={"include_usage": True}
         )
+        parts = []
+        usage = None
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+                timer.usage(chunk.usage.completion_tokens)
+            if chunk.choices and chunk.choices[0].delta.content:
+                timer.token()
+                parts.append(chunk.choices[0].delta.content)
+                yield {'event': 'token', 'text': parts[-1]}
         
-        answer = response.choices[0].message.content
-        return answer, docs
+        timer.record()
+        record_llm_tokens(self.last_context, usage)
+        self.remember_answer(query, query_embedding, ''.join(parts), docs)
+        yield {'event': 'done', 'metrics': {
+            **timer.metrics(self.last_timings),
+            'prompt_tokens': self.last_context['prompt_tokens'],
+            'cache_hit': False
+        }}
+
+
+def dump_metrics(metrics_registry):
+    if metrics_registry.enabled and MetricsConfig.dump_path:
+        metrics_registry.dump_json(MetricsConfig.dump_path)
+        print(f"✓ 指标已写入 {MetricsConfig.dump_path}")
+
+
+def run_batch_mode(args, index_name, pdf_dir, metrics_registry):
+    """批量问答：入库（增量）后回答问题文件中的全部问题，不进入交互"""
+    from batch_qa import load_questions, print_summary, run_batch
+    
+    questions = load_questions(args.batch)
+    with PDFProcessor(index_name) as processor:
+        processor.process_directory(pdf_dir)
+    rag = RAGQuery(index_name)
+    print(f"\n📋 批量问答: {len(questions)} 个问题, 每批 {args.batch_size}, 生成并发 {args.concurrency}")
+    summary = run_batch(
+        questions, rag.retrieve_batch, rag.complete, args.output, top_k=args.top_k,
+        batch_size=args.batch_size, concurrency=args.concurrency, generate=not args.retrieval_only
+    )
+    print_summary(summary, args.output)
+    dump_metrics(metrics_registry)
 
 
 def main():
     """主函数"""
+    import argparse
+    parser = argparse.ArgumentParser(description="PDF RAG 系统（默认交互式问答）")
+    parser.add_argument('--batch', metavar='QUESTIONS.jsonl', help="批量回答问题文件中的问题")
+    parser.add_argument('--output', default='answers.jsonl', help="批量模式的结果文件")
+    parser.add_argument('--batch-size', type=int, default=32, help="每批编码与检索的问题数")
+    parser.add_argument('--concurrency', type=int, default=8, help="同时生成答案的问题数")
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--retrieval-only', action='store_true', help="只检索和计算 recall@k，不生成答案")
+    args = parser.parse_args()
+    
     print("="*70)
     print("🚀 完整 PDF RAG 系统")
     print("="*70)
+    metrics_registry = start_metrics()
+    if ServingConfig.preload:
+        # 本地模型由 embedder 按需加载：http 向量后端时不占用内存
+        registry.preload(['embedder', 'embedding_cache', 'context_builder', 'llm'])
     
     # 检查 PDF 文件
     pdf_dir = "test_pdf"
@@ -320,30 +827,39 @@ def main():
     
     if not pdf_files:
         print(f"\n⚠️  请将 PDF 文件放到 '{pdf_dir}' 目录中")
-        input("\n按回车退出...")
+        if not args.batch:
+            input("\n按回车退出...")
+        return
+    
+    index_name = "pdf_rag_index"
+    if args.batch:
+        run_batch_mode(args, index_name, pdf_dir, metrics_registry)
         return
     
     print(f"\n找到 {len(pdf_files)} 个 PDF 文件:")
     for i, f in enumerate(pdf_files, 1):
         print(f"  {i}. {f}")
     
-    # 选择文件
+    # 选择文件（a = 并发处理全部）
+    pdf_path = None
     if len(pdf_files) == 1:
         pdf_path = os.path.join(pdf_dir, pdf_files[0])
     else:
-        choice = input(f"\n选择要处理的文件 (1-{len(pdf_files)}): ").strip()
-        try:
-            idx = int(choice) - 1
-            pdf_path = os.path.join(pdf_dir, pdf_files[idx])
-        except:
-            print("无效选择")
-            return
-    
-    index_name = "pdf_rag_index"
+        choice = input(f"\n选择要处理的文件 (1-{len(pdf_files)}, a=全部): ").strip()
+        if choice.lower() != 'a':
+            try:
+                idx = int(choice) - 1
+                pdf_path = os.path.join(pdf_dir, pdf_files[idx])
+            except:
+                print("无效选择")
+                return
     
     # 处理 PDF
-    processor = PDFProcessor(index_name)
-    processor.process_pdf(pdf_path)
+    with PDFProcessor(index_name) as processor:
+        if pdf_path is None:
+            processor.process_directory(pdf_dir)
+        else:
+            processor.process_pdf(pdf_path)
     
     # 交互式问答
     print("\n" + "="*70)
@@ -365,12 +881,19 @@ def main():
             
             print("\n🔍 正在检索和生成答案...\n")
             
-            answer, docs = rag.generate_answer(question)
-            
             print("="*70)
             print("📝 AI 回答:")
             print("="*70)
-            print(answer)
+            
+            docs, metrics = [], {}
+            for event in rag.stream_answer(question):
+                if event['event'] == 'docs':
+                    docs = event['docs']
+                elif event['event'] == 'token':
+                    print(event['text'], end='', flush=True)
+                else:
+                    metrics = event['metrics']
+            print()
             
             print("\n" + "="*70)
             print(f"📚 检索到的文档 (共{len(docs)}个):")
@@ -380,6 +903,18 @@ def main():
                 print(f"相似度: {doc['score']:.4f}")
                 print(doc['text'][:200] + "...")
             
+            if metrics.get('cache_hit'):
+                print("\n⚡ 命中语义答案缓存")
+            elif metrics:
+                print(f"\n⏱  首 token {metrics['ttft_ms']:.0f}ms, "
+                      f"{metrics['tokens']} tokens, {metrics['tokens_per_sec']:.1f} tokens/秒")
+            if metrics.get('prompt_tokens'):
+                context = rag.last_context
+                print(f"📝 提示词 {context['prompt_tokens']} tokens (上下文 {context['context_tokens']}, "
+                      f"合并 {context['merged']}, 去重 {context['duplicates']}, 截断 {context['truncated']})")
+            timings = ", ".join(f"{name} {ms:.0f}ms" for name, ms in rag.last_timings.items())
+            print(f"\n⏱  检索耗时: {timings}")
+            
             print("\n" + "="*70 + "\n")
             
         except KeyboardInterrupt:
@@ -391,9 +926,11 @@ def main():
     # 清理
     cleanup = input("\n是否删除索引？(y/n): ").strip().lower()
     if cleanup == 'y':
-        es.indices.delete(index=index_name)
+        processor.store.drop()
         print(f"✓ 已删除索引: {index_name}")
     
+    dump_metrics(metrics_registry)
+    
     print("\n完成！")
 
 
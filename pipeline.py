@@ -0,0 +1,72 @@
+"""
+流式处理管道工具
+各阶段都是生成器，下游按需拉取，在途任务数有上限（背压），
+内存占用与文档大小无关
+"""
+import time
+from collections import Counter, deque
+from itertools import islice
+
+
+def batched(iterable, size):
+    """把任意可迭代对象切分为大小为 size 的列表"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def ordered_map(pool, fn, args_iter, max_pending):
+    """在 pool 中执行 fn(*args)，最多 max_pending 个任务在途，按提交顺序产出结果"""
+    pending = deque()
+    for args in args_iter:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(pool.submit(fn, *args))
+    while pending:
+        yield pending.popleft().result()
+
+
+class StageStats:
+    """单个阶段的进度与吞吐计数"""
+
+    def __init__(self, name, unit='项'):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.busy = 0.0
+
+    def add(self, items, seconds):
+        self.items += items
+        self.busy += seconds
+
+    @property
+    def rate(self):
+        return self.items / self.busy if self.busy > 0 else 0.0
+
+    def __str__(self):
+        return f"{self.name} {self.items}{self.unit} ({self.rate:.1f} {self.unit}/秒)"
+
+
+class PipelineStats:
+    """整条管道的计数器集合"""
+
+    def __init__(self, *stages):
+        self.stages = {stage.name: stage for stage in stages}
+        self.counts = Counter()
+        self.failed = set()
+        self.caption_failed = set()    # 有图像描述失败的页 (来源, 页码)，下次入库重新处理
+        self.page_chunks = {}
+        self.started = time.perf_counter()
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def progress(self):
+        return " | ".join(str(stage) for stage in self.stages.values())
@@ -0,0 +1,135 @@
+"""
+交叉编码器重排序
+位于 RAGQuery.search 与 generate_answer 之间：分批打分、缓存 (问题, chunk) 分数，
+超出单次查询的延迟预算时退回第一阶段的排序
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from config import RERANK_URL, RERANK_MODEL, RERANK_LOCAL_MODEL, RetrievalConfig
+
+
+class Reranker:
+    """重排序基类，子类实现 score_batch"""
+
+    def __init__(self, batch_size=None, budget_ms=None, cache_size=None):
+        self.batch_size = batch_size or RetrievalConfig.rerank_batch_size
+        self.budget_ms = budget_ms or RetrievalConfig.rerank_budget_ms
+        self.cache_size = cache_size or RetrievalConfig.rerank_cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.cache_hits = 0
+        self.scored = 0
+        self.fallbacks = 0
+
+    def score_batch(self, query, texts, timeout):
+        """返回 texts 中每段文本与 query 的相关性分数"""
+        raise NotImplementedError
+
+    def _key(self, query, doc):
+        content = doc.get('chunk_id') or doc['text']
+        return hashlib.sha1(f"{query}\0{content}".encode('utf-8')).hexdigest()
+
+    def _cached(self, key):
+        with self.lock:
+            score = self.cache.get(key)
+            if score is not None:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+            return score
+
+    def _remember(self, key, score):
+        with self.lock:
+            self.cache[key] = score
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def rerank(self, query, docs, top_k=None):
+        """按交叉编码器分数重排 docs，返回 (前 top_k 个文档, 是否完成重排)"""
+        top_k = top_k or len(docs)
+        deadline = time.perf_counter() + self.budget_ms / 1000
+
+        keys = [self._key(query, doc) for doc in docs]
+        scores = [self._cached(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        for start in range(0, len(missing), self.batch_size):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return self._fallback(docs, top_k)
+            batch = missing[start:start + self.batch_size]
+            try:
+                batch_scores = self.score_batch(query, [docs[i]['text'] for i in batch], remaining)
+            except Exception:
+                return self._fallback(docs, top_k)
+            for i, score in zip(batch, batch_scores):
+                scores[i] = float(score)
+                self._remember(keys[i], scores[i])
+            self.scored += len(batch)
+
+        if time.perf_counter() > deadline:
+            return self._fallback(docs, top_k)
+
+        reranked = []
+        for doc, score in zip(docs, scores):
+            reranked.append({**doc, 'first_stage_score': doc['score'], 'score': score})
+        reranked.sort(key=lambda doc: doc['score'], reverse=True)
+        return reranked[:top_k], True
+
+    def _fallback(self, docs, top_k):
+        self.fallbacks += 1
+        return docs[:top_k], False
+
+    def stats(self):
+        return {
+            'scored': self.scored,
+            'cache_hits': self.cache_hits,
+            'fallbacks': self.fallbacks
+        }
+
+
+class CrossEncoderReranker(Reranker):
+    """本地 sentence-transformers CrossEncoder"""
+
+    def __init__(self, model_name=RERANK_LOCAL_MODEL, **kwargs):
+        super().__init__(**kwargs)
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name)
+
+    def score_batch(self, query, texts, timeout):
+        return self.model.predict([(query, text) for text in texts], batch_size=self.batch_size)
+
+
+class HTTPReranker(Reranker):
+    """HTTP 重排序服务：POST {model, query, documents} -> {results: [{index, relevance_score}]}"""
+
+    def __init__(self, url=RERANK_URL, model_name=RERANK_MODEL, **kwargs):
+        super().__init__(**kwargs)
+        import requests
+        self.url = url
+        self.model_name = model_name
+        self.session = requests.Session()
+
+    def score_batch(self, query, texts, timeout):
+        response = self.session.post(
+            self.url,
+            json={'model': self.model_name, 'query': query, 'documents': texts},
+            timeout=timeout
+        )
+        response.raise_for_status()
+        scores = [0.0] * len(texts)
+        for result in response.json()['results']:
+            scores[result['index']] = result['relevance_score']
+        return scores
+
+
+def make_reranker(kind):
+    """按 RetrievalConfig.reranker 创建重排序器：none | local | http"""
+    if kind in (None, '', 'none'):
+        return None
+    if kind == 'local':
+        return CrossEncoderReranker()
+    if kind == 'http':
+        return HTTPReranker()
+    raise ValueError(f"未知的重排序器: {kind}")
@@ -0,0 +1,25 @@
+"""
+检索结果融合
+"""
+from config import RetrievalConfig
+
+
+def reciprocal_rank_fusion(ranked_lists, k=None, key=lambda hit: hit['id']):
+    """Reciprocal Rank Fusion：score(d) = Σ 1 / (k + rank_i(d))，rank 从 1 开始
+
+    ranked_lists 中每个列表已按相关性降序排列；返回融合后按分数降序的
+    [(分数, 命中)]，同一文档保留首次出现的命中
+    """
+    k = RetrievalConfig.rrf_k if k is None else k
+    scores = {}
+    first_hit = {}
+    for hits in ranked_lists:
+        for rank, hit in enumerate(hits, 1):
+            doc_key = key(hit)
+            scores[doc_key] = scores.get(doc_key, 0.0) + 1.0 / (k + rank)
+            first_hit.setdefault(doc_key, hit)
+    return sorted(
+        ((score, first_hit[doc_key]) for doc_key, score in scores.items()),
+        key=lambda item: item[0],
+        reverse=True
+    )
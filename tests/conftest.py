@@ -0,0 +1,64 @@
+"""
+测试公共夹具：仓库根目录加入 sys.path；入库测试使用临时目录、本地 NumPy 存储、
+按文本哈希生成向量的嵌入替身和可控的视觉模型替身，不需要 Elasticsearch、OpenAI 或嵌入模型
+"""
+import hashlib
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from components import registry  # noqa: E402
+from config import DocumentConfig, VectorStoreConfig  # noqa: E402
+from embedding_cache import EmbeddingCache  # noqa: E402
+from embedding_provider import EmbeddingProvider  # noqa: E402
+
+
+class HashEmbedder(EmbeddingProvider):
+    """同一文本总是得到同一个单位向量"""
+
+    name = 'test-hash'
+
+    def encode_batch(self, texts, batch_size=32):
+        vectors = np.stack([
+            np.random.default_rng(int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16))
+            .standard_normal(self.dims)
+            for text in texts
+        ]).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class FakeVision:
+    """OpenAI 客户端替身：failing 为 True 时图像描述请求抛异常"""
+
+    def __init__(self):
+        self.failing = False
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.calls += 1
+        if self.failing:
+            raise RuntimeError('vision down')
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f'描述 {self.calls}'))])
+
+
+@pytest.fixture
+def ingest_env(tmp_path, monkeypatch):
+    """入库所需的组件与路径全部指向 tmp_path，返回视觉模型替身"""
+    monkeypatch.setattr(VectorStoreConfig, 'backend', 'numpy')
+    monkeypatch.setattr(VectorStoreConfig, 'directory', str(tmp_path / 'vector_store'))
+    monkeypatch.setattr(VectorStoreConfig, 'quantization', 'none')
+    monkeypatch.setattr(DocumentConfig, 'manifest_path', str(tmp_path / 'manifest.json'))
+    monkeypatch.setattr(DocumentConfig, 'caption_cache_path', str(tmp_path / 'captions.jsonl'))
+    vision = FakeVision()
+    # 经 monkeypatch 注入，测试结束后注册表恢复原状
+    monkeypatch.setitem(registry._instances, 'embedder', HashEmbedder())
+    monkeypatch.setitem(registry._instances, 'embedding_cache',
+                        EmbeddingCache(HashEmbedder.name, cache_dir=str(tmp_path / 'embeddings')))
+    monkeypatch.setitem(registry._instances, 'llm', vision)
+    return vision
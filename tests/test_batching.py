@@ -0,0 +1,72 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from batching import MicroBatcher
+
+
+def test_results_are_split_back_per_call():
+    batcher = MicroBatcher(lambda items: [item * 2 for item in items], max_batch=8)
+    assert batcher([1, 2, 3]) == [2, 4, 6]
+    assert batcher([]) == []
+
+
+def test_concurrent_calls_are_merged():
+    sizes = []
+    release = threading.Event()
+
+    def fn(items):
+        sizes.append(len(items))
+        release.wait(5)
+        return [item + 1 for item in items]
+
+    batcher = MicroBatcher(fn, max_batch=16)
+    first = batcher.submit([0])
+    time.sleep(0.05)
+    # 唯一的 worker 正忙，后续请求在队列中积累
+    futures = [batcher.submit([i]) for i in range(1, 6)]
+    time.sleep(0.05)
+    release.set()
+    assert first.result(5) == [1]
+    assert [future.result(5) for future in futures] == [[i + 1] for i in range(1, 6)]
+    assert sizes == [1, 5]
+
+
+def test_batch_size_is_capped():
+    sizes = []
+    gate = threading.Event()
+
+    def fn(items):
+        sizes.append(len(items))
+        gate.wait(5)
+        return items
+
+    batcher = MicroBatcher(fn, max_batch=4)
+    busy = batcher.submit([0])
+    time.sleep(0.05)
+    futures = [batcher.submit([i]) for i in range(10)]
+    time.sleep(0.05)
+    gate.set()
+    busy.result(5)
+    for future in futures:
+        future.result(5)
+    assert sizes[0] == 1
+    assert max(sizes[1:]) <= 4
+    assert sum(sizes[1:]) == 10
+
+
+def test_errors_reach_every_caller_in_the_batch():
+    def fn(items):
+        raise RuntimeError('model failed')
+
+    batcher = MicroBatcher(fn, max_batch=8)
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(batcher, [i]) for i in range(4)]
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result(5)
+    # 出错后 worker 仍可继续处理
+    batcher.fn = lambda items: items
+    assert batcher(['ok']) == ['ok']
@@ -0,0 +1,71 @@
+import pytest
+
+from chunker import Tokenizer
+from context_builder import ContextBuilder, merge_overlapping
+
+
+@pytest.fixture
+def builder():
+    # 正则近似计数：不依赖 tiktoken 编码文件
+    tokenizer = Tokenizer(encoding_name='unavailable')
+    assert tokenizer.name == 'regex'
+    return ContextBuilder(budget=60, dedup_threshold=0.85, min_chunk_tokens=5, tokenizer=tokenizer)
+
+
+def chunk(text, index=None, page=1, source='a.pdf'):
+    return {'text': text, 'source': source, 'page': page, 'type': 'text', 'chunk_index': index}
+
+
+def words(start, stop):
+    return ' '.join(f'w{i}' for i in range(start, stop))
+
+
+def test_merge_overlapping_removes_the_shared_part():
+    assert merge_overlapping('alpha beta gamma', 'beta gamma delta') == 'alpha beta gamma delta'
+    assert merge_overlapping('alpha beta', 'gamma delta') is None
+    assert merge_overlapping('alpha beta gamma', 'beta') == 'alpha beta gamma'
+
+
+def test_adjacent_chunks_merge_in_page_order(builder):
+    groups, stats = builder.pack([chunk(words(5, 12), 1), chunk(words(0, 7), 0)])
+    assert len(groups) == 1
+    assert groups[0]['text'] == words(0, 12)
+    assert (groups[0]['first'], groups[0]['last']) == (0, 1)
+    assert stats['merged'] == 1
+
+
+def test_chunk_filling_a_gap_joins_both_groups(builder):
+    groups, _ = builder.pack([chunk(words(0, 4), 0), chunk(words(8, 12), 2), chunk(words(4, 8), 1)])
+    assert [group['text'] for group in groups] == [words(0, 4) + '\n' + words(4, 8) + '\n' + words(8, 12)]
+
+
+def test_other_pages_are_not_merged(builder):
+    groups, _ = builder.pack([chunk(words(0, 4), 0), chunk(words(4, 8), 1, page=2)])
+    assert len(groups) == 2
+
+
+def test_near_duplicates_are_dropped(builder):
+    groups, stats = builder.pack([chunk(words(0, 20), source='a.pdf'), chunk(words(0, 20), source='b.pdf')])
+    assert len(groups) == 1
+    assert stats['duplicates'] == 1
+
+
+def test_budget_truncates_then_skips(builder):
+    docs = [chunk(words(0, 30), source='a.pdf'), chunk(words(100, 140), source='b.pdf'),
+            chunk(words(200, 240), source='c.pdf')]
+    builder.budget = 100
+    groups, stats = builder.pack(docs)
+    assert stats['context_tokens'] <= builder.budget
+    assert [group['source'] for group in groups] == ['a.pdf', 'b.pdf']
+    assert groups[0]['text'] == words(0, 30)
+    assert stats['truncated'] == 1
+    assert stats['skipped'] == 1
+
+
+def test_build_messages_reports_prompt_tokens(builder):
+    report = {}
+    messages = builder.build_messages('问题', [chunk(words(0, 5))], report)
+    assert [message['role'] for message in messages] == ['system', 'user']
+    assert '[文档1] (来源: a.pdf, 第1页, 类型: text)' in messages[1]['content']
+    assert report['chunks'] == 1
+    assert report['prompt_tokens'] > report['context_tokens'] > 0
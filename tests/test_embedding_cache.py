@@ -0,0 +1,59 @@
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+
+class CountingEncoder:
+    def __init__(self, dim=4):
+        self.dim = dim
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return np.array([[len(text)] * self.dim for text in texts], dtype=np.float32)
+
+
+def test_only_missing_texts_are_encoded_once(tmp_path):
+    cache = EmbeddingCache('model', cache_dir=str(tmp_path))
+    encoder = CountingEncoder()
+    vectors = cache.encode(['a', 'bb', 'a'], encoder)
+    assert encoder.calls == [['a', 'bb']]
+    assert vectors[:, 0].tolist() == [1, 2, 1]
+
+    vectors = cache.encode(['bb', 'ccc'], encoder)
+    assert encoder.calls[1:] == [['ccc']]
+    assert vectors[:, 0].tolist() == [2, 3]
+    assert cache.stats()['memory_hits'] == 1
+
+
+def test_vectors_persist_on_disk(tmp_path):
+    first = EmbeddingCache('model', cache_dir=str(tmp_path))
+    first.encode(['a', 'bb'], CountingEncoder())
+
+    encoder = CountingEncoder()
+    second = EmbeddingCache('model', cache_dir=str(tmp_path))
+    vectors = second.encode(['bb', 'a'], encoder)
+    assert encoder.calls == []
+    assert vectors[:, 0].tolist() == [2, 1]
+    assert second.stats()['disk_hits'] == 2
+
+
+def test_models_do_not_share_vectors(tmp_path):
+    EmbeddingCache('model-a', cache_dir=str(tmp_path)).encode(['a'], CountingEncoder())
+    encoder = CountingEncoder()
+    EmbeddingCache('model-b', cache_dir=str(tmp_path)).encode(['a'], encoder)
+    assert encoder.calls == [['a']]
+
+
+def test_uncacheable_results_are_not_stored(tmp_path):
+    cache = EmbeddingCache('model', cache_dir=str(tmp_path))
+    encoder = CountingEncoder()
+    cache.encode(['a'], encoder, cacheable=lambda: False)
+    cache.encode(['a'], encoder)
+    assert encoder.calls == [['a'], ['a']]
+
+
+def test_memory_layer_is_bounded(tmp_path):
+    cache = EmbeddingCache('model', cache_dir=str(tmp_path), max_items=2)
+    cache.encode(['a', 'bb', 'ccc'], CountingEncoder())
+    assert cache.stats()['memory_items'] == 2
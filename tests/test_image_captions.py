@@ -0,0 +1,48 @@
+import pytest
+
+from benchmark import make_corpus
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    directory = str(tmp_path / 'pdfs')
+    make_corpus(directory, 2, 2, images_per_page=2)
+    return directory
+
+
+def image_docs(store):
+    return [meta for row, meta in enumerate(store.metadata)
+            if row not in store.deleted and meta['content_type'] == 'image']
+
+
+def test_failed_captions_are_retried_on_next_ingest(ingest_env, corpus):
+    from pdf_rag import PDFProcessor
+
+    ingest_env.failing = True
+    with PDFProcessor('docs') as processor:
+        processor.captioner.max_retries = 0
+        assert processor.process_directory(corpus) > 0
+        failed = processor.last_stats.caption_failed
+        assert failed == {(f'doc_{d:04d}.pdf', page) for d in range(2) for page in (1, 2)}
+        # 占位描述带图像序号：同一页的多张失败图像各自入库
+        placeholders = image_docs(processor.store)
+        assert len({(meta['source'], meta['page'], meta['text']) for meta in placeholders}) == 2 * 2 * 3
+        # 页未记录指纹，下次入库仍要处理
+        pages = processor.manifest.document('docs', 'doc_0000.pdf')['pages']
+        assert {entry['fingerprint'] for entry in pages.values()} == {None}
+
+    ingest_env.failing = False
+    calls = ingest_env.calls
+    with PDFProcessor('docs') as processor:
+        assert processor.process_directory(corpus) > 0
+        assert ingest_env.calls > calls
+        assert not processor.last_stats.caption_failed
+        captions = image_docs(processor.store)
+        assert len(captions) == 2 * 2 * 3
+        assert all(meta['text'].startswith('图像描述: 描述') for meta in captions)
+
+    calls = ingest_env.calls
+    with PDFProcessor('docs') as processor:
+        assert processor.process_directory(corpus) == 0
+        assert ingest_env.calls == calls
+
@@ -0,0 +1,117 @@
+import os
+
+import fitz
+import pytest
+
+from benchmark import make_corpus
+from ingest_manifest import IngestManifest, chunk_id, file_fingerprint
+
+
+def doc(text, page=1, source='a.pdf', content_type='text'):
+    return {'source': source, 'page': page, 'content_type': content_type, 'text': text}
+
+
+def test_chunk_id_depends_on_source_page_type_and_text():
+    base = chunk_id(doc('hello'))
+    assert chunk_id(doc('hello')) == base
+    assert len({
+        base,
+        chunk_id(doc('hello!')),
+        chunk_id(doc('hello', page=2)),
+        chunk_id(doc('hello', source='b.pdf')),
+        chunk_id(doc('hello', content_type='image'))
+    }) == 5
+
+
+def test_file_fingerprint_changes_with_content(tmp_path):
+    path = tmp_path / 'a.bin'
+    path.write_bytes(b'one')
+    first = file_fingerprint(path)
+    path.write_bytes(b'two')
+    assert file_fingerprint(path) != first
+
+
+def test_manifest_pages_round_trip(tmp_path):
+    path = str(tmp_path / 'cache' / 'manifest.json')
+    manifest = IngestManifest(path)
+    manifest.set_doc_hash('docs', 'a.pdf', 'h1')
+    manifest.update_page('docs', 'a.pdf', 1, 'f1', ['c2', 'c1'])
+    manifest.update_page('docs', 'a.pdf', 2, 'f2', ['c3'])
+    manifest.save()
+
+    loaded = IngestManifest(path)
+    assert loaded.document('docs', 'a.pdf') == {
+        'doc_hash': 'h1',
+        'pages': {'1': {'fingerprint': 'f1', 'chunk_ids': ['c1', 'c2']},
+                  '2': {'fingerprint': 'f2', 'chunk_ids': ['c3']}}
+    }
+    assert loaded.remove_page('docs', 'a.pdf', 1) == ['c1', 'c2']
+    assert loaded.remove_page('docs', 'a.pdf', 1) == []
+    assert loaded.remove_document('docs', 'a.pdf') == ['c3']
+    assert loaded.remove_document('docs', 'a.pdf') == []
+    assert loaded.document('docs', 'a.pdf') is None
+
+
+def test_forget_index_only_drops_that_index(tmp_path):
+    manifest = IngestManifest(str(tmp_path / 'manifest.json'))
+    manifest.update_page('a', 'x.pdf', 1, 'f', ['c'])
+    manifest.update_page('b', 'x.pdf', 1, 'f', ['c'])
+    manifest.forget_index('a')
+    assert manifest.documents('a') == {}
+    assert manifest.document('b', 'x.pdf') is not None
+
+
+def edit_page(path, page_num, text):
+    """在指定页追加一段文字，其余页保持不变"""
+    with fitz.open(path) as pdf:
+        pdf[page_num - 1].insert_text((50, 40), text, fontsize=9)
+        data = pdf.tobytes()
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    directory = str(tmp_path / 'pdfs')
+    make_corpus(directory, 2, 3, images_per_page=0)
+    return directory
+
+
+def test_plan_updates_only_lists_changed_pages(ingest_env, corpus):
+    from pdf_rag import PDFProcessor
+
+    paths = sorted(os.path.join(corpus, name) for name in os.listdir(corpus))
+    with PDFProcessor('docs') as processor:
+        plans = processor.plan_updates(paths)
+        assert [plans[path][2] for path in paths] == [[1, 2, 3], [1, 2, 3]]
+        assert processor.process_directory(corpus) > 0
+        assert processor.plan_updates(paths) == {}
+
+        edit_page(paths[0], 2, 'revised paragraph')
+        plans = processor.plan_updates(paths)
+        assert list(plans) == [paths[0]]
+        assert plans[paths[0]][2] == [2]
+
+
+def test_reingest_replaces_chunks_of_changed_page(ingest_env, corpus):
+    from pdf_rag import PDFProcessor
+
+    path = os.path.join(corpus, 'doc_0000.pdf')
+    with PDFProcessor('docs') as processor:
+        processor.process_directory(corpus)
+        old_ids = set(processor.manifest.document('docs', 'doc_0000.pdf')['pages']['2']['chunk_ids'])
+        size = len(processor.store)
+
+        edit_page(path, 2, 'revised paragraph')
+        processor.process_directory(corpus)
+        new_ids = set(processor.manifest.document('docs', 'doc_0000.pdf')['pages']['2']['chunk_ids'])
+        assert new_ids != old_ids
+        assert not (old_ids - new_ids) & set(processor.store.rows)
+        assert new_ids <= set(processor.store.rows)
+        assert len(processor.store) == size - len(old_ids - new_ids) + len(new_ids - old_ids)
+
+        # 删除的文件整篇从索引移除
+        os.remove(path)
+        processor.process_directory(corpus)
+        assert processor.manifest.document('docs', 'doc_0000.pdf') is None
+        assert not new_ids & set(processor.store.rows)
@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+from benchmark import make_corpus
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    directory = str(tmp_path / 'pdfs')
+    make_corpus(directory, 2, 2, images_per_page=1)
+    return directory
+
+
+def test_rebuild_keeps_every_document(ingest_env, corpus):
+    from pdf_rag import PDFProcessor
+
+    with PDFProcessor('docs') as processor:
+        processor.process_directory(corpus)
+        ids = set(processor.store.rows)
+    calls = ingest_env.calls
+    with PDFProcessor('docs', rebuild=True) as processor:
+        # 只用一个文件重建会丢掉其余文档
+        with pytest.raises(ValueError):
+            processor.process_pdf(os.path.join(corpus, 'doc_0000.pdf'))
+        processor.process_directory(corpus)
+        assert set(processor.store.rows) == ids
+        assert set(processor.manifest.documents('docs')) == {'doc_0000.pdf', 'doc_0001.pdf'}
+    # 图像描述来自缓存
+    assert ingest_env.calls == calls
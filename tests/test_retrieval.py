@@ -0,0 +1,43 @@
+import pytest
+
+from config import RetrievalConfig
+from retrieval import reciprocal_rank_fusion
+
+
+def hits(*ids, source='knn'):
+    return [{'id': doc_id, 'source': source} for doc_id in ids]
+
+
+def test_scores_are_sum_of_reciprocal_ranks():
+    fused = reciprocal_rank_fusion([hits('a', 'b', 'c'), hits('b', 'd')], k=60)
+    scores = {hit['id']: score for score, hit in fused}
+    assert scores == pytest.approx({
+        'a': 1 / 61,
+        'b': 1 / 62 + 1 / 61,
+        'c': 1 / 63,
+        'd': 1 / 62
+    })
+    assert [hit['id'] for _, hit in fused] == ['b', 'a', 'd', 'c']
+
+
+def test_documents_in_both_lists_beat_a_single_top_rank():
+    fused = reciprocal_rank_fusion([hits('a', 'b'), hits('c', 'b')], k=60)
+    assert fused[0][1]['id'] == 'b'
+
+
+def test_first_occurrence_of_a_document_is_kept():
+    fused = reciprocal_rank_fusion([hits('a', source='bm25'), hits('a', source='knn')])
+    assert len(fused) == 1
+    assert fused[0][1]['source'] == 'bm25'
+
+
+def test_default_k_and_custom_key(monkeypatch):
+    monkeypatch.setattr(RetrievalConfig, 'rrf_k', 1)
+    docs = [{'text': 'x'}, {'text': 'y'}]
+    fused = reciprocal_rank_fusion([docs, docs[::-1]], key=lambda hit: hit['text'])
+    assert [score for score, _ in fused] == pytest.approx([1 / 2 + 1 / 3] * 2)
+
+
+def test_empty_input():
+    assert reciprocal_rank_fusion([]) == []
+    assert reciprocal_rank_fusion([[], []]) == []
@@ -0,0 +1,130 @@
+import math
+
+import numpy as np
+import pytest
+
+from config import VectorStoreConfig
+from vector_store import HNSWVectorStore, NumpyVectorStore, synthetic_vectors
+
+DIMS = 32
+STORES = [NumpyVectorStore, HNSWVectorStore]
+
+
+def open_store(cls, directory, **kwargs):
+    return cls(str(directory), DIMS, quantization='none', **kwargs)
+
+
+def filled(cls, directory, num=300, **kwargs):
+    store = open_store(cls, directory, **kwargs)
+    store.create()
+    vectors = synthetic_vectors(num, DIMS, clusters=20)
+    store.upsert([f'd{i}' for i in range(num)], vectors, [{'n': i} for i in range(num)])
+    return store, vectors
+
+
+@pytest.mark.parametrize('cls', STORES)
+def test_search_finds_the_stored_vector(cls, tmp_path):
+    store, vectors = filled(cls, tmp_path)
+    hits = store.search(vectors[7], 5)
+    assert hits[0]['id'] == 'd7'
+    assert hits[0]['metadata'] == {'n': 7}
+    assert hits[0]['score'] == pytest.approx(1.0, abs=1e-5)
+    assert [hit['score'] for hit in hits] == sorted((hit['score'] for hit in hits), reverse=True)
+
+
+@pytest.mark.parametrize('cls', STORES)
+def test_upsert_overwrites_existing_id(cls, tmp_path):
+    store, vectors = filled(cls, tmp_path)
+    store.upsert(['d7'], vectors[8:9], [{'n': 'moved'}])
+    assert len(store) == 300
+    hits = store.search(vectors[8], 2)
+    assert {hit['id'] for hit in hits} == {'d7', 'd8'}
+    assert store.search(vectors[7], 1)[0]['id'] != 'd7'
+
+
+@pytest.mark.parametrize('cls', STORES)
+def test_deleted_ids_are_not_returned(cls, tmp_path):
+    store, vectors = filled(cls, tmp_path)
+    store.delete(['d7', 'missing'])
+    assert len(store) == 299
+    assert 'd7' not in [hit['id'] for hit in store.search(vectors[7], 10)]
+
+
+@pytest.mark.parametrize('cls', STORES)
+def test_flush_and_reopen(cls, tmp_path):
+    store, vectors = filled(cls, tmp_path)
+    store.delete(['d1'])
+    store.flush()
+    reopened = open_store(cls, tmp_path)
+    assert len(reopened) == 299
+    assert reopened.search(vectors[7], 1)[0]['id'] == 'd7'
+    assert 'd1' not in [hit['id'] for hit in reopened.search(vectors[1], 10)]
+    # memmap 加载后仍可继续写入
+    reopened.upsert(['new'], vectors[1:2], [{}])
+    assert reopened.search(vectors[1], 1)[0]['id'] == 'new'
+
+
+@pytest.mark.parametrize('cls', STORES)
+def test_flush_compacts_many_deletions(cls, tmp_path):
+    store, vectors = filled(cls, tmp_path)
+    store.delete([f'd{i}' for i in range(0, 300, 2)])
+    store.flush()
+    assert store.size == len(store) == 150
+    assert not store.deleted
+    assert store.search(vectors[9], 1)[0]['id'] == 'd9'
+    assert open_store(cls, tmp_path).search(vectors[9], 1)[0]['id'] == 'd9'
+
+
+@pytest.mark.parametrize('cls', STORES)
+def test_reader_reloads_after_another_writer_flushes(cls, tmp_path, monkeypatch):
+    monkeypatch.setattr(VectorStoreConfig, 'reload_check_interval', 0)
+    writer, vectors = filled(cls, tmp_path)
+    writer.flush()
+    reader = open_store(cls, tmp_path)
+    assert len(reader) == 300
+
+    extra = synthetic_vectors(1, DIMS, seed=5)
+    writer.upsert(['late'], extra, [{}])
+    writer.flush()
+    assert reader.search(extra[0], 1)[0]['id'] == 'late'
+    assert len(reader) == 301
+
+
+def test_opening_the_wrong_kind_fails(tmp_path):
+    filled(NumpyVectorStore, tmp_path)[0].flush()
+    with pytest.raises(ValueError):
+        open_store(HNSWVectorStore, tmp_path)
+
+
+def test_hnsw_recall_against_exact_search(tmp_path):
+    exact, vectors = filled(NumpyVectorStore, tmp_path / 'exact', num=1000)
+    approx, _ = filled(HNSWVectorStore, tmp_path / 'hnsw', num=1000)
+    queries = synthetic_vectors(50, DIMS, clusters=20, seed=3)
+    found = total = 0
+    for query in queries:
+        truth = {hit['id'] for hit in exact.search(query, 10)}
+        found += len(truth & {hit['id'] for hit in approx.search(query, 10, ef=100)})
+        total += len(truth)
+    assert found / total >= 0.9
+
+
+def test_hnsw_keeps_graph_parameters_of_saved_store(tmp_path):
+    store, vectors = filled(HNSWVectorStore, tmp_path, m=8)
+    store.flush()
+    reopened = open_store(HNSWVectorStore, tmp_path, m=32)
+    assert reopened.m == 8
+    assert reopened.level_mult == pytest.approx(1 / math.log(8))
+    assert reopened.graph0.shape[1] == reopened.m0 == 16
+    reopened.upsert(['new'], synthetic_vectors(1, DIMS, seed=9), [{}])
+    assert reopened.graph0.shape[1] == 16
+
+
+def test_hnsw_resizes_graph0_of_different_width(tmp_path):
+    store, vectors = filled(HNSWVectorStore, tmp_path, m=8)
+    store.flush()
+    graph0 = np.load(tmp_path / 'graph0.npy')
+    np.save(tmp_path / 'graph0.npy', np.pad(graph0, ((0, 0), (0, 8)), constant_values=-1))
+    reopened = open_store(HNSWVectorStore, tmp_path)
+    assert reopened.graph0.shape[1] == 16
+    assert (np.sort(reopened.graph0, axis=1) == np.sort(graph0, axis=1)).all()
+    assert reopened.search(vectors[7], 1)[0]['id'] == 'd7'
@@ -0,0 +1,855 @@
+"""
+可插拔的向量存储
+- ElasticsearchVectorStore: 现有的 Elasticsearch 索引
+- NumpyVectorStore: 本地精确检索（float32 矩阵乘法求余弦相似度）
+- HNSWVectorStore: 本地近似检索（HNSW 图索引）
+本地存储以 .npy 文件持久化，加载时以 memmap 方式映射，不需要 Elasticsearch
+
+VECTOR_QUANTIZATION=int8/binary 时检索先在量化码上粗排，再用 float 向量对候选精排；
+对比各量化方式的召回率、延迟与内存: python vector_store.py [--vectors 存储目录]
+"""
+import heapq
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from config import EMBEDDING_DIMS, VectorStoreConfig
+from index_manager import ES_INDEX_TYPES, IndexManager
+
+
+# 本地存储的多路检索共用的线程池（NumPy 矩阵乘法会释放 GIL）
+_search_pool = ThreadPoolExecutor(max_workers=8)
+
+_SCORE_BLOCK = 512   # 量化码分块打分，限制转换为 float 的临时内存
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class VectorStore:
+    """向量存储接口"""
+
+    # 是否支持 BM25 全文检索（混合检索需要）
+    supports_text_search = False
+
+    def exists(self):
+        raise NotImplementedError
+
+    def create(self):
+        raise NotImplementedError
+
+    def drop(self):
+        raise NotImplementedError
+
+    def upsert(self, ids, vectors, metadata):
+        """写入/覆盖向量，返回 [(ID, 错误)]"""
+        raise NotImplementedError
+
+    def delete(self, ids):
+        raise NotImplementedError
+
+    def search(self, query_vector, top_k):
+        """返回按相似度降序的 [{'id', 'score', 'metadata'}]"""
+        raise NotImplementedError
+
+    def multi_search(self, query_vectors, size, text_queries=()):
+        """并发执行多个检索
+
+        返回 (每个向量的 kNN 命中, 每个文本的 BM25 命中, {'knn': [毫秒], 'bm25': [毫秒]})
+        """
+        if text_queries:
+            raise ValueError("该向量存储不支持 BM25 检索")
+
+        def timed_search(vector):
+            started = time.perf_counter()
+            hits = self.search(vector, size)
+            return hits, (time.perf_counter() - started) * 1000
+
+        results = list(_search_pool.map(timed_search, query_vectors))
+        return [hits for hits, _ in results], [], {'knn': [ms for _, ms in results], 'bm25': []}
+
+    def flush(self):
+        """使写入可见/落盘"""
+
+    def check_schema(self):
+        """打开已有索引时调用：与当前配置（向量维度等）不兼容则抛出 ValueError"""
+
+    def rebuild(self, populate):
+        """清空后调用 populate() 全量写入；默认先删除再创建，重建期间检索不到旧数据"""
+        self.drop()
+        self.create()
+        populate()
+
+    def generation(self):
+        """当前入库版本；重新入库后会变化（用于让答案缓存失效）"""
+        return None
+
+    def bump_generation(self):
+        """入库完成后调用，标记索引内容已变化"""
+
+
+def check_quantization(quantization):
+    if quantization not in ES_INDEX_TYPES:
+        raise ValueError(f"未知的量化方式: {quantization}")
+    return quantization
+
+
+class ElasticsearchVectorStore(VectorStore):
+    """Elasticsearch dense_vector 索引；mapping 与索引生命周期由 IndexManager 管理"""
+
+    supports_text_search = True
+
+    def __init__(self, es, index_name, dims=EMBEDDING_DIMS, quantization=None):
+        self.es = es
+        self.index_name = index_name
+        self.dims = dims
+        self.quantization = check_quantization(quantization or VectorStoreConfig.quantization)
+        self.oversample = VectorStoreConfig.rescore_oversample.get(self.quantization, 1)
+        self.indices = IndexManager(es, dims, self.quantization)
+        # 写入目标：平时是别名本身，rebuild 期间是尚未对外的新物理索引
+        self.write_index = index_name
+
+    def exists(self):
+        return self.indices.index_exists(self.index_name)
+
+    def create(self):
+        if not self.indices.create_index(self.index_name):
+            raise RuntimeError(f"索引创建失败: {self.index_name}")
+
+    def drop(self):
+        self.indices.delete_index(self.index_name)
+
+    def check_schema(self):
+        self.indices.check_index(self.index_name)
+
+    def rebuild(self, populate):
+        """写入新的物理索引（暂停刷新、无副本），完成后原子切换别名；重建期间检索仍命中旧索引"""
+        def fill(physical):
+            self.write_index = physical
+            try:
+                populate()
+            finally:
+                self.write_index = self.index_name
+        self.indices.reindex(self.index_name, populate=fill)
+
+    def upsert(self, ids, vectors, metadata):
+        operations = []
+        for doc_id, vector, meta in zip(ids, vectors, metadata):
+            operations.append({"index": {"_index": self.write_index, "_id": doc_id}})
+            operations.append({**meta, 'embedding': np.asarray(vector).tolist()})
+        try:
+            response = self.es.bulk(operations=operations)
+        except Exception as e:
+            return [(doc_id, str(e)) for doc_id in ids]
+
+        errors = []
+        for item in response['items']:
+            result = next(iter(item.values()))
+            if 'error' in result:
+                errors.append((result.get('_id'), result['error']))
+        return errors
+
+    def delete(self, ids):
+        operations = [{"delete": {"_index": self.write_index, "_id": doc_id}} for doc_id in ids]
+        if operations:
+            self.es.bulk(operations=operations)
+
+    def _knn(self, query_vector, k, num_candidates):
+        knn = {
+            "field": "embedding",
+            "query_vector": np.asarray(query_vector).tolist(),
+            "k": k,
+            "num_candidates": max(num_candidates, k)
+        }
+        if self.quantization != 'none':
+            # 每个分片取 k × oversample 个量化候选，再用原始 float 向量重打分
+            knn["rescore_vector"] = {"oversample": self.oversample}
+        return knn
+
+    def search(self, query_vector, top_k, num_candidates=50):
+        result = self.es.search(
+            index=self.index_name,
+            knn=self._knn(query_vector, top_k, num_candidates),
+            source_excludes=["embedding"]
+        )
+        return self._hits(result)
+
+    def _hits(self, response):
+        return [
+            {'id': hit['_id'], 'score': hit['_score'], 'metadata': hit['_source']}
+            for hit in response['hits']['hits']
+        ]
+
+    def msearch_body(self, query_vectors, size, text_queries=(), num_candidates=50):
+        """BM25 与 kNN 检索组成的 _msearch 请求体（同步/异步客户端共用）"""
+        header = {"index": self.index_name}
+        searches = []
+        for text in text_queries:
+            searches += [header, {
+                "query": {"match": {"text": text}},
+                "size": size,
+                "_source": {"excludes": ["embedding"]}
+            }]
+        for vector in query_vectors:
+            searches += [header, {
+                "knn": self._knn(vector, size, num_candidates),
+                "size": size,
+                "_source": {"excludes": ["embedding"]}
+            }]
+        return searches
+
+    def parse_msearch(self, result, num_text_queries):
+        """拆分 _msearch 响应，返回值同 multi_search；延迟取自各子响应的 took"""
+        responses = result['responses']
+        for response in responses:
+            if 'error' in response:
+                raise RuntimeError(f"检索失败: {response['error']}")
+        bm25_responses = responses[:num_text_queries]
+        knn_responses = responses[num_text_queries:]
+        latencies = {
+            'bm25': [r['took'] for r in bm25_responses],
+            'knn': [r['took'] for r in knn_responses]
+        }
+        return (
+            [self._hits(r) for r in knn_responses],
+            [self._hits(r) for r in bm25_responses],
+            latencies
+        )
+
+    def multi_search(self, query_vectors, size, text_queries=(), num_candidates=50):
+        """所有 BM25 与 kNN 检索合并为一个 _msearch 请求，由 ES 并发执行"""
+        searches = self.msearch_body(query_vectors, size, text_queries, num_candidates)
+        return self.parse_msearch(self.es.msearch(searches=searches), len(text_queries))
+
+    def flush(self):
+        self.es.indices.refresh(index=self.write_index)
+
+    def _meta(self):
+        # 别名解析到物理索引，返回值以物理索引名为键
+        mapping = self.es.indices.get_mapping(index=self.index_name)
+        return next(iter(mapping.values()))['mappings'].get('_meta', {})
+
+    def generation(self):
+        return self._meta().get('ingest_generation')
+
+    def bump_generation(self):
+        # put_mapping 会整体替换 _meta，先读出已有字段再合并
+        meta = {**self._meta(), 'ingest_generation': uuid.uuid4().hex}
+        self.es.indices.put_mapping(index=self.index_name, meta=meta)
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize(vectors, quantization):
+    """归一化向量 -> (量化码, 每行缩放系数)
+
+    int8: 每行按最大绝对值缩放到 [-127, 127]；binary: 每维只保留符号位，按位打包
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if quantization == 'int8':
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    if quantization == 'binary':
+        return np.packbits(vectors > 0, axis=1), np.ones(len(vectors), dtype=np.float32)
+    raise ValueError(f"未知的量化方式: {quantization}")
+
+
+def _popcount(array):
+    if hasattr(np, 'bitwise_count'):   # NumPy 2.0+
+        return np.bitwise_count(array)
+    return _POPCOUNT[array]
+
+
+def approx_scores(codes, scales, query, quantization):
+    """量化码上的近似相似度（越大越相似）：int8 为缩放后的点积，binary 为负汉明距离"""
+    scores = np.empty(len(codes), dtype=np.float32)
+    bits = np.packbits(query > 0) if quantization == 'binary' else None
+    for start in range(0, len(codes), _SCORE_BLOCK):
+        block = np.asarray(codes[start:start + _SCORE_BLOCK])
+        end = start + len(block)
+        if bits is not None:
+            scores[start:end] = -_popcount(block ^ bits).sum(axis=1, dtype=np.int32)
+        else:
+            scores[start:end] = (block.astype(np.float32) @ query) * scales[start:end]
+    return scores
+
+
+def _top_rows(scores, k):
+    """得分最高的 k 行，降序"""
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class LocalVectorStore(VectorStore):
+    """本地存储的公共部分：ID/元数据管理、删除标记和 memmap 持久化"""
+
+    kind = None
+
+    def __init__(self, directory, dims=EMBEDDING_DIMS, quantization=None):
+        self.directory = directory
+        self.dims = dims
+        self.quantization = check_quantization(quantization or VectorStoreConfig.quantization)
+        self.oversample = VectorStoreConfig.rescore_oversample.get(self.quantization, 1)
+        self.lock = threading.RLock()
+        self._generation = None          # 内存中数据对应的 store.json 版本
+        self._reload_checked = time.monotonic()
+        self._reset()
+        if self.exists():
+            self._load()
+
+    def _reset(self):
+        self.ids = []
+        self.metadata = []
+        self.rows = {}
+        self.deleted = set()
+        self.vectors = np.zeros((0, self.dims), dtype=np.float32)
+        self.codes = self.scales = None
+        if self.quantization != 'none':
+            self.codes, self.scales = quantize(self.vectors, self.quantization)
+        self.size = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def exists(self):
+        return os.path.exists(self._path('store.json'))
+
+    def create(self):
+        with self.lock:
+            self._reset()
+            self.flush()
+
+    def drop(self):
+        with self.lock:
+            self._reset()
+            for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+                os.remove(self._path(name))
+
+    def __len__(self):
+        return self.size - len(self.deleted)
+
+    def _writable(self, array, min_rows):
+        """memmap 只读：首次写入时复制到内存，并按需倍增容量"""
+        if isinstance(array, np.memmap) or array.shape[0] < min_rows:
+            capacity = max(min_rows, array.shape[0] * 2, 64)
+            grown = np.full((capacity,) + array.shape[1:], self._fill(array), dtype=array.dtype)
+            grown[:array.shape[0]] = array
+            return grown
+        return array
+
+    @staticmethod
+    def _fill(array):
+        return -1 if array.dtype.kind == 'i' else 0
+
+    def _append(self, doc_id, vector, meta):
+        row = self.size
+        self.vectors = self._writable(self.vectors, row + 1)
+        self.vectors[row] = vector
+        self._set_codes(row, vector)
+        self.ids.append(doc_id)
+        self.metadata.append(meta)
+        self.rows[doc_id] = row
+        self.size += 1
+        return row
+
+    def _set_codes(self, row, vector):
+        if self.codes is None:
+            return
+        codes, scales = quantize(vector[None], self.quantization)
+        self.codes = self._writable(self.codes, row + 1)
+        self.scales = self._writable(self.scales, row + 1)
+        self.codes[row] = codes[0]
+        self.scales[row] = scales[0]
+
+    def delete(self, ids):
+        with self.lock:
+            for doc_id in ids:
+                row = self.rows.pop(doc_id, None)
+                if row is not None:
+                    self.deleted.add(row)
+
+    def _hit(self, row, score, ids=None, metadata=None):
+        ids = self.ids if ids is None else ids
+        metadata = self.metadata if metadata is None else metadata
+        return {'id': ids[row], 'score': float(score), 'metadata': metadata[row]}
+
+    def _rescore(self, vectors, rows, query, top_k):
+        """用 float 向量对量化检索的候选精确重打分，返回 [(行, 相似度)]"""
+        rows = np.asarray(rows, dtype=np.int64)
+        exact = vectors[rows] @ query
+        order = np.argsort(-exact)[:top_k]
+        return [(int(rows[i]), exact[i]) for i in order]
+
+    def memory_bytes(self):
+        """检索时需要扫描的向量字节数：量化后只扫描量化码，float 向量只读候选行"""
+        if self.codes is None:
+            return self.vectors[:self.size].nbytes
+        return self.codes[:self.size].nbytes + self.scales[:self.size].nbytes
+
+    def _save_array(self, name, array):
+        # 写临时文件再替换：正在被 memmap 的旧文件不会被截断
+        tmp_path = self._path(name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(array))
+        os.replace(tmp_path, self._path(name))
+
+    def _add(self, doc_id, vector, meta):
+        """compact() 重建时逐条加入存活的行"""
+        self._append(doc_id, vector, meta)
+
+    def compact(self):
+        """去掉删除标记的行并重建（HNSW 重新建图），行号随之重新编排"""
+        with self.lock:
+            live = [row for row in range(self.size) if row not in self.deleted]
+            vectors = np.array(self.vectors[live])
+            entries = [(self.ids[row], self.metadata[row]) for row in live]
+            self._reset()
+            for (doc_id, meta), vector in zip(entries, vectors):
+                self._add(doc_id, vector, meta)
+
+    def flush(self):
+        with self.lock:
+            # 删除标记过多时先压缩：否则文件只增不减，HNSW 检索也要绕过越来越多的死节点
+            if self.deleted and len(self.deleted) >= VectorStoreConfig.compact_deleted_ratio * self.size:
+                self.compact()
+            os.makedirs(self.directory, exist_ok=True)
+            self._save_array('vectors.npy', self.vectors[:self.size])
+            if self.codes is not None:
+                self._save_array('codes.npy', self.codes[:self.size])
+                self._save_array('scales.npy', self.scales[:self.size])
+            self._save_extra()
+            state = {
+                'kind': self.kind,
+                'dims': self.dims,
+                'quantization': self.quantization,
+                'ids': self.ids,
+                'deleted': sorted(self.deleted),
+                **self._extra_state()
+            }
+            with open(self._path('metadata.jsonl'), 'w', encoding='utf-8') as f:
+                for meta in self.metadata:
+                    f.write(json.dumps(meta, ensure_ascii=False) + '\n')
+            # store.json 最后写入，作为一次完整保存的标记
+            with open(self._path('store.json'), 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            self._generation = self.generation()
+
+    def generation(self):
+        # 每次 flush 都会重写 store.json
+        return os.stat(self._path('store.json')).st_mtime_ns if self.exists() else None
+
+    def reload_if_changed(self):
+        """另一进程重新入库（store.json 被重写）后重新加载，查询进程无需重启；
+        每 reload_check_interval 秒最多检查一次，检索前调用"""
+        now = time.monotonic()
+        if now - self._reload_checked < VectorStoreConfig.reload_check_interval:
+            return
+        self._reload_checked = now
+        generation = self.generation()
+        if generation is None or generation == self._generation:
+            return
+        with self.lock:
+            if generation == self._generation:
+                return
+            state = dict(self.__dict__)
+            try:
+                self._reset()
+                self._load()
+            except (OSError, ValueError, KeyError):
+                # 对方正在写入：保留旧数据，下次再试
+                self.__dict__.update(state)
+
+    def _load(self):
+        self._generation = self.generation()
+        with open(self._path('store.json'), encoding='utf-8') as f:
+            state = json.load(f)
+        if state['kind'] != self.kind:
+            raise ValueError(f"{self.directory} 是 {state['kind']} 存储，不能以 {self.kind} 打开")
+        if state['dims'] != self.dims:
+            raise ValueError(f"存储维度 {state['dims']} 与模型维度 {self.dims} 不一致")
+        self.ids = state['ids']
+        self.size = len(self.ids)
+        self.deleted = set(state['deleted'])
+        self.rows = {doc_id: row for row, doc_id in enumerate(self.ids) if row not in self.deleted}
+        with open(self._path('metadata.jsonl'), encoding='utf-8') as f:
+            self.metadata = [json.loads(line) for line in f]
+        self.vectors = np.load(self._path('vectors.npy'), mmap_mode='r')
+        if self.quantization != 'none':
+            if state.get('quantization') == self.quantization:
+                self.codes = np.load(self._path('codes.npy'), mmap_mode='r')
+                self.scales = np.load(self._path('scales.npy'), mmap_mode='r')
+            else:
+                # 量化方式变了：由 float 向量重新生成量化码，无需重新入库
+                self.codes, self.scales = quantize(self.vectors, self.quantization)
+        self._load_extra(state)
+
+    def _save_extra(self):
+        pass
+
+    def _extra_state(self):
+        return {}
+
+    def _load_extra(self, state):
+        pass
+
+
+class NumpyVectorStore(LocalVectorStore):
+    """精确检索：归一化后的 float32 矩阵与查询向量做一次矩阵乘法"""
+
+    kind = 'numpy'
+
+    def upsert(self, ids, vectors, metadata):
+        vectors = _normalize(vectors)
+        with self.lock:
+            for doc_id, vector, meta in zip(ids, vectors, metadata):
+                row = self.rows.get(doc_id)
+                if row is None:
+                    self._append(doc_id, vector, meta)
+                else:
+                    self.vectors = self._writable(self.vectors, self.size)
+                    self.vectors[row] = vector
+                    self._set_codes(row, vector)
+                    self.metadata[row] = meta
+        return []
+
+    def search(self, query_vector, top_k):
+        query = _normalize(query_vector)
+        self.reload_if_changed()
+        # 只在取快照时持锁，矩阵乘法可与其它检索并发
+        with self.lock:
+            vectors, codes, scales = self.vectors, self.codes, self.scales
+            size, deleted = self.size, list(self.deleted)
+            # compact() 会换成新的列表并重排行号，这里持有旧列表即可保持一致
+            ids, metadata = self.ids, self.metadata
+        if codes is None:
+            scores = vectors[:size] @ query
+        else:
+            scores = approx_scores(codes[:size], scales[:size], query, self.quantization)
+        if deleted:
+            scores[deleted] = -np.inf
+        k = min(top_k, size - len(deleted))
+        if k <= 0:
+            return []
+        if codes is None:
+            return [self._hit(row, scores[row], ids, metadata) for row in _top_rows(scores, k)]
+        # 量化码粗排取 k × oversample 个候选，float 向量精排
+        candidates = _top_rows(scores, min(k * self.oversample, size - len(deleted)))
+        return [self._hit(row, score, ids, metadata)
+                for row, score in self._rescore(vectors, candidates, query, k)]
+
+
+class HNSWVectorStore(LocalVectorStore):
+    """HNSW 近似检索
+
+    第 0 层邻接表为定长 int32 矩阵（-1 填充），与向量一起 memmap 加载；
+    上层节点很少，保存在 JSON 中。删除只打标记，节点仍参与图遍历，直到 flush() 时压缩；
+    覆盖写入在原节点上更新向量与邻居，不产生删除标记
+    """
+
+    kind = 'hnsw'
+
+    def __init__(self, directory, dims=EMBEDDING_DIMS, m=None, ef_construction=None,
+                 ef_search=None, quantization=None):
+        self.m = m or VectorStoreConfig.hnsw_m
+        self.m0 = 2 * self.m
+        self.ef_construction = ef_construction or VectorStoreConfig.hnsw_ef_construction
+        self.ef_search = ef_search or VectorStoreConfig.hnsw_ef_search
+        self.level_mult = 1 / math.log(self.m)
+        self.rng = random.Random(42)
+        super().__init__(directory, dims, quantization)
+
+    def _reset(self):
+        super()._reset()
+        self.graph0 = np.full((0, 2 * self.m), -1, dtype=np.int32)
+        self.upper = {}          # {节点: [第1层邻居, 第2层邻居, ...]}
+        self.entry_point = None
+        self.max_level = -1
+
+    # ---- 图操作 ----
+
+    def _neighbors(self, node, level):
+        if level == 0:
+            row = self.graph0[node]
+            return row[row >= 0].tolist()
+        return self.upper[node][level - 1]
+
+    def _set_neighbors(self, node, level, neighbors):
+        # 整行/整个列表一次替换：锁外遍历的检索不会看到写了一半的邻居表
+        if level == 0:
+            self.graph0 = self._writable(self.graph0, self.size)
+            row = np.full(self.graph0.shape[1], -1, dtype=np.int32)
+            row[:len(neighbors)] = neighbors
+            self.graph0[node] = row
+        else:
+            self.upper[node][level - 1] = list(neighbors)
+
+    def _similarity(self, query, nodes):
+        return self.vectors[nodes] @ query
+
+    def _approx_similarity(self, query, nodes):
+        return approx_scores(self.codes[nodes], self.scales[nodes], query, self.quantization)
+
+    def _search_layer(self, query, entry_points, ef, level, similarity=None, neighbors=None):
+        """在单层图上做贪心 best-first 搜索，返回 [(相似度, 节点)]，降序
+
+        similarity / neighbors 默认读当前的图；检索时传入快照上的版本
+        """
+        similarity = similarity or self._similarity
+        neighbors = neighbors or self._neighbors
+        visited = set(entry_points)
+        sims = similarity(query, entry_points)
+        candidates = [(-s, n) for s, n in zip(sims.tolist(), entry_points)]
+        results = [(s, n) for s, n in zip(sims.tolist(), entry_points)]
+        heapq.heapify(candidates)
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            neg_sim, node = heapq.heappop(candidates)
+            if -neg_sim < results[0][0] and len(results) >= ef:
+                break
+            fresh = [n for n in neighbors(node, level) if n not in visited]
+            if not fresh:
+                continue
+            visited.update(fresh)
+            for sim, n in zip(similarity(query, fresh).tolist(), fresh):
+                if len(results) < ef or sim > results[0][0]:
+                    heapq.heappush(candidates, (-sim, n))
+                    heapq.heappush(results, (sim, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def _greedy_descent(self, query, target_level, similarity=None, neighbors=None, start=None):
+        """从入口点逐层贪心下降到 target_level；start 为快照的 (入口点, 最高层)"""
+        entry_point, max_level = start or (self.entry_point, self.max_level)
+        entry = [entry_point]
+        for level in range(max_level, target_level, -1):
+            entry = [self._search_layer(query, entry, 1, level, similarity, neighbors)[0][1]]
+        return entry
+
+    def _link(self, node, level, candidates):
+        limit = self.m0 if level == 0 else self.m
+        neighbors = [n for _, n in candidates[:self.m]]
+        self._set_neighbors(node, level, neighbors)
+        for n in neighbors:
+            links = self._neighbors(n, level) + [node]
+            if len(links) > limit:
+                # 邻居超出上限：保留与 n 最相似的 limit 个
+                sims = self._similarity(self.vectors[n], links)
+                links = [links[i] for i in np.argsort(-sims)[:limit]]
+            self._set_neighbors(n, level, links)
+
+    def _insert(self, doc_id, vector, meta):
+        node = self._append(doc_id, vector, meta)
+        self.graph0 = self._writable(self.graph0, self.size)
+        level = int(-math.log(1.0 - self.rng.random()) * self.level_mult)
+        if level > 0:
+            self.upper[node] = [[] for _ in range(level)]
+
+        if self.entry_point is None:
+            self.entry_point, self.max_level = node, level
+            return
+
+        entry = self._greedy_descent(vector, level)
+        for lvl in range(min(level, self.max_level), -1, -1):
+            candidates = self._search_layer(vector, entry, self.ef_construction, lvl)
+            self._link(node, lvl, candidates)
+            entry = [n for _, n in candidates]
+
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    _add = _insert
+
+    def _update(self, node, vector):
+        """原地更新节点向量，并按新向量重新选择它在各层的邻居（指向它的旧边保留）"""
+        self.vectors = self._writable(self.vectors, self.size)
+        self.vectors[node] = vector
+        self._set_codes(node, vector)
+        level = len(self.upper.get(node, ()))
+        entry = self._greedy_descent(vector, level)
+        for lvl in range(min(level, self.max_level), -1, -1):
+            candidates = [(sim, n) for sim, n in self._search_layer(vector, entry, self.ef_construction, lvl)
+                          if n != node]
+            if candidates:
+                self._link(node, lvl, candidates)
+                entry = [n for _, n in candidates]
+
+    def upsert(self, ids, vectors, metadata):
+        vectors = _normalize(vectors)
+        with self.lock:
+            for doc_id, vector, meta in zip(ids, vectors, metadata):
+                node = self.rows.get(doc_id)
+                if node is None:
+                    self._insert(doc_id, vector, meta)
+                    continue
+                self.metadata[node] = meta
+                # 向量未变（重复入库同一内容）时只更新元数据，图不动
+                if not np.allclose(self.vectors[node], vector, atol=1e-6):
+                    self._update(node, vector)
+        return []
+
+    def search(self, query_vector, top_k, ef=None):
+        query = _normalize(query_vector)
+        self.reload_if_changed()
+        # 与 NumpyVectorStore 一样只在取快照时持锁，图遍历与其它检索、写入并发。
+        # 写入只整行替换邻居表/向量或追加节点，compact() 换成新对象，快照始终可用；
+        # 快照之后新增的节点（编号 >= size）在遍历时忽略
+        with self.lock:
+            if self.entry_point is None or top_k <= 0:
+                return []
+            vectors, codes, scales = self.vectors, self.codes, self.scales
+            graph0, upper, size = self.graph0, self.upper, self.size
+            start = (self.entry_point, self.max_level)
+            deleted = set(self.deleted)
+            ids, metadata = self.ids, self.metadata
+
+        def neighbors(node, level):
+            if level == 0:
+                row = graph0[node]
+                return row[(row >= 0) & (row < size)].tolist()
+            return [n for n in upper[node][level - 1] if n < size]
+
+        # 建图用 float 向量；检索时图遍历只读量化码，最后对候选精排
+        if codes is None:
+            def similarity(query, nodes):
+                return vectors[nodes] @ query
+        else:
+            def similarity(query, nodes):
+                return approx_scores(codes[nodes], scales[nodes], query, self.quantization)
+        wanted = top_k if codes is None else top_k * self.oversample
+        # 有删除标记时按存活比例多取候选，过滤后仍能凑够 top_k；设上限，避免退化为全量遍历
+        widened = math.ceil(wanted * size / max(size - len(deleted), 1))
+        ef = max(ef or self.ef_search, min(widened, VectorStoreConfig.hnsw_max_ef))
+        entry = self._greedy_descent(query, 0, similarity, neighbors, start)
+        results = self._search_layer(query, entry, ef, 0, similarity, neighbors)
+        hits = [(sim, n) for sim, n in results if n not in deleted]
+        if codes is not None:
+            rows = [n for _, n in hits[:wanted]]
+            return [self._hit(n, sim, ids, metadata) for n, sim in self._rescore(vectors, rows, query, top_k)]
+        return [self._hit(n, sim, ids, metadata) for sim, n in hits[:top_k]]
+
+    # ---- 持久化 ----
+
+    def _save_extra(self):
+        self._save_array('graph0.npy', self.graph0[:self.size])
+
+    def _extra_state(self):
+        return {
+            'm': self.m,
+            'entry_point': self.entry_point,
+            'max_level': self.max_level,
+            'upper': {str(node): links for node, links in self.upper.items()}
+        }
+
+    def _load_extra(self, state):
+        self.m = state['m']
+        self.m0 = 2 * self.m
+        self.entry_point = state['entry_point']
+        self.max_level = state['max_level']
+        self.upper = {int(node): links for node, links in state['upper'].items()}
+        # 层数分布取决于 m：存储按另一个 hnsw_m 建成时，后续插入要沿用它的 m
+        self.level_mult = 1 / math.log(self.m)
+        self.graph0 = np.load(self._path('graph0.npy'), mmap_mode='r')
+        if self.graph0.shape[1] != self.m0:
+            self.graph0 = self._resize_graph0(self.graph0)
+
+    def _resize_graph0(self, graph0):
+        """把第 0 层邻接表调整为 m0 列：不足补 -1，超出时保留与节点最相似的 m0 个邻居"""
+        resized = np.full((len(graph0), self.m0), -1, dtype=np.int32)
+        for node, row in enumerate(np.asarray(graph0)):
+            links = row[row >= 0]
+            if len(links) > self.m0:
+                links = links[np.argsort(-(self.vectors[links] @ self.vectors[node]))[:self.m0]]
+            resized[node, :len(links)] = links
+        return resized
+
+
+def open_vector_store(backend, index_name, es=None, dims=EMBEDDING_DIMS, quantization=None):
+    """按名称创建向量存储；本地存储位于 VectorStoreConfig.directory/<索引名>"""
+    if backend == 'elasticsearch':
+        return ElasticsearchVectorStore(es, index_name, dims, quantization)
+    directory = os.path.join(VectorStoreConfig.directory, index_name)
+    if backend == 'numpy':
+        return NumpyVectorStore(directory, dims, quantization)
+    if backend == 'hnsw':
+        return HNSWVectorStore(directory, dims, quantization=quantization)
+    raise ValueError(f"未知的向量存储: {backend}")
+
+
+def synthetic_vectors(num, dims=EMBEDDING_DIMS, clusters=200, seed=0):
+    """带簇结构的合成向量（近似真实嵌入的分布，纯随机向量彼此几乎正交）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dims)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=num)]
+    return _normalize(vectors + 0.7 * rng.standard_normal((num, dims)).astype(np.float32))
+
+
+def quantization_report(vectors, num_queries=200, top_k=10, backend='numpy',
+                        modes=('none', 'int8', 'binary'), seed=1):
+    """各量化方式相对精确检索的 recall@k、单次检索延迟和检索内存"""
+    import tempfile
+    vectors = _normalize(vectors)
+    rng = np.random.default_rng(seed)
+    # 查询取自库内向量加噪声，模拟与文档相近但不相同的问题
+    queries = vectors[rng.integers(len(vectors), size=num_queries)]
+    queries = _normalize(queries + 0.5 * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(vectors.shape[1]))
+    exact = vectors @ queries.T
+    truth = [set(_top_rows(exact[:, i], top_k).tolist()) for i in range(num_queries)]
+    ids = [str(i) for i in range(len(vectors))]
+
+    print(f"{len(vectors)} 条 {vectors.shape[1]} 维向量, {num_queries} 个查询, top_k={top_k}, "
+          f"{backend}, oversample={VectorStoreConfig.rescore_oversample}")
+    baseline = None
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in modes:
+            store_class = HNSWVectorStore if backend == 'hnsw' else NumpyVectorStore
+            store = store_class(os.path.join(workdir, mode), vectors.shape[1], quantization=mode)
+            store.create()
+            for start in range(0, len(vectors), 1000):
+                store.upsert(ids[start:start + 1000], vectors[start:start + 1000],
+                             [{}] * len(ids[start:start + 1000]))
+            store.flush()
+            # 重新打开：与服务时一样从 memmap 读取
+            store = store_class(store.directory, vectors.shape[1], quantization=mode)
+            started = time.perf_counter()
+            results = [store.search(query, top_k) for query in queries]
+            latency_ms = (time.perf_counter() - started) * 1000 / num_queries
+            recall = np.mean([
+                len(truth[i] & {int(hit['id']) for hit in hits}) / top_k
+                for i, hits in enumerate(results)
+            ])
+            memory = store.memory_bytes()
+            baseline = baseline or memory
+            rows.append({'mode': mode, 'recall': float(recall), 'latency_ms': latency_ms,
+                         'memory_bytes': memory, 'compression': baseline / memory})
+            print(f"{mode:<8} recall@{top_k} {recall:.3f}  {latency_ms:7.2f} ms/查询  "
+                  f"{memory / 2**20:8.1f} MB ({baseline / memory:.1f}x)")
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="向量量化的召回率/延迟/内存对比")
+    parser.add_argument('--vectors', help="已有本地存储目录（含 vectors.npy），默认使用合成向量")
+    parser.add_argument('--num', type=int, default=50000, help="合成向量条数")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--backend', default='numpy', choices=['numpy', 'hnsw'])
+    args = parser.parse_args()
+    if args.vectors:
+        data = np.load(os.path.join(args.vectors, 'vectors.npy'), mmap_mode='r')
+    else:
+        data = synthetic_vectors(args.num)
+    quantization_report(data, args.queries, args.top_k, args.backend)